@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'iot_app.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -81,10 +83,143 @@ DATABASES = {
     }
 }
 
+# Local memory per process by default; point IOT_REDIS_URL at a Redis server
+# to share the device and history caches between workers
+if os.environ.get('IOT_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['IOT_REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 50000},
+        }
+    }
+
 MONGODB_SETTINGS = {
+    # 'mongo' or 'memory' (in-process store for tests and benchmarks);
+    # the IOT_STORAGE_BACKEND environment variable overrides it
+    'backend': 'mongo',
     'host': 'localhost',
     'port': 27017,
-    'db': 'iot_dashboard'
+    'db': 'iot_dashboard',
+    # A full connection string takes precedence over host/port
+    'uri': None,
+    'max_pool_size': 100,
+    'server_selection_timeout_ms': 5000,
+    'connect_timeout_ms': 5000,
+    'socket_timeout_ms': 20000,
+    'write_concern': 1,
+    # Create indexes when the app starts (see `manage.py ensure_indexes`)
+    'auto_index': True,
+    # Create telemetry as a time-series collection and expire raw readings
+    'timeseries': False,
+    'telemetry_ttl_days': 0,
+}
+
+# Telemetry ingestion. In 'queue' mode readings are acknowledged with 202 and
+# written in batches by a background thread (one queue per worker process).
+# 'partitioned' acknowledges the same way, but hands each reading to the
+# ingest worker that owns its device (see iot_app/partition.py). A 202 is not
+# a durability guarantee: a batch that keeps failing to write is dropped after
+# 'retry_limit' retries (iot_ingest_dropped_total), and readings still queued
+# when a process dies are lost.
+IOT_INGEST = {
+    'mode': 'sync',
+    'queue_size': 10000,
+    'flush_size': 500,
+    'flush_interval': 1.0,
+    # 'partitioned': readings go to `manage.py ingest_workers`, hashed by
+    # device_id; worker i listens on port + i. After changing 'workers',
+    # restart ingest_workers and then the web processes. The workers refuse to
+    # start with process-local device/history caches (set IOT_REDIS_URL), and
+    # their readings don't reach SSE streams in the web processes.
+    'workers': 4,
+    'partition_address': ('127.0.0.1', 9200),
+}
+
+# Minute/hour/day rollups maintained on ingest. History queries read the
+# coarsest tier that fits the requested bucket size instead of raw readings.
+# Each tier is only read from the time ingest started maintaining it; older
+# ranges come from raw readings until `manage.py backfill_rollups` has
+# rebuilt them. Don't run processes with rollups on and off side by side.
+IOT_ROLLUPS = {
+    'enabled': True,
+}
+
+# Incoming readings are screened per device before they are stored (see
+# iot_app/anomaly.py). Hits of the 'quarantine' kinds are kept out of
+# telemetry, rollups, daily logs and the relay rules; all hits are listed
+# at /api/anomalies/.
+IOT_ANOMALY = {
+    'enabled': True,
+    'z_threshold': 6,
+    'stuck_count': 30,
+    'quarantine': ('range', 'rate'),
+}
+
+# Raw readings older than after_days are packed into compressed per-device
+# day blocks by `manage.py archive_telemetry` (run it daily, e.g. from cron).
+# Values are kept to `decimals` places. Reads merge the archive back in when
+# enabled. With telemetry_ttl_days set, archive before the TTL expires them.
+IOT_ARCHIVE = {
+    'enabled': True,
+    'after_days': 30,
+    'decimals': 2,
+}
+
+# Device documents cached per process for the command poll path. Set 'shared'
+# with a shared CACHES backend (e.g. Redis) when running several workers, and
+# always with ingest_listener or partitioned ingest, whose writes happen in
+# another process.
+IOT_DEVICE_CACHE = {
+    'enabled': True,
+    'max_size': 10000,
+    'ttl': 15,
+    'shared': False,
+    'cache_alias': 'default',
+}
+
+# Aggregated history responses cache closed buckets indefinitely; only the
+# open bucket is recomputed. Readings arriving more than 'grace' seconds
+# after their timestamp invalidate the cached buckets of their device.
+IOT_HISTORY_CACHE = {
+    'enabled': True,
+    'cache_alias': 'default',
+    'grace': 60,
+}
+
+# Fleet overview (/api/fleet/): devices with no reading for offline_after
+# seconds are reported offline.
+IOT_FLEET = {
+    'offline_after': 120,
+}
+
+# /api/bootstrap/ fetches device, series and daily logs concurrently, on a
+# thread pool of 'workers' per process for the sync view, and answers 504
+# after 'timeout' seconds.
+IOT_BOOTSTRAP = {
+    'workers': 16,
+    'timeout': 10,
+}
+
+# Serve ingest, command polling and telemetry history from native async views
+# on an asyncio MongoDB driver. dashboard/asgi.py turns this on; under WSGI
+# the DRF viewsets are used, since async views there would need a loop per
+# request.
+IOT_ASYNC_VIEWS = os.environ.get('IOT_ASYNC_VIEWS') == '1'
+
+# Request timings and MongoDB op counts, exported at /metrics and as
+# Server-Timing headers. Operations slower than slow_query_ms are logged
+# to 'iot_app.slow_queries' with the query shape (values stripped).
+IOT_INSTRUMENTATION = {
+    'enabled': True,
+    'slow_query_ms': 100,
+    'server_timing': True,
 }
 
 # Password validation
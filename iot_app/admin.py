@@ -2,6 +2,9 @@ from django.contrib import admin
 from django.urls import path
 from django.shortcuts import render
 from .models import Device, Telemetry
+from .pagination import encode_cursor, decode_cursor
+
+PAGE_SIZE = 100
 
 class MongoAdminSite(admin.AdminSite):
     def get_urls(self):
@@ -12,9 +15,25 @@ class MongoAdminSite(admin.AdminSite):
         ]
         return custom_urls + urls
 
+    def get_cursor(self, request, fields):
+        try:
+            return decode_cursor(request.GET['after'], fields) if request.GET.get('after') else None
+        except ValueError:
+            return None
+
+    def page_context(self, objects, fields):
+        # One extra row is fetched to know whether there is a next page
+        has_next = len(objects) > PAGE_SIZE
+        objects = objects[:PAGE_SIZE]
+        return {
+            'objects': objects,
+            'next_cursor': encode_cursor(objects[-1], fields) if has_next else None,
+        }
+
     def devices_view(self, request):
+        after = self.get_cursor(request, Device.page_fields)
         context = {
-            'objects': Device.get_all(),
+            **self.page_context(Device.find_page(after, limit=PAGE_SIZE + 1), Device.page_fields),
             'title': 'Devices List',
             'opts': {'app_label': 'iot_app', 'model_name': 'device'},
             **self.each_context(request),
@@ -22,8 +41,11 @@ class MongoAdminSite(admin.AdminSite):
         return render(request, 'admin/mongo_changelist.html', context)
 
     def telemetry_view(self, request):
+        # Newest first
+        after = self.get_cursor(request, Telemetry.page_fields)
+        objects = list(Telemetry.find_range(after=after, descending=True, batch_size=PAGE_SIZE + 1).limit(PAGE_SIZE + 1))
         context = {
-            'objects': Telemetry.get_all(),
+            **self.page_context(objects, Telemetry.page_fields),
             'title': 'Telemetry List',
             'opts': {'app_label': 'iot_app', 'model_name': 'telemetry'},
             **self.each_context(request),
@@ -35,4 +57,4 @@ mongo_admin = MongoAdminSite(name='mongoadmin')
 
 # Register the admin site
 admin.site = mongo_admin
-admin.sites.site = mongo_admin
\ No newline at end of file
+admin.sites.site = mongo_admin
@@ -0,0 +1,197 @@
+import re
+from datetime import datetime, timedelta
+
+# Buckets are aligned to multiples of their size since this (naive) epoch,
+# so 10m buckets start on :00/:10/..., 1h on the hour and 1d at midnight.
+EPOCH = datetime(1970, 1, 1)
+
+FIELDS = ('temperature', 'humidity')
+
+MAX_BUCKETS = 2000
+# Longest timespan a query window may cover
+MAX_SPAN = timedelta(days=3660)
+
+# Bucket sizes used by the dashboard's fixed ranges
+DEFAULT_BUCKETS = {
+    '1h': '10m',
+    '24h': '1h',
+    '7d': '1d',
+}
+
+# Candidate bucket sizes for any other timespan, smallest first
+BUCKET_LADDER = ('1m', '5m', '10m', '15m', '30m', '1h', '3h', '6h', '12h', '1d', '7d')
+TARGET_BUCKETS = 24
+
+_DURATION_RE = re.compile(r'^(\d+)([smhdw])$')
+_UNITS = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+
+def parse_duration(value):
+    match = _DURATION_RE.match(str(value).strip())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f'Invalid duration {value!r}, expected e.g. 30m, 1h, 7d')
+    try:
+        return timedelta(**{_UNITS[match.group(2)]: int(match.group(1))})
+    except OverflowError:
+        raise ValueError(f'Duration {value!r} is too long')
+
+
+def resolve_window(timespan, bucket=None):
+    span = parse_duration(timespan)
+    if span > MAX_SPAN:
+        raise ValueError(f'Timespan must be at most {MAX_SPAN.days}d')
+    if bucket is None:
+        bucket = DEFAULT_BUCKETS.get(timespan)
+    if bucket is None:
+        for candidate in BUCKET_LADDER:
+            if span / parse_duration(candidate) <= TARGET_BUCKETS:
+                bucket = candidate
+                break
+        else:
+            bucket = BUCKET_LADDER[-1]
+    size = parse_duration(bucket)
+    if span / size > MAX_BUCKETS:
+        raise ValueError(f'Too many buckets, use a bucket of at least {span / MAX_BUCKETS}')
+    return span, size
+
+
+def align(dt, bucket):
+    return EPOCH + ((dt - EPOCH) // bucket) * bucket
+
+
+def split_interval(start, end, bucket):
+    # (bucket start, seconds) for each bucket the interval overlaps
+    while start < end:
+        bucket_start = align(start, bucket)
+        chunk_end = min(end, bucket_start + bucket)
+        yield bucket_start, (chunk_end - start).total_seconds()
+        start = chunk_end
+
+
+def merge_intervals(intervals):
+    # Union of (start, end) pairs, sorted
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(interval) for interval in merged]
+
+
+def bucket_window(now, span, bucket):
+    start = align(now - span, bucket)
+    count = (now - start) // bucket + 1
+    return start, count
+
+
+def empty_partial():
+    partial = {'count': 0}
+    for field in FIELDS:
+        partial[f'{field}_sum'] = 0
+        partial[f'{field}_min'] = None
+        partial[f'{field}_max'] = None
+    return partial
+
+
+def merge_partial(into, other):
+    into['count'] += other['count']
+    for field in FIELDS:
+        into[f'{field}_sum'] += other[f'{field}_sum']
+        for key, pick in ((f'{field}_min', min), (f'{field}_max', max)):
+            if other[key] is not None:
+                into[key] = other[key] if into[key] is None else pick(into[key], other[key])
+    return into
+
+
+def bucket_index(start, bucket, time_field='timestamp'):
+    return {'$floor': {'$divide': [
+        {'$subtract': [f'${time_field}', start]},
+        bucket // timedelta(milliseconds=1),
+    ]}}
+
+
+def bucket_pipeline(start, end, bucket, device_id=None, by_device=False):
+    # device_id may also be a list
+    match = {'timestamp': {'$gte': start, '$lt': end}}
+    if isinstance(device_id, list):
+        match['device_id'] = {'$in': device_id}
+    elif device_id:
+        match['device_id'] = device_id
+
+    index = bucket_index(start, bucket)
+    group = {
+        '_id': {'device_id': '$device_id', 'index': index} if by_device else index,
+        'count': {'$sum': 1},
+    }
+    for field in FIELDS:
+        group[f'{field}_sum'] = {'$sum': f'${field}'}
+        group[f'{field}_min'] = {'$min': f'${field}'}
+        group[f'{field}_max'] = {'$max': f'${field}'}
+
+    return [{'$match': match}, {'$group': group}]
+
+
+def rollup_pipeline(start, end, bucket, device_id=None):
+    # Same result as bucket_pipeline, computed from pre-aggregated partials
+    match = {'bucket': {'$gte': start, '$lt': end}}
+    if device_id:
+        match['device_id'] = device_id
+
+    group = {
+        '_id': bucket_index(start, bucket, time_field='bucket'),
+        'count': {'$sum': '$count'},
+    }
+    for field in FIELDS:
+        group[f'{field}_sum'] = {'$sum': f'${field}_sum'}
+        group[f'{field}_min'] = {'$min': f'${field}_min'}
+        group[f'{field}_max'] = {'$max': f'${field}_max'}
+
+    return [{'$match': match}, {'$group': group}]
+
+
+def partial_update(partial):
+    # Folds a partial into a stored rollup document
+    update = {'$inc': {'count': partial['count']}, '$min': {}, '$max': {}}
+    for field in FIELDS:
+        update['$inc'][f'{field}_sum'] = partial[f'{field}_sum']
+        update['$min'][f'{field}_min'] = partial[f'{field}_min']
+        update['$max'][f'{field}_max'] = partial[f'{field}_max']
+    return update
+
+
+def bucket_readings(readings, start, bucket, by_device=False):
+    # Single pass over readings already in memory
+    partials = {}
+    for reading in readings:
+        index = (reading['timestamp'] - start) // bucket
+        if by_device:
+            index = (reading['device_id'], index)
+        partial = partials.get(index)
+        if partial is None:
+            partial = partials[index] = empty_partial()
+        partial['count'] += 1
+        for field in FIELDS:
+            value = reading[field]
+            partial[f'{field}_sum'] += value
+            low, high = partial[f'{field}_min'], partial[f'{field}_max']
+            partial[f'{field}_min'] = value if low is None or value < low else low
+            partial[f'{field}_max'] = value if high is None or value > high else high
+    return partials
+
+
+def build_series(start, bucket, count, partials):
+    data = []
+    for index in range(count):
+        partial = partials.get(index) or empty_partial()
+        n = partial['count']
+        point = {
+            'timestamp': (start + index * bucket).isoformat(),
+            'count': n,
+        }
+        for field in FIELDS:
+            point[field] = partial[f'{field}_sum'] / n if n else 0
+            point[f'min_{field}'] = partial[f'{field}_min']
+            point[f'max_{field}'] = partial[f'{field}_max']
+        data.append(point)
+    return data
@@ -0,0 +1,285 @@
+import math
+from datetime import timedelta
+from itertools import islice
+import numpy as np
+from .aggregation import EPOCH, FIELDS
+from .models import RollupWatermark, Telemetry, TelemetryArchive, TelemetryRollup, archive_enabled
+
+PERCENTILES = (5, 50, 95)
+
+# Longest timespan analysed
+MAX_SPAN = timedelta(days=366)
+# Buckets this long or longer are summarised from a rollup tier, as are
+# ranges with more raw readings than MAX_RAW_ROWS
+ROLLUP_BUCKET = timedelta(days=1)
+MAX_RAW_ROWS = 2000000
+FETCH_BATCH = 5000
+
+ROLLUP_FIELDS = ('count', *(f'{field}_{part}' for field in FIELDS for part in ('sum', 'min', 'max')))
+
+# Magnus formula coefficients (Sonntag 1990), valid for -45..60 °C
+MAGNUS_B = 17.62
+MAGNUS_C = 243.12
+
+
+def batches(rows, size=FETCH_BATCH):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def grown(array, capacity):
+    return np.concatenate((array, np.empty(capacity - len(array), dtype=array.dtype)))
+
+
+class ColumnReader:
+    # Fills arrays preallocated from a count, a batch of rows at a time.
+    # Device ids are kept as integer codes until the end.
+
+    def __init__(self, capacity, time_field, fields):
+        self.capacity = max(capacity, 1)
+        self.time_field = time_field
+        self.size = 0
+        self.codes = {}
+        self.device = np.empty(self.capacity, dtype=np.int64)
+        self.time = np.empty(self.capacity, dtype='datetime64[us]')
+        self.values = {field: np.empty(self.capacity) for field in fields}
+
+    def add(self, batch):
+        end = self.size + len(batch)
+        if end > self.capacity:
+            # Rows written since the count
+            self.capacity = max(end, self.capacity * 2)
+            self.device = grown(self.device, self.capacity)
+            self.time = grown(self.time, self.capacity)
+            self.values = {field: grown(values, self.capacity) for field, values in self.values.items()}
+        codes = self.codes
+        self.device[self.size:end] = [codes.setdefault(row['device_id'], len(codes)) for row in batch]
+        self.time[self.size:end] = [row[self.time_field] for row in batch]
+        for field, values in self.values.items():
+            values[self.size:end] = [row[field] for row in batch]
+        self.size = end
+
+    def columns(self):
+        # Ordered by device, then time, so each device is a contiguous slice
+        names = sorted(self.codes)
+        rank = np.empty(len(names), dtype=np.int64)
+        rank[[self.codes[name] for name in names]] = np.arange(len(names))
+        codes = rank[self.device[:self.size]]
+        times = self.time[:self.size]
+        order = np.lexsort((times, codes))
+        columns = {
+            'device_id': np.array(names, dtype=object)[codes[order]],
+            # Seconds since the naive epoch used for bucketing
+            'time': (times[order] - np.datetime64(EPOCH, 'us')) / np.timedelta64(1, 's'),
+        }
+        for field, values in self.values.items():
+            columns[field] = values[:self.size][order]
+        return columns
+
+
+def fetch_columns(start_time, end_time, device_ids=None):
+    # Raw readings, live and archived; None when there are more than
+    # MAX_RAW_ROWS of them
+    query = {'timestamp': {'$gte': start_time, '$lt': end_time}}
+    if device_ids:
+        query['device_id'] = {'$in': device_ids}
+    blocks = TelemetryArchive.find_blocks(start_time, end_time, device_ids or None) if archive_enabled() else []
+    expected = Telemetry.collection.count_documents(query) + sum(block['count'] for block in blocks)
+    if expected > MAX_RAW_ROWS:
+        return None
+
+    reader = ColumnReader(expected, 'timestamp', FIELDS)
+    cursor = Telemetry.collection.find(
+        query,
+        {'_id': 0, 'device_id': 1, 'timestamp': 1, 'temperature': 1, 'humidity': 1}
+    ).batch_size(FETCH_BATCH)
+    for batch in batches(cursor):
+        reader.add(batch)
+    for batch in batches(TelemetryArchive.readings(blocks, start_time, end_time)):
+        reader.add(batch)
+    return reader.columns()
+
+
+def rollup_tier(start_time, bucket, window):
+    # Coarsest tier whose buckets tile both the series buckets and the window
+    for tier in TelemetryRollup.tiers():
+        if not (bucket % tier.resolution or window % tier.resolution or (start_time - EPOCH) % tier.resolution):
+            return tier
+    return None
+
+
+def fetch_rollup_columns(tier, start_time, end_time, device_ids=None):
+    # One row per device and tier bucket: the bucket's mean as the value and
+    # its count as the weight. Buckets before the tier's watermark are
+    # aggregated from raw readings by the database.
+    split = Telemetry.rollup_split(start_time, end_time, tier.resolution, RollupWatermark.complete_from(tier))
+    raw = tier.raw_partials(start_time, split, device_ids)
+    query = {'bucket': {'$gte': split, '$lt': end_time}}
+    if device_ids:
+        query['device_id'] = {'$in': device_ids}
+
+    reader = ColumnReader(len(raw) + tier.collection.count_documents(query), 'bucket', ROLLUP_FIELDS)
+    rows = (
+        {'device_id': device_id, 'bucket': start_time + index * tier.resolution, **partial}
+        for (device_id, index), partial in raw.items()
+    )
+    for batch in batches(rows):
+        reader.add(batch)
+    for batch in batches(tier.collection.find(query, {'_id': 0}).batch_size(FETCH_BATCH)):
+        reader.add(batch)
+    columns = reader.columns()
+    columns['weight'] = columns.pop('count')
+    for field in FIELDS:
+        columns[field] = columns[f'{field}_sum'] / columns['weight']
+    return columns
+
+
+def split_by_device(columns):
+    ids = columns['device_id']
+    if not len(ids):
+        return {}
+    # Indices where the device changes in the device-sorted columns
+    edges = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+    bounds = zip(np.concatenate(([0], edges)), np.concatenate((edges, [len(ids)])))
+    return {
+        ids[lo]: {name: column[lo:hi] for name, column in columns.items() if name != 'device_id'}
+        for lo, hi in bounds
+    }
+
+
+def dew_point(temperature, humidity):
+    gamma = np.log(np.clip(humidity, 1e-6, 100) / 100) + MAGNUS_B * temperature / (MAGNUS_C + temperature)
+    return MAGNUS_C * gamma / (MAGNUS_B - gamma)
+
+
+def heat_index(temperature, humidity):
+    # NOAA Rothfusz regression in °F with the simple formula below 80 °F
+    t = temperature * 9 / 5 + 32
+    rh = humidity
+    simple = 0.5 * (t + 61 + (t - 68) * 1.2 + rh * 0.094)
+    full = (-42.379 + 2.04901523 * t + 10.14333127 * rh - 0.22475541 * t * rh
+            - 6.83783e-3 * t * t - 5.481717e-2 * rh * rh + 1.22874e-3 * t * t * rh
+            + 8.5282e-4 * t * rh * rh - 1.99e-6 * t * t * rh * rh)
+    result = np.where((simple + t) / 2 >= 80, full, simple)
+    return (result - 32) * 5 / 9
+
+
+def describe(values, times, weights=None):
+    # weights: readings behind each value when the values are bucket means
+    mean = np.average(values, weights=weights)
+    stats = {
+        'mean': mean,
+        'std': np.sqrt(np.average((values - mean) ** 2, weights=weights)),
+        'min': values.min(),
+        'max': values.max(),
+    }
+    for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        stats[f'p{p}'] = value
+
+    # Least-squares trend and steepest step between consecutive readings, per hour
+    hours = (times - times[0]) / 3600
+    if len(values) > 1 and hours[-1] > 0:
+        stats['trend_per_hour'] = np.polyfit(hours, values, 1, w=None if weights is None else np.sqrt(weights))[0]
+        dt = np.diff(hours)
+        steps = np.divide(np.diff(values), dt, out=np.zeros_like(dt), where=dt > 0)
+        stats['max_rate_per_hour'] = np.abs(steps).max()
+    else:
+        stats['trend_per_hour'] = None
+        stats['max_rate_per_hour'] = None
+    return stats
+
+
+def bucket_series(values, times, start, bucket_seconds, count, window_seconds, weights=None):
+    if weights is None:
+        weights = np.ones_like(values)
+    index = ((times - start) // bucket_seconds).astype(np.int64)
+    counts = np.bincount(index, weights=weights, minlength=count)[:count]
+    sums = np.bincount(index, weights=values * weights, minlength=count)[:count]
+    means = np.divide(sums, counts, out=np.full(count, np.nan), where=counts > 0)
+
+    # Trailing time-window mean evaluated at each bucket end, via prefix sums
+    prefix = np.concatenate(([0.0], np.cumsum(values * weights)))
+    prefix_n = np.concatenate(([0.0], np.cumsum(weights)))
+    ends = start + bucket_seconds * np.arange(1, count + 1)
+    hi = np.searchsorted(times, ends, side='left')
+    lo = np.searchsorted(times, ends - window_seconds, side='left')
+    n = prefix_n[hi] - prefix_n[lo]
+    rolling = np.divide(prefix[hi] - prefix[lo], n, out=np.full(count, np.nan), where=n > 0)
+    return means, rolling
+
+
+def clean(value):
+    if isinstance(value, dict):
+        return {k: clean(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [clean(v) for v in value]
+    if value is None:
+        return None
+    value = float(value)
+    return None if math.isnan(value) or math.isinf(value) else round(value, 3)
+
+
+def analyze(start_time, end_time, bucket, window, device_ids=None):
+    # Raises ValueError for ranges too large to analyse
+    if end_time - start_time > MAX_SPAN:
+        raise ValueError(f'Timespan must be at most {MAX_SPAN.days}d')
+    tier = rollup_tier(start_time, bucket, window)
+    columns = None
+    if tier is None or bucket < ROLLUP_BUCKET:
+        columns = fetch_columns(start_time, end_time, device_ids)
+        if columns is None and tier is None:
+            raise ValueError(f'More than {MAX_RAW_ROWS} readings, use a bucket of whole minutes')
+    source = 'raw'
+    if columns is None:
+        columns = fetch_rollup_columns(tier, start_time, end_time, device_ids)
+        source = tier.collection.name
+
+    start = (start_time - EPOCH) / timedelta(seconds=1)
+    bucket_seconds = bucket / timedelta(seconds=1)
+    count = int(math.ceil(((end_time - start_time) / timedelta(seconds=1)) / bucket_seconds))
+    window_seconds = window / timedelta(seconds=1)
+
+    results = []
+    for device_id, data in split_by_device(columns).items():
+        times, temperature, humidity = data['time'], data['temperature'], data['humidity']
+        weights = data.get('weight')
+        stats = {field: describe(data[field], times, weights) for field in FIELDS}
+        if weights is not None:
+            # Extremes of the readings rather than of the bucket means
+            for field in FIELDS:
+                stats[field].update(min=data[f'{field}_min'].min(), max=data[f'{field}_max'].max())
+        dew = dew_point(temperature, humidity)
+        heat = heat_index(temperature, humidity)
+        temp_means, temp_rolling = bucket_series(
+            temperature, times, start, bucket_seconds, count, window_seconds, weights
+        )
+        hum_means, hum_rolling = bucket_series(
+            humidity, times, start, bucket_seconds, count, window_seconds, weights
+        )
+        results.append({
+            'device_id': device_id,
+            'count': len(times) if weights is None else int(weights.sum()),
+            'temperature': clean(stats['temperature']),
+            'humidity': clean(stats['humidity']),
+            'dew_point': clean({'mean': dew.mean(), 'min': dew.min(), 'max': dew.max(), 'latest': dew[-1]}),
+            'heat_index': clean({'mean': heat.mean(), 'max': heat.max(), 'latest': heat[-1]}),
+            'series': {
+                'temperature_mean': clean(temp_means),
+                'temperature_rolling': clean(temp_rolling),
+                'humidity_mean': clean(hum_means),
+                'humidity_rolling': clean(hum_rolling),
+            },
+        })
+    return {
+        # 'raw', or the rollup tier the statistics were computed from
+        'source': source,
+        'start': start_time.isoformat(),
+        'bucket_seconds': bucket_seconds,
+        'window_seconds': window_seconds,
+        'timestamps': [(start_time + i * bucket).isoformat() for i in range(count)],
+        'devices': results,
+    }
@@ -0,0 +1,180 @@
+import math
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from django.conf import settings
+
+# Online sensor-fault screening on the ingest path. Each device keeps a few
+# numbers per field (EWMA mean and variance, the last accepted value and
+# time, a run length of identical readings), so a reading is scored in O(1)
+# without looking at history. Checks, in order:
+#
+#   range   outside what the sensor can report
+#   rate    moved faster than max_rate per minute since the last accepted
+#           reading; gaps under rate_window seconds count as rate_window, so
+#           sensor noise between readings taken seconds apart isn't a spike
+#   zscore  more than z_threshold EWMA standard deviations from the EWMA mean,
+#           once warmup readings have been seen
+#   stuck   stuck_count identical readings in a row (reported once per run)
+#
+# Kinds listed in 'quarantine' keep the reading out of telemetry, rollups,
+# daily logs and the relay rules; other hits are stored with the reading.
+# Quarantined readings don't update the state, so a genuine jump is let
+# through by the rate check once enough time has passed. Leave zscore as a
+# flag: quarantining it would reject a lasting level shift indefinitely.
+#
+# State is per process, like the device cache, and relearns after a restart.
+
+DEFAULTS = {
+    'enabled': True,
+    # DHT22 limits
+    'range': {'temperature': (-40, 80), 'humidity': (0, 100)},
+    'max_rate': {'temperature': 5, 'humidity': 20},
+    'rate_window': 60,
+    'alpha': 0.05,
+    'warmup': 30,
+    'z_threshold': 6,
+    # Floor for the standard deviation of a very steady signal
+    'min_std': {'temperature': 0.2, 'humidity': 1.0},
+    'stuck_count': 30,
+    'quarantine': ('range', 'rate'),
+    'max_devices': 100000,
+}
+
+FIELDS = ('temperature', 'humidity')
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'IOT_ANOMALY', {})}
+
+
+class DeviceState:
+    __slots__ = ('samples', 'mean', 'var', 'last', 'last_time', 'run')
+
+    def __init__(self):
+        self.samples = 0
+        self.mean = dict.fromkeys(FIELDS, 0.0)
+        self.var = dict.fromkeys(FIELDS, 0.0)
+        self.last = dict.fromkeys(FIELDS)
+        self.last_time = None
+        self.run = 0
+
+    def update(self, reading, alpha):
+        for field in FIELDS:
+            value = reading[field]
+            if self.samples == 0:
+                self.mean[field] = value
+            else:
+                # Exponentially weighted Welford update
+                diff = value - self.mean[field]
+                self.mean[field] += alpha * diff
+                self.var[field] = (1 - alpha) * (self.var[field] + alpha * diff * diff)
+        same = self.last_time is not None and all(reading[f] == self.last[f] for f in FIELDS)
+        self.run = self.run + 1 if same else 1
+        for field in FIELDS:
+            self.last[field] = reading[field]
+        self.last_time = reading['timestamp']
+        self.samples += 1
+
+
+class Detector:
+    def __init__(self, config):
+        self.config = config
+        self.quarantine = frozenset(config['quarantine'])
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _state(self, device_id):
+        state = self._states.get(device_id)
+        if state is None:
+            state = self._states[device_id] = DeviceState()
+            if len(self._states) > self.config['max_devices']:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(device_id)
+        return state
+
+    def score(self, state, reading):
+        # [(kind, field, expected, score)]
+        config = self.config
+        hits = []
+        for field in FIELDS:
+            low, high = config['range'][field]
+            if not low <= reading[field] <= high:
+                hits.append(('range', field, None, None))
+        if hits:
+            return hits
+
+        if state.last_time is not None and reading['timestamp'] > state.last_time:
+            seconds = (reading['timestamp'] - state.last_time).total_seconds()
+            minutes = max(seconds, config['rate_window']) / 60
+            for field in FIELDS:
+                rate = abs(reading[field] - state.last[field]) / minutes
+                if rate > config['max_rate'][field]:
+                    hits.append(('rate', field, state.last[field], rate))
+        if state.samples >= config['warmup']:
+            for field in FIELDS:
+                std = max(math.sqrt(state.var[field]), config['min_std'][field])
+                z = abs(reading[field] - state.mean[field]) / std
+                if z > config['z_threshold']:
+                    hits.append(('zscore', field, state.mean[field], z))
+        return hits
+
+    def screen(self, docs):
+        # (docs to store, anomaly events), readings scored per device in
+        # timestamp order
+        accepted, events = [], []
+        detected_at = datetime.now()
+        with self._lock:
+            for doc in sorted(docs, key=lambda d: (d['device_id'], d['timestamp'])):
+                state = self._state(doc['device_id'])
+                hits = self.score(state, doc)
+                quarantined = any(kind in self.quarantine for kind, _, _, _ in hits)
+                if not quarantined and (state.last_time is None or doc['timestamp'] > state.last_time):
+                    state.update(doc, self.config['alpha'])
+                    if state.run == self.config['stuck_count']:
+                        hits.append(('stuck', None, None, state.run))
+                        quarantined = 'stuck' in self.quarantine
+                if not quarantined:
+                    accepted.append(doc)
+                for kind, field, expected, score in hits:
+                    events.append({
+                        'device_id': doc['device_id'],
+                        'timestamp': doc['timestamp'],
+                        'kind': kind,
+                        'field': field,
+                        'value': doc[field] if field else None,
+                        'expected': expected,
+                        'score': score,
+                        'action': 'quarantined' if quarantined else 'flagged',
+                        'reading': {f: doc[f] for f in FIELDS},
+                        'detected_at': detected_at,
+                    })
+        return accepted, events
+
+    def tracked(self):
+        with self._lock:
+            return len(self._states)
+
+
+_detector = None
+_lock = threading.Lock()
+
+
+def get_detector():
+    # None when screening is turned off
+    global _detector
+    config = get_settings()
+    if not config['enabled']:
+        return None
+    if _detector is None:
+        with _lock:
+            if _detector is None:
+                _detector = Detector(config)
+    return _detector
+
+
+def reset_detector():
+    global _detector
+    with _lock:
+        _detector = None
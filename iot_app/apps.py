@@ -1,6 +1,19 @@
+import threading
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class IotAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'iot_app'
+
+    def ready(self):
+        mongo_settings = getattr(settings, 'MONGODB_SETTINGS', {})
+        if mongo_settings.get('auto_index', False):
+            from .indexes import ensure_indexes_on_startup
+            # Runs in the background so an unreachable server can't stall startup
+            threading.Thread(
+                target=ensure_indexes_on_startup,
+                args=(mongo_settings,),
+                daemon=True
+            ).start()
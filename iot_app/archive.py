@@ -0,0 +1,67 @@
+import sys
+import zlib
+from array import array
+from datetime import timedelta
+from itertools import accumulate
+
+# Column blocks for archived telemetry: one device, one day, all readings
+# packed into a single zlib-compressed payload laid out column by column.
+#
+#   timestamps   int64 delta-of-delta in microseconds from the block start
+#   temperature  int32 deltas of the value quantized to 10^-decimals
+#   humidity     int32 deltas of the value quantized to 10^-decimals
+#
+# Readings at a steady interval turn into runs of zero, which is what zlib
+# compresses best; a day of one-minute readings is a few hundred bytes
+# instead of ~100 KB of BSON documents. Values are rounded to `decimals`,
+# which at the default of 2 is finer than the DHT22 reports.
+
+VERSION = 1
+FIELDS = ('temperature', 'humidity')
+MICROSECOND = timedelta(microseconds=1)
+
+
+def _to_bytes(values, typecode):
+    column = array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def _from_bytes(data, typecode):
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def _deltas(values):
+    previous = 0
+    for value in values:
+        yield value - previous
+        previous = value
+
+
+def encode_block(readings, start, decimals=2):
+    # readings in timestamp order, none before start
+    offsets = [(r['timestamp'] - start) // MICROSECOND for r in readings]
+    parts = [_to_bytes(_deltas(_deltas(offsets)), 'q')]
+    scale = 10 ** decimals
+    for field in FIELDS:
+        parts.append(_to_bytes(_deltas(round(r[field] * scale) for r in readings), 'i'))
+    return zlib.compress(b''.join(parts))
+
+
+def decode_block(data, start, count, decimals=2):
+    # Columns: ([timestamp], {field: [value]})
+    payload = zlib.decompress(data)
+    split = count * 8
+    offsets = accumulate(accumulate(_from_bytes(payload[:split], 'q')))
+    timestamps = [start + timedelta(microseconds=offset) for offset in offsets]
+    scale = 10 ** decimals
+    values = {}
+    for i, field in enumerate(FIELDS):
+        column = payload[split + i * count * 4:split + (i + 1) * count * 4]
+        values[field] = [value / scale for value in accumulate(_from_bytes(column, 'i'))]
+    return timestamps, values
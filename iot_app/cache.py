@@ -0,0 +1,312 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from .aggregation import EPOCH
+
+DEFAULTS = {
+    'enabled': True,
+    'max_size': 10000,
+    'ttl': 15,
+    # Keep entries in a Django cache (e.g. Redis) shared by all workers
+    # instead of per process
+    'shared': False,
+    'cache_alias': 'default',
+}
+
+HISTORY_DEFAULTS = {
+    'enabled': True,
+    'cache_alias': 'default',
+    # A bucket is closed once it ended this many seconds ago; readings
+    # older than this on arrival count as late and invalidate the cache
+    'grace': 60,
+    # Closed buckets never change, the timeout only bounds memory use
+    'timeout': 8 * 86400,
+}
+
+
+class DeviceCache:
+    # TTL + LRU bounded, per process
+
+    def __init__(self, max_size=10000, ttl=15):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, device_id):
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[device_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(device_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def get_many(self, device_ids):
+        found = {}
+        for device_id in device_ids:
+            device = self.get(device_id)
+            if device is not None:
+                found[device_id] = device
+        return found
+
+    def set(self, device_id, device):
+        with self._lock:
+            self._entries[device_id] = (time.monotonic() + self.ttl, dict(device))
+            self._entries.move_to_end(device_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Async views use these; process memory, so nothing to wait for
+
+    async def aget(self, device_id):
+        return self.get(device_id)
+
+    async def aget_many(self, device_ids):
+        return self.get_many(device_ids)
+
+    async def aset(self, device_id, device):
+        self.set(device_id, device)
+
+
+class SharedDeviceCache:
+    # Same interface on top of a Django cache backend
+
+    prefix = 'iot:device:'
+
+    def __init__(self, alias='default', ttl=15):
+        self.cache = caches[alias]
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, device_id):
+        device = self.cache.get(self.prefix + device_id)
+        if device is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return device
+
+    def get_many(self, device_ids):
+        found = self.cache.get_many([self.prefix + device_id for device_id in device_ids])
+        self.hits += len(found)
+        self.misses += len(device_ids) - len(found)
+        return {key[len(self.prefix):]: device for key, device in found.items()}
+
+    def set(self, device_id, device):
+        self.cache.set(self.prefix + device_id, device, self.ttl)
+
+    def invalidate(self, device_id):
+        self.cache.delete(self.prefix + device_id)
+
+    # Through the async cache API, so a network backend doesn't block the
+    # event loop
+
+    async def aget(self, device_id):
+        device = await self.cache.aget(self.prefix + device_id)
+        if device is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return device
+
+    async def aget_many(self, device_ids):
+        found = await self.cache.aget_many([self.prefix + device_id for device_id in device_ids])
+        self.hits += len(found)
+        self.misses += len(device_ids) - len(found)
+        return {key[len(self.prefix):]: device for key, device in found.items()}
+
+    async def aset(self, device_id, device):
+        await self.cache.aset(self.prefix + device_id, device, self.ttl)
+
+
+class NullDeviceCache:
+    hits = misses = 0
+
+    def get(self, device_id):
+        return None
+
+    def get_many(self, device_ids):
+        return {}
+
+    def set(self, device_id, device):
+        pass
+
+    def invalidate(self, device_id):
+        pass
+
+    def clear(self):
+        pass
+
+    async def aget(self, device_id):
+        return None
+
+    async def aget_many(self, device_ids):
+        return {}
+
+    async def aset(self, device_id, device):
+        pass
+
+
+_device_cache = None
+_lock = threading.Lock()
+
+
+def process_local_caches():
+    # Caches a process that ingests on behalf of the web processes
+    # (ingest_listener, partitioned ingest workers) can't update for them:
+    # web processes keep serving their own copies until the entries expire
+    local = []
+    device = {**DEFAULTS, **getattr(settings, 'IOT_DEVICE_CACHE', {})}
+    if device['enabled'] and (not device['shared'] or isinstance(caches[device['cache_alias']], LocMemCache)):
+        local.append(f"device cache (stale for up to {device['ttl']}s)")
+    history = {**HISTORY_DEFAULTS, **getattr(settings, 'IOT_HISTORY_CACHE', {})}
+    if history['enabled'] and isinstance(caches[history['cache_alias']], LocMemCache):
+        local.append('history cache (late readings never invalidate cached buckets)')
+    return local
+
+
+def get_device_cache():
+    global _device_cache
+    if _device_cache is None:
+        with _lock:
+            if _device_cache is None:
+                config = {**DEFAULTS, **getattr(settings, 'IOT_DEVICE_CACHE', {})}
+                if not config['enabled']:
+                    _device_cache = NullDeviceCache()
+                elif config['shared']:
+                    _device_cache = SharedDeviceCache(config['cache_alias'], config['ttl'])
+                else:
+                    _device_cache = DeviceCache(config['max_size'], config['ttl'])
+    return _device_cache
+
+
+def reset_device_cache():
+    global _device_cache, _history_cache
+    with _lock:
+        _device_cache = None
+        _history_cache = None
+
+
+class HistoryCache:
+    # Closed telemetry buckets, keyed by a per-device generation. A late
+    # reading replaces the generation of its device (and of the all-devices
+    # scope '*'), which orphans every cached bucket for it at once.
+
+    prefix = 'iot:history:'
+
+    def __init__(self, alias='default', grace=60, timeout=None):
+        self.cache = caches[alias]
+        self.grace = timedelta(seconds=grace)
+        self.timeout = timeout
+
+    def _init(self, key, value):
+        # add() keeps whatever a concurrent request stored first
+        if self.cache.add(key, value, None):
+            return value
+        return self.cache.get(key, value)
+
+    async def _ainit(self, key, value):
+        if await self.cache.aadd(key, value, None):
+            return value
+        return await self.cache.aget(key, value)
+
+    def state_keys(self, device_id):
+        scope = device_id or '*'
+        return f'{self.prefix}gen:{scope}', f'{self.prefix}mtime:{scope}'
+
+    def state(self, device_id=None):
+        # (generation, last modified) for a device or all devices. Missing
+        # entries restart from now, so eviction never serves stale data.
+        generation_key, modified_key = self.state_keys(device_id)
+        found = self.cache.get_many([generation_key, modified_key])
+        generation = found.get(generation_key)
+        if generation is None:
+            generation = self._init(generation_key, time.time_ns())
+        modified = found.get(modified_key)
+        if modified is None:
+            modified = self._init(modified_key, datetime.now())
+        return generation, modified
+
+    async def astate(self, device_id=None):
+        # The async methods go through Django's async cache API, so a
+        # network backend doesn't block the event loop
+        generation_key, modified_key = self.state_keys(device_id)
+        found = await self.cache.aget_many([generation_key, modified_key])
+        generation = found.get(generation_key)
+        if generation is None:
+            generation = await self._ainit(generation_key, time.time_ns())
+        modified = found.get(modified_key)
+        if modified is None:
+            modified = await self._ainit(modified_key, datetime.now())
+        return generation, modified
+
+    def bucket_keys(self, device_id, generation, start, bucket, count):
+        first = (start - EPOCH) // bucket
+        size = int(bucket.total_seconds())
+        return [f'{self.prefix}{device_id or "*"}:{generation}:{size}:{first + i}' for i in range(count)]
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys) if keys else {}
+
+    async def aget_many(self, keys):
+        return await self.cache.aget_many(keys) if keys else {}
+
+    def set_many(self, entries):
+        if entries:
+            self.cache.set_many(entries, self.timeout)
+
+    async def aset_many(self, entries):
+        if entries:
+            await self.cache.aset_many(entries, self.timeout)
+
+    def touch_entries(self, device_ids, late_device_ids):
+        now = datetime.now()
+        entries = {f'{self.prefix}mtime:{scope}': now for scope in [*device_ids, '*']}
+        if late_device_ids:
+            generation = time.time_ns()
+            entries.update({f'{self.prefix}gen:{scope}': generation for scope in [*late_device_ids, '*']})
+        return entries
+
+    def touch(self, device_ids, late_device_ids=()):
+        # Called after ingest: moves Last-Modified forward and invalidates
+        # closed buckets of devices that received late readings
+        self.cache.set_many(self.touch_entries(device_ids, late_device_ids), None)
+
+    async def atouch(self, device_ids, late_device_ids=()):
+        await self.cache.aset_many(self.touch_entries(device_ids, late_device_ids), None)
+
+
+_history_cache = None
+
+
+def get_history_cache():
+    # None when disabled
+    global _history_cache
+    if _history_cache is None:
+        with _lock:
+            if _history_cache is None:
+                config = {**HISTORY_DEFAULTS, **getattr(settings, 'IOT_HISTORY_CACHE', {})}
+                if config['enabled']:
+                    _history_cache = HistoryCache(config['cache_alias'], config['grace'], config['timeout'])
+                else:
+                    _history_cache = False
+    return _history_cache or None
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+
+# Events queued per subscriber before the oldest ones are dropped
+MAX_PENDING = 256
+
+
+def _json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+class Subscription:
+    def __init__(self, loop, device_id=None):
+        self.loop = loop
+        self.device_id = device_id
+        self.queue = asyncio.Queue(MAX_PENDING)
+        self.dropped = 0
+
+    def wants(self, device_id):
+        return self.device_id is None or self.device_id == device_id
+
+    def deliver(self, event):
+        # Runs on the subscriber's event loop; slow consumers lose the oldest events
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class EventBroker:
+    """
+    In-process pub/sub between the ingest path (any thread) and async
+    subscribers such as the SSE stream. Events only reach subscribers in
+    the same process.
+    """
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, device_id=None):
+        subscription = Subscription(asyncio.get_running_loop(), device_id)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def has_subscribers(self):
+        return bool(self._subscriptions)
+
+    def publish(self, event_type, device_id, data):
+        if not self._subscriptions:
+            return
+        event = {'type': event_type, 'data': {k: _json_value(v) for k, v in data.items()}}
+        with self._lock:
+            subscriptions = [s for s in self._subscriptions if s.wants(device_id)]
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError:
+                # The subscriber's loop has closed
+                self.unsubscribe(subscription)
+
+
+broker = EventBroker()
+
+
+def publish_readings(readings):
+    if not broker.has_subscribers():
+        return
+    for reading in readings:
+        broker.publish('telemetry', reading['device_id'], {
+            'device_id': reading['device_id'],
+            'temperature': reading['temperature'],
+            'humidity': reading['humidity'],
+            'timestamp': reading['timestamp']
+        })
+
+
+COMMAND_FIELDS = {
+    'relay_state': 'relay',
+    'auto_mode': 'auto_mode',
+    'temp_threshold_high': 'temp_threshold_high',
+    'temp_threshold_low': 'temp_threshold_low',
+    'state_version': 'version',
+}
+
+
+def publish_device(device_id, fields):
+    # fields may be a whole device document or just the updated fields
+    if not broker.has_subscribers():
+        return
+    data = {name: fields[key] for key, name in COMMAND_FIELDS.items() if key in fields}
+    if data:
+        broker.publish('device', device_id, {'device_id': device_id, **data})
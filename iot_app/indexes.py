@@ -0,0 +1,134 @@
+import logging
+from datetime import datetime, timedelta
+from pymongo.errors import OperationFailure, PyMongoError
+from .models import Anomaly, Device, Telemetry, TelemetryArchive, DailyLog, TelemetryRollup, RelayEvent, RelayRuntime
+from .storage import get_database
+
+logger = logging.getLogger(__name__)
+
+MODELS = (Device, Telemetry, TelemetryArchive, DailyLog, *TelemetryRollup.tiers(), RelayEvent, RelayRuntime, Anomaly)
+
+
+def create_timeseries_collection(ttl_seconds=None):
+    db = get_database()
+    name = Telemetry.collection.name
+    if name in db.list_collection_names():
+        return False
+    options = {
+        'timeseries': {
+            'timeField': 'timestamp',
+            'metaField': 'device_id',
+            'granularity': 'seconds'
+        }
+    }
+    if ttl_seconds:
+        options['expireAfterSeconds'] = ttl_seconds
+    db.create_collection(name, **options)
+    return True
+
+
+def is_timeseries(collection):
+    db = get_database()
+    info = next(db.list_collections(filter={'name': collection.name}), None)
+    return bool(info and info.get('type') == 'timeseries')
+
+
+def set_telemetry_ttl(ttl_seconds):
+    db = get_database()
+    collection = Telemetry.collection
+    if is_timeseries(collection):
+        db.command('collMod', collection.name, expireAfterSeconds=ttl_seconds)
+        return
+    try:
+        collection.create_index([('timestamp', 1)], expireAfterSeconds=ttl_seconds)
+    except OperationFailure:
+        # A plain timestamp index already exists, turn it into a TTL index
+        db.command('collMod', collection.name, index={
+            'keyPattern': {'timestamp': 1},
+            'expireAfterSeconds': ttl_seconds
+        })
+
+
+def index_name(keys):
+    return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+
+def ensure_indexes(timeseries=False, ttl_seconds=None):
+    # (created, failures). An index the server refuses (e.g. one that
+    # conflicts with an existing index) is reported and the rest still get
+    # created; connection errors are raised.
+    created, failures = [], []
+    if timeseries and create_timeseries_collection(ttl_seconds):
+        created.append(f'{Telemetry.collection.name} (time-series)')
+    for model in MODELS:
+        for spec in model.indexes:
+            options = {k: v for k, v in spec.items() if k != 'keys'}
+            try:
+                created.append(f"{model.collection.name}.{model.collection.create_index(spec['keys'], **options)}")
+            except OperationFailure as e:
+                failures.append((f"{model.collection.name}.{index_name(spec['keys'])}", e))
+    if ttl_seconds:
+        try:
+            set_telemetry_ttl(ttl_seconds)
+        except OperationFailure as e:
+            failures.append((f'{Telemetry.collection.name} TTL', e))
+    return created, failures
+
+
+def hot_queries():
+    now = datetime.now()
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    window = {'$gte': now - timedelta(hours=1), '$lt': now}
+    return [
+        ('Device.get_by_id', Device.collection.find({'device_id': '001'})),
+        ('Telemetry.get_range', Telemetry.collection.find({'timestamp': window, 'device_id': '001'})),
+        ('Telemetry.get_range (all devices)', Telemetry.collection.find({'timestamp': window})),
+        ('TelemetryArchive.find_blocks', TelemetryArchive.collection.find(TelemetryArchive.range_query(now - timedelta(hours=1), now, '001'))),
+        ('DailyLog.get_or_create', DailyLog.collection.find({'device_id': '001', 'date': day})),
+        ('DailyLog.get_range', DailyLog.collection.find({'date': {'$gte': day}}).sort('date', -1)),
+        ('Device.count_online', Device.collection.find({'last_seen': {'$gte': now - timedelta(minutes=2)}})),
+        ('Anomaly.find_page', Anomaly.collection.find({'timestamp': {'$gte': day}}).sort([('timestamp', -1), ('_id', -1)])),
+        ('RelayEvent.open_runs', RelayEvent.collection.find({'end': None})),
+        ('RelayRuntime.runtime_seconds', RelayRuntime.collection.find({'hour': {'$gte': day}})),
+    ]
+
+
+def plan_stages(explain):
+    # Collect every stage name below any winningPlan, wherever the server
+    # nests it (time-series collections wrap it in an aggregation explain)
+    stages = []
+
+    def walk(node, in_plan):
+        if isinstance(node, dict):
+            if in_plan and 'stage' in node:
+                stages.append(node['stage'])
+            for key, value in node.items():
+                walk(value, in_plan or key == 'winningPlan')
+        elif isinstance(node, list):
+            for value in node:
+                walk(value, in_plan)
+
+    walk(explain, False)
+    return stages
+
+
+def check_query_plans():
+    failures = []
+    for name, cursor in hot_queries():
+        stages = plan_stages(cursor.explain())
+        if 'COLLSCAN' in stages:
+            failures.append((name, stages))
+    return failures
+
+
+def ensure_indexes_on_startup(settings):
+    try:
+        _, failures = ensure_indexes(
+            timeseries=settings.get('timeseries', False),
+            ttl_seconds=settings.get('telemetry_ttl_days', 0) * 86400 or None
+        )
+    except PyMongoError as e:
+        logger.warning('Could not create MongoDB indexes: %s', e)
+        return
+    for name, error in failures:
+        logger.warning('Could not create MongoDB index %s: %s', name, error)
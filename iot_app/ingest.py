@@ -0,0 +1,470 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from bson import ObjectId
+from django.conf import settings
+from django.utils import timezone
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+from .models import (
+    Anomaly, Telemetry, TelemetryRollup, RollupWatermark, Device, DailyLog, RelayEvent, RelayRuntime, rollups_enabled
+)
+from .events import publish_readings
+from . import rules
+from .cache import get_history_cache
+from .anomaly import get_detector
+from .instrumentation import metrics, timed
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 1000
+
+DEFAULTS = {
+    'mode': 'sync',
+    'queue_size': 10000,
+    'flush_size': 500,
+    'flush_interval': 1.0,
+    # A batch that fails to write is retried this many times, waiting
+    # retry_backoff seconds and doubling up to retry_backoff_max, then dropped
+    'retry_limit': 5,
+    'retry_backoff': 0.5,
+    'retry_backoff_max': 30.0,
+    # 'partitioned' mode, see partition.py
+    'workers': 4,
+    'partition_address': ('127.0.0.1', 9200),
+    'partition_replicas': 128,
+    'authkey': None,
+    # Seconds a web process or ingest_listener waits on a worker (connect,
+    # reply, or another request to it) before counting it as unreachable
+    'partition_timeout': 5.0,
+}
+
+
+def to_local(timestamp, default):
+    # Stored timestamps are naive local time, same as datetime.now()
+    if timestamp is None:
+        return default
+    if timezone.is_aware(timestamp):
+        return timestamp.astimezone().replace(tzinfo=None)
+    return timestamp
+
+
+def build_documents(readings):
+    now = datetime.now()
+    return [
+        {
+            'device_id': r['device_id'],
+            'temperature': r['temperature'],
+            'humidity': r['humidity'],
+            'timestamp': to_local(r.get('timestamp'), now)
+        }
+        for r in readings
+    ]
+
+
+def screen(docs):
+    # (docs to store, anomaly events); everything passes with screening off
+    detector = get_detector()
+    if detector is None or not docs:
+        return docs, []
+    with timed('anomaly'):
+        docs, events = detector.screen(docs)
+    for event in events:
+        metrics.inc('iot_anomalies_total', (('kind', event['kind']), ('action', event['action'])))
+    return docs, events
+
+
+def group_by_device(docs):
+    by_device = defaultdict(list)
+    for doc in docs:
+        by_device[doc['device_id']].append(doc)
+    return by_device
+
+
+def plan_updates(by_device, devices):
+    # Device, daily log and relay event writes for a batch, without touching
+    # the database
+    device_updates = {}
+    latest = {}
+    daily_updates = []
+    relay_changes = []
+    for device_id, device_docs in by_device.items():
+        device = devices[device_id]
+        device_docs.sort(key=lambda d: d['timestamp'])
+        latest[device_id] = device_docs[-1]
+
+        # Rules see the readings in order, as if posted one by one; only the
+        # outcome is written, once
+        relay_state, changed_at, transitions = rules.evaluate(device, device_docs)
+        if transitions:
+            device_updates[device_id] = {'relay_state': relay_state, 'relay_changed_at': changed_at}
+            relay_changes.append((device_id, device['relay_state'], device.get('relay_changed_at'), transitions))
+
+        days = defaultdict(list)
+        for doc in device_docs:
+            days[doc['timestamp'].replace(hour=0, minute=0, second=0, microsecond=0)].append(doc)
+        for date, day_docs in days.items():
+            daily_updates.append((device_id, date, day_docs))
+    return device_updates, latest, daily_updates, relay_changes
+
+
+def late_devices(history, docs):
+    # Checked after the writes, so a bucket cached before this point can
+    # only be missing readings that are late by this definition
+    cutoff = datetime.now() - history.grace
+    return {doc['device_id'] for doc in docs if doc['timestamp'] < cutoff}
+
+
+def ingested(docs, by_device):
+    history = get_history_cache()
+    if history is not None:
+        history.touch(by_device, late_devices(history, docs))
+    publish_readings(docs)
+
+
+async def aingested(docs, by_device):
+    history = get_history_cache()
+    if history is not None:
+        await history.atouch(by_device, late_devices(history, docs))
+    publish_readings(docs)
+
+
+class IngestBatch:
+    """
+    The writes of ingest_readings as steps that can be retried.
+
+    Readings are screened and given their _id once. write() resumes at the
+    step that failed last time, and a bulk write that failed in part keeps
+    only its failed operations, so a retry doesn't insert readings again,
+    repeat daily log and rollup $incs, or feed the anomaly detector and the
+    rules the same readings twice. A connection lost in the middle of a
+    bulk update can still leave that one step applied in part.
+    """
+
+    def __init__(self, readings):
+        self.docs, self.anomalies = screen(build_documents(readings))
+        for doc in [*self.docs, *self.anomalies]:
+            doc['_id'] = ObjectId()
+        self.by_device = group_by_device(self.docs)
+        self._inserts = {'anomalies': self.anomalies, 'telemetry': self.docs}
+        self._uncertain = set()
+        self._ops = {}
+        self._steps = [lambda: self._insert('anomalies', Anomaly)]
+        if self.docs:
+            self._steps += [lambda: self._insert('telemetry', Telemetry), self._plan]
+
+    def write(self):
+        while self._steps:
+            self._steps[0]()
+            self._steps.pop(0)
+        return self.docs
+
+    def _insert(self, name, model):
+        docs = self._inserts[name]
+        if name in self._uncertain:
+            # The last attempt failed without saying what it stored
+            ids = [doc['_id'] for doc in docs]
+            stored = {doc['_id'] for doc in model.collection.find({'_id': {'$in': ids}}, {'_id': 1})}
+            docs = [doc for doc in docs if doc['_id'] not in stored]
+        try:
+            if docs:
+                model.insert_many(docs)
+        except BulkWriteError as e:
+            # A duplicate _id was stored by an earlier attempt
+            failed = sorted(error['index'] for error in e.details['writeErrors'] if error['code'] != 11000)
+            self._inserts[name] = [docs[index] for index in failed]
+            self._uncertain.discard(name)
+            if failed:
+                raise
+        except Exception:
+            self._inserts[name] = docs
+            self._uncertain.add(name)
+            raise
+        self._inserts[name] = []
+
+    def _bulk(self, name, collection, ordered=False):
+        ops = self._ops[name]
+        try:
+            if ops:
+                collection.bulk_write(ops, ordered=ordered)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            retry = [
+                error['index'] for error in errors
+                if not (error['code'] == 11000 and isinstance(ops[error['index']], InsertOne))
+            ]
+            if ordered:
+                # Everything before the first error went through
+                first = errors[0]['index']
+                self._ops[name] = ops[first if first in retry else first + 1:]
+            else:
+                self._ops[name] = [ops[index] for index in retry]
+            raise
+        self._ops[name] = []
+
+    def _plan(self):
+        # Rules run here, once; only their outcome is retried
+        devices = Device.get_or_create_many(list(self.by_device))
+        device_updates, latest, daily_updates, relay_changes = plan_updates(self.by_device, devices)
+        relay_ops, runtime_ops = RelayEvent.prepare(relay_changes)
+        self._ops = {
+            'devices': Device.update_ops(device_updates) + Device.latest_ops(latest),
+            'daily': DailyLog.add_readings_ops(daily_updates),
+            # Ordered, so closing a run can't match the one opened after it
+            'relays': relay_ops,
+            'runtime': runtime_ops,
+        }
+        steps = [
+            lambda: self._bulk('devices', Device.collection),
+            lambda: Device.updated_many(device_updates, latest),
+            lambda: self._bulk('daily', DailyLog.collection),
+            lambda: self._bulk('relays', RelayEvent.collection, ordered=True),
+            lambda: self._bulk('runtime', RelayRuntime.collection),
+        ]
+        if rollups_enabled():
+            steps.append(RollupWatermark.ensure)
+            for tier in TelemetryRollup.tiers():
+                self._ops[tier.__name__] = tier.readings_ops(self.docs)
+                steps.append(lambda tier=tier: self._bulk(tier.__name__, tier.collection))
+        else:
+            steps.append(RollupWatermark.drop)
+        steps.append(lambda: ingested(self.docs, self.by_device))
+        self._steps[1:1] = steps
+
+
+def ingest_readings(readings):
+    return IngestBatch(readings).write()
+
+
+async def aingest_readings(readings):
+    # Same writes as ingest_readings, with independent ones in flight together
+    docs, anomalies = screen(build_documents(readings))
+    if not docs:
+        if anomalies:
+            await Anomaly.ainsert_many(anomalies)
+        return docs
+    by_device = group_by_device(docs)
+    first = [Telemetry.ainsert_many(docs), Device.aget_or_create_many(list(by_device))]
+    if anomalies:
+        first.append(Anomaly.ainsert_many(anomalies))
+    _, devices, *_ = await asyncio.gather(*first)
+    device_updates, latest, daily_updates, relay_changes = plan_updates(by_device, devices)
+
+    writes = [
+        Device.aupdate_many(device_updates, latest),
+        DailyLog.aadd_readings_many(daily_updates),
+        RelayEvent.arecord_many(relay_changes),
+    ]
+    if rollups_enabled():
+        await RollupWatermark.aensure()
+        writes.append(TelemetryRollup.aadd_readings_all_tiers(docs))
+    else:
+        writes.append(RollupWatermark.adrop())
+    await asyncio.gather(*writes)
+    await aingested(docs, by_device)
+    return docs
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'IOT_INGEST', {})}
+
+
+class IngestQueue:
+    """
+    Bounded in-process buffer drained by a background writer thread.
+
+    Readings are written with ingest_readings in groups of up to flush_size,
+    or whatever has accumulated after flush_interval seconds.
+
+    A 202 only means the reading is in memory. A batch whose write fails is
+    retried with exponential backoff while the queue keeps filling (and then
+    rejects with 429); after retry_limit failed retries it is dropped and
+    counted in 'dropped'. Readings still queued when the process dies are
+    lost. Devices that need durability should use 'sync' mode.
+    """
+
+    def __init__(self, max_size=10000, flush_size=500, flush_interval=1.0,
+                 retry_limit=5, retry_backoff=0.5, retry_backoff_max=30.0):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.retry_limit = retry_limit
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'written': 0,
+            'failed': 0,
+            'retries': 0,
+            'dropped': 0,
+            'flushes': 0,
+            'flush_seconds_total': 0.0,
+            'flush_seconds_max': 0.0,
+            'last_flush_seconds': 0.0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+                self._thread.start()
+        return self
+
+    def put_many(self, readings):
+        now = datetime.now()
+        readings = [{**r, 'timestamp': r.get('timestamp') or now} for r in readings]
+        with self._cond:
+            if self._stopping or len(self._pending) + len(readings) > self.max_size:
+                self._stats['rejected'] += len(readings)
+                return False
+            self._pending.extend(readings)
+            self._stats['accepted'] += len(readings)
+            if len(self._pending) >= self.flush_size:
+                self._cond.notify()
+        return True
+
+    def put(self, reading):
+        return self.put_many([reading])
+
+    def put_batch(self, readings):
+        # Indexes of the readings that were not queued; all or none here
+        return [] if self.put_many(readings) else list(range(len(readings)))
+
+    # Async views and ingest_listener use these; process memory, so nothing
+    # to wait for
+
+    async def aput_many(self, readings):
+        return self.put_many(readings)
+
+    async def aput(self, reading):
+        return self.put(reading)
+
+    async def aput_batch(self, readings):
+        return self.put_batch(readings)
+
+    def _take_batch(self):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: len(self._pending) >= self.flush_size or self._stopping,
+                timeout=self.flush_interval
+            )
+            count = min(len(self._pending), self.flush_size)
+            return [self._pending.popleft() for _ in range(count)]
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._flush(batch)
+            elif self._stopping:
+                return
+
+    def _write(self, batch):
+        # True once written; failed attempts are retried with backoff from
+        # the step that failed
+        try:
+            writes = IngestBatch(batch)
+        except Exception:
+            logger.exception('Dropping %d queued readings that could not be screened', len(batch))
+            with self._cond:
+                self._stats['failed'] += len(batch)
+            return False
+        delay = self.retry_backoff
+        for attempt in range(self.retry_limit + 1):
+            try:
+                writes.write()
+                return True
+            except Exception:
+                with self._cond:
+                    self._stats['failed'] += len(batch)
+                if attempt == self.retry_limit:
+                    logger.exception('Dropping %d queued readings after %d retries', len(batch), attempt)
+                    return False
+                logger.warning('Failed to write %d queued readings, retrying in %.1fs',
+                               len(batch), delay, exc_info=True)
+            with self._cond:
+                self._stats['retries'] += 1
+            time.sleep(delay)
+            delay = min(delay * 2, self.retry_backoff_max)
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        written = self._write(batch)
+        elapsed = time.perf_counter() - started
+        with self._cond:
+            stats = self._stats
+            if written:
+                stats['written'] += len(batch)
+            else:
+                stats['dropped'] += len(batch)
+            stats['flushes'] += 1
+            stats['flush_seconds_total'] += elapsed
+            stats['flush_seconds_max'] = max(stats['flush_seconds_max'], elapsed)
+            stats['last_flush_seconds'] = elapsed
+
+    def stop(self, timeout=10):
+        # Refuse new readings and drain what is already queued
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            self._thread = None
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._pending),
+                'capacity': self.max_size,
+                'flush_size': self.flush_size,
+                'flush_interval': self.flush_interval,
+                **self._stats,
+            }
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def ingest_mode():
+    return get_settings()['mode']
+
+
+def queue_enabled():
+    # Readings are handed off and written later, in this process or by the
+    # partitioned ingest workers
+    return ingest_mode() in ('queue', 'partitioned')
+
+
+def get_ingest_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                config = get_settings()
+                if config['mode'] == 'partitioned':
+                    from .partition import PartitionClient
+                    _queue = PartitionClient(config)
+                else:
+                    _queue = IngestQueue(
+                        max_size=config['queue_size'],
+                        flush_size=config['flush_size'],
+                        flush_interval=config['flush_interval'],
+                        retry_limit=config['retry_limit'],
+                        retry_backoff=config['retry_backoff'],
+                        retry_backoff_max=config['retry_backoff_max']
+                    ).start()
+                atexit.register(_queue.stop)
+    return _queue
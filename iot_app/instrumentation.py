@@ -0,0 +1,269 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+
+slow_query_logger = logging.getLogger('iot_app.slow_queries')
+
+DEFAULTS = {
+    'enabled': True,
+    'slow_query_ms': 100,
+    'server_timing': True,
+}
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'IOT_INSTRUMENTATION', {})}
+
+
+class Metrics:
+    # Minimal Prometheus-style registry: counters and histograms with labels
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self, gauges=()):
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._help:
+                kind, text = self._help[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+                described.add(name)
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, {**h, 'counts': list(h['counts'])}) for key, h in histograms]
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram['count']}")
+        for name, kind, text, value in gauges:
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('iot_http_requests_total', 'counter', 'HTTP requests by route, method and status')
+metrics.describe('iot_http_request_duration_seconds', 'histogram', 'HTTP request latency by route')
+metrics.describe('iot_http_request_mongo_operations', 'histogram', 'MongoDB operations per HTTP request')
+metrics.describe('iot_mongo_operations_total', 'counter', 'MongoDB operations by collection and operation')
+metrics.describe('iot_mongo_operation_duration_seconds', 'histogram', 'MongoDB operation latency')
+metrics.describe('iot_mongo_documents_returned_total', 'counter', 'Documents returned by MongoDB reads')
+metrics.describe('iot_mongo_slow_operations_total', 'counter', 'MongoDB operations over the slow query threshold')
+metrics.describe('iot_anomalies_total', 'counter', 'Readings flagged or quarantined by ingest screening')
+
+
+class RequestStats:
+    __slots__ = ('db_ops', 'db_docs', 'db_seconds', 'phases')
+
+    def __init__(self):
+        self.db_ops = 0
+        self.db_docs = 0
+        self.db_seconds = 0.0
+        self.phases = {}
+
+
+_request_stats = contextvars.ContextVar('iot_request_stats', default=None)
+
+
+def start_request():
+    stats = RequestStats()
+    return stats, _request_stats.set(stats)
+
+
+def end_request(token):
+    _request_stats.reset(token)
+
+
+@contextmanager
+def timed(phase):
+    # Attribute a block of application time to a named Server-Timing phase
+    stats = _request_stats.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.phases[phase] = stats.phases.get(phase, 0.0) + time.perf_counter() - started
+
+
+def query_shape(value):
+    # Keeps the structure of a filter/pipeline and hides the values
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and isinstance(value[0], (dict, list, tuple)):
+            return [query_shape(v) for v in value]
+        return ['?']
+    return '?'
+
+
+def record_operation(collection, operation, seconds, docs=0, spec=None):
+    labels = (('collection', collection), ('operation', operation))
+    metrics.inc('iot_mongo_operations_total', labels)
+    metrics.observe('iot_mongo_operation_duration_seconds', seconds, labels)
+    if docs:
+        metrics.inc('iot_mongo_documents_returned_total', (('collection', collection),), docs)
+
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.db_ops += 1
+        stats.db_docs += docs
+        stats.db_seconds += seconds
+
+    threshold = get_settings()['slow_query_ms']
+    if threshold is not None and seconds * 1000 >= threshold:
+        metrics.inc('iot_mongo_slow_operations_total', labels)
+        slow_query_logger.warning(
+            'Slow MongoDB %s on %s: %.1fms, %d docs, shape=%s',
+            operation, collection, seconds * 1000, docs, spec if isinstance(spec, str) else query_shape(spec)
+        )
+
+
+class InstrumentedCursor:
+    # Times the round trips made while iterating and counts documents;
+    # recorded as one operation when the cursor is exhausted or closed
+
+    CHAINABLE = {'sort', 'skip', 'limit', 'batch_size', 'hint', 'max_time_ms', 'comment', 'allow_disk_use'}
+
+    def __init__(self, cursor, collection, operation, spec):
+        self._cursor = cursor
+        self._collection = collection
+        self._operation = operation
+        self._spec = spec
+        self._seconds = 0.0
+        self._docs = 0
+        self._done = False
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name in self.CHAINABLE:
+            def chained(*args, **kwargs):
+                attr(*args, **kwargs)
+                return self
+            return chained
+        return attr
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            doc = next(self._cursor)
+        except StopIteration:
+            self._seconds += time.perf_counter() - started
+            self._finish()
+            raise
+        self._seconds += time.perf_counter() - started
+        self._docs += 1
+        return doc
+
+    next = __next__
+
+    def _finish(self):
+        if not self._done:
+            self._done = True
+            record_operation(self._collection, self._operation, self._seconds, self._docs, self._spec)
+
+    def close(self):
+        self._finish()
+        close = getattr(self._cursor, 'close', None)
+        if close is not None:
+            close()
+
+
+class InstrumentedCollection:
+    CURSOR_METHODS = {'find', 'aggregate'}
+    READ_METHODS = {'find_one', 'find_one_and_update'}
+    WRITE_METHODS = {
+        'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one',
+        'delete_one', 'delete_many', 'bulk_write', 'count_documents', 'distinct',
+    }
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.name = collection.name
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in self.CURSOR_METHODS:
+            def cursor_method(*args, **kwargs):
+                spec = args[0] if args else kwargs.get('filter', kwargs.get('pipeline'))
+                started = time.perf_counter()
+                cursor = InstrumentedCursor(attr(*args, **kwargs), self.name, name, spec)
+                # aggregate runs the pipeline before returning the cursor
+                cursor._seconds = time.perf_counter() - started
+                return cursor
+            return cursor_method
+        if name in self.READ_METHODS or name in self.WRITE_METHODS:
+            def method(*args, **kwargs):
+                started = time.perf_counter()
+                result = attr(*args, **kwargs)
+                seconds = time.perf_counter() - started
+                if name == 'bulk_write':
+                    spec = f'{len(args[0]) if args else 0} ops'
+                else:
+                    spec = args[0] if args and name not in ('insert_one', 'insert_many') else None
+                docs = 1 if name in self.READ_METHODS and result is not None else 0
+                record_operation(self.name, name, seconds, docs, spec)
+                return result
+            return method
+        return attr
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from iot_app.aggregation import parse_duration
+from iot_app.models import Telemetry, TelemetryArchive
+
+
+class Command(BaseCommand):
+    help = 'Pack closed days of raw telemetry into compressed per-device archive blocks'
+
+    def add_arguments(self, parser):
+        config = getattr(settings, 'IOT_ARCHIVE', {})
+        parser.add_argument('--older-than', default=f"{config.get('after_days', 30)}d",
+                            help='Archive whole days before now minus this, e.g. 30d (default: IOT_ARCHIVE after_days)')
+        parser.add_argument('--decimals', type=int, default=config.get('decimals', 2),
+                            help='Decimal places kept for temperature and humidity')
+
+    def handle(self, *args, **options):
+        try:
+            older_than = parse_duration(options['older_than'])
+        except ValueError as e:
+            raise CommandError(e)
+        if not 0 <= options['decimals'] <= 6:
+            raise CommandError('--decimals must be between 0 and 6')
+
+        TelemetryArchive.finish_pending()
+        cutoff = (datetime.now() - older_than).replace(hour=0, minute=0, second=0, microsecond=0)
+        oldest = Telemetry.collection.find_one({'timestamp': {'$lt': cutoff}}, sort=[('timestamp', 1)])
+        if oldest is None:
+            self.stdout.write('Nothing to archive')
+            return
+
+        day = oldest['timestamp'].replace(hour=0, minute=0, second=0, microsecond=0)
+        total = 0
+        while day < cutoff:
+            devices, readings = TelemetryArchive.archive_day(day, options['decimals'])
+            if readings:
+                self.stdout.write(f'  {day.date()}: {readings} readings from {devices} devices')
+            total += readings
+            day += timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f'Archived {total} readings'))
@@ -0,0 +1,247 @@
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib import request as urlrequest
+from urllib.error import HTTPError
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+
+SCENARIOS = ('ingest', 'command', 'telemetry_1h', 'telemetry_24h', 'telemetry_7d', 'daily_logs')
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1]) if latencies else None,
+    }
+
+
+class InProcessTransport:
+    # Goes through the full Django stack without sockets
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = Client()
+        return self.local.client
+
+    def get(self, path):
+        return self.client().get(path).status_code
+
+    def post(self, path, payload):
+        return self.client().post(path, json.dumps(payload), content_type='application/json').status_code
+
+
+class HttpTransport:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def _send(self, req):
+        try:
+            with urlrequest.urlopen(req, timeout=30) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+    def get(self, path):
+        return self._send(urlrequest.Request(self.base_url + path))
+
+    def post(self, path, payload):
+        return self._send(urlrequest.Request(
+            self.base_url + path,
+            data=json.dumps(payload).encode(),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        ))
+
+
+class Command(BaseCommand):
+    help = ('Simulate a fleet of devices posting telemetry and polling commands, '
+            'then report throughput and latency percentiles per endpoint as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=50, help='Virtual devices (default: 50)')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per scenario (default: 10)')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients (default: 8)')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Target requests/sec per scenario, 0 for as fast as possible')
+        parser.add_argument('--seed-days', type=float, default=1,
+                            help='Days of 15s history to preload per device before measuring (default: 1)')
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f"Comma separated subset of {', '.join(SCENARIOS)}")
+        parser.add_argument('--url', default=None,
+                            help='Benchmark a running server over HTTP instead of in-process')
+        parser.add_argument('--backend', choices=('mongo', 'memory'), default=None,
+                            help='Storage backend for in-process runs (default: settings)')
+        parser.add_argument('--anomaly', choices=('on', 'off'), default=None,
+                            help='Ingest anomaly screening for in-process runs (default: settings); '
+                                 'compare an off and an on report to see its cost')
+        parser.add_argument('--output', default=None, help='Write the JSON report to this file')
+        parser.add_argument('--compare', default=None,
+                            help='Earlier JSON report to print throughput/p95 changes against')
+
+    def handle(self, *args, **options):
+        scenarios = [s for s in options['scenarios'].split(',') if s]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+        if options['url']:
+            transport = HttpTransport(options['url'])
+        else:
+            if options['backend']:
+                from iot_app import storage
+                os.environ['IOT_STORAGE_BACKEND'] = options['backend']
+                storage.reset()
+            if options['anomaly']:
+                override_settings(IOT_ANOMALY={
+                    **getattr(settings, 'IOT_ANOMALY', {}), 'enabled': options['anomaly'] == 'on'
+                }).enable()
+            transport = InProcessTransport()
+
+        self.device_ids = [f'bench-{i:05d}' for i in range(options['devices'])]
+        if options['seed_days']:
+            self.seed(transport, options['seed_days'])
+
+        results = {}
+        for scenario in scenarios:
+            self.stdout.write(f'Running {scenario}...')
+            results[scenario] = self.run_scenario(transport, scenario, options)
+            self.stdout.write(f"  {json.dumps(results[scenario])}")
+
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'commit': self.git_commit(),
+            'target': options['url'] or f"in-process ({os.environ.get('IOT_STORAGE_BACKEND', 'settings')})",
+            'config': {k: options[k] for k in ('devices', 'duration', 'concurrency', 'rate', 'seed_days', 'anomaly')},
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), report)
+
+    def compare(self, baseline, report):
+        self.stdout.write(f"Compared with {baseline.get('commit') or baseline.get('timestamp')}:")
+        for scenario, result in report['results'].items():
+            before = baseline.get('results', {}).get(scenario)
+            if not before:
+                continue
+            changes = []
+            for key in ('throughput_rps', 'p95_ms'):
+                if before.get(key) and result.get(key) is not None:
+                    changes.append(f'{key} {before[key]} -> {result[key]} ({(result[key] / before[key] - 1) * 100:+.1f}%)')
+            self.stdout.write(f"  {scenario}: {', '.join(changes)}")
+
+    def seed(self, transport, days):
+        # Posted through the batch endpoint with device timestamps
+        now = datetime.now()
+        per_device = int(days * 86400 / 15)
+        self.stdout.write(f'Seeding {per_device} readings for each of {len(self.device_ids)} devices...')
+        batch = []
+        for device_id in self.device_ids:
+            for i in range(per_device):
+                batch.append(self.reading(device_id, now - timedelta(seconds=15 * i)))
+                if len(batch) == 1000:
+                    transport.post('/api/telemetry/batch/', batch)
+                    batch = []
+        if batch:
+            transport.post('/api/telemetry/batch/', batch)
+
+    def reading(self, device_id, timestamp=None):
+        reading = {
+            'device_id': device_id,
+            # Plausible sensor noise, so anomaly screening lets it through
+            'temperature': round(random.gauss(25, 0.5), 2),
+            'humidity': round(random.gauss(50, 2), 2),
+        }
+        if timestamp is not None:
+            reading['timestamp'] = timestamp.isoformat()
+        return reading
+
+    def request(self, transport, scenario):
+        device_id = random.choice(self.device_ids)
+        if scenario == 'ingest':
+            return transport.post('/api/telemetry/', self.reading(device_id))
+        if scenario == 'command':
+            return transport.get(f'/api/devices/{device_id}/command/')
+        if scenario == 'daily_logs':
+            return transport.get(f'/api/daily-logs/?days=7&device_id={device_id}')
+        timespan = scenario.split('_', 1)[1]
+        return transport.get(f'/api/telemetry/?timespan={timespan}&device_id={device_id}')
+
+    def run_scenario(self, transport, scenario, options):
+        latencies, errors = [], 0
+        lock = threading.Lock()
+        deadline = time.perf_counter() + options['duration']
+        interval = options['concurrency'] / options['rate'] if options['rate'] else 0
+
+        def worker():
+            nonlocal errors
+            next_at = time.perf_counter()
+            while True:
+                now = time.perf_counter()
+                if now >= deadline:
+                    return
+                if interval and now < next_at:
+                    time.sleep(next_at - now)
+                started = time.perf_counter()
+                try:
+                    code = self.request(transport, scenario)
+                except Exception:
+                    code = None
+                elapsed = time.perf_counter() - started
+                with lock:
+                    if code is not None and code < 400:
+                        latencies.append(elapsed)
+                    else:
+                        errors += 1
+                next_at += interval
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            for _ in range(options['concurrency']):
+                pool.submit(worker)
+        return summarize(latencies, errors, time.perf_counter() - started)
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, text=True, timeout=5
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from iot_app.indexes import ensure_indexes, check_query_plans
+
+
+class Command(BaseCommand):
+    help = 'Create MongoDB indexes for the IoT collections and verify hot queries use them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeseries', action='store_true',
+                            help='Create telemetry as a time-series collection if it does not exist yet')
+        parser.add_argument('--ttl-days', type=int, default=0,
+                            help='Expire raw telemetry after this many days')
+        parser.add_argument('--check', action='store_true',
+                            help='Fail if any hot query falls back to a collection scan')
+
+    def handle(self, *args, **options):
+        ttl_seconds = options['ttl_days'] * 86400 or None
+        created, failures = ensure_indexes(timeseries=options['timeseries'], ttl_seconds=ttl_seconds)
+        for name in created:
+            self.stdout.write(f'  {name}')
+        for name, error in failures:
+            self.stderr.write(f'  {name}: {error}')
+        if not failures:
+            self.stdout.write(self.style.SUCCESS('Indexes are in place'))
+
+        errors = []
+        if failures:
+            errors.append(f'{len(failures)} indexes could not be created')
+        if options['check']:
+            slow = check_query_plans()
+            for name, stages in slow:
+                self.stderr.write(f"  {name}: {' -> '.join(stages)}")
+            if slow:
+                errors.append(f'{len(slow)} hot queries use COLLSCAN')
+            else:
+                self.stdout.write(self.style.SUCCESS('All hot queries use an index'))
+        if errors:
+            raise CommandError('; '.join(errors))
@@ -0,0 +1,125 @@
+import asyncio
+from django.core.management.base import BaseCommand, CommandError
+from iot_app.cache import process_local_caches
+from iot_app.ingest import get_ingest_queue, ingest_mode
+from iot_app.wire import ACK_BUSY, ACK_INVALID, ACK_OK, LENGTH, FrameError, decode_frame, encode_ack
+
+
+def check_caches(command, options, writer):
+    # Shared with ingest_workers: both write readings the web processes serve
+    local = process_local_caches()
+    if local and not options['allow_local_cache']:
+        raise CommandError(
+            f"Readings are written by {writer}, whose {' and '.join(local)} are process-local. "
+            "Set IOT_REDIS_URL and IOT_DEVICE_CACHE['shared'], or pass --allow-local-cache."
+        )
+    for cache in local:
+        command.stderr.write(command.style.WARNING(f'WARNING: web processes do not see updates to the {cache}'))
+    command.stderr.write(command.style.WARNING(
+        f'WARNING: readings ingested by {writer} do not reach SSE streams in the web processes; '
+        'command long-polls see relay changes on their next recheck'
+    ))
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagram_received(self, data, addr):
+        # No acknowledgement over UDP; dropped frames show up in the stats
+        self.listener.accept_later(data)
+
+
+class Listener:
+    def __init__(self):
+        self.queue = get_ingest_queue()
+        self.stats = {'frames': 0, 'readings': 0, 'invalid': 0, 'rejected': 0, 'connections': 0}
+        self._pending = set()
+
+    def accept_later(self, frame):
+        # Datagram callbacks can't await; hold a reference until it is done
+        task = asyncio.ensure_future(self.accept(frame))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def accept(self, frame):
+        try:
+            readings = decode_frame(frame)
+        except FrameError:
+            self.stats['invalid'] += 1
+            return ACK_INVALID, 0
+        # Straight into the batched writer, no per-reading validation layer.
+        # A frame holds one device, so even partitioned it is queued or
+        # rejected as a whole and the device can resend it.
+        if not await self.queue.aput_many(readings):
+            self.stats['rejected'] += 1
+            return ACK_BUSY, 0
+        self.stats['frames'] += 1
+        self.stats['readings'] += len(readings)
+        return ACK_OK, len(readings)
+
+    async def handle_tcp(self, reader, writer):
+        # Devices keep the connection open and send length-prefixed frames
+        self.stats['connections'] += 1
+        try:
+            while True:
+                (length,) = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+                status, accepted = await self.accept(await reader.readexactly(length))
+                writer.write(encode_ack(status, accepted))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.stats['connections'] -= 1
+            writer.close()
+
+
+class Command(BaseCommand):
+    help = ('Accept binary telemetry frames (iot_app.wire) over UDP and TCP and '
+            'feed them to the batched ingest queue')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1',
+                            help='Address to listen on; 0.0.0.0 for devices on the network (default: 127.0.0.1)')
+        parser.add_argument('--udp-port', type=int, default=9100, help='0 to disable (default: 9100)')
+        parser.add_argument('--tcp-port', type=int, default=9101, help='0 to disable (default: 9101)')
+        parser.add_argument('--stats-interval', type=float, default=60,
+                            help='Seconds between stats lines, 0 to disable (default: 60)')
+        parser.add_argument('--allow-local-cache', action='store_true',
+                            help='Start even if the web processes cannot see the cache updates of this one')
+
+    def handle(self, *args, **options):
+        # Partitioned: the ingest workers write, and ingest_workers checks
+        if ingest_mode() != 'partitioned':
+            check_caches(self, options, 'this process')
+        try:
+            asyncio.run(self.serve(options))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Flush whatever is still queued before exiting
+            get_ingest_queue().stop()
+
+    async def serve(self, options):
+        listener = Listener()
+        loop = asyncio.get_running_loop()
+        servers = []
+        if options['udp_port']:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: UdpProtocol(listener), local_addr=(options['host'], options['udp_port'])
+            )
+            servers.append(transport)
+            self.stdout.write(f"UDP on {options['host']}:{options['udp_port']}")
+        if options['tcp_port']:
+            server = await asyncio.start_server(listener.handle_tcp, options['host'], options['tcp_port'])
+            servers.append(server)
+            self.stdout.write(f"TCP on {options['host']}:{options['tcp_port']}")
+
+        try:
+            while True:
+                await asyncio.sleep(options['stats_interval'] or 3600)
+                if options['stats_interval']:
+                    self.stdout.write(f"{listener.stats} queue={listener.queue.stats()['depth']}")
+        finally:
+            for server in servers:
+                server.close()
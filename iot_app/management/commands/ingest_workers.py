@@ -0,0 +1,71 @@
+import multiprocessing
+import signal
+import time
+from django.core.management.base import BaseCommand, CommandError
+from iot_app.ingest import get_settings
+from iot_app.partition import EXIT_ADDRESS_IN_USE, run_worker, worker_address
+from .ingest_listener import check_caches
+
+
+class Command(BaseCommand):
+    help = ("Run the partitioned ingest workers (IOT_INGEST mode 'partitioned'): "
+            'one process per partition, each writing the readings of the devices it owns')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Worker processes (default: IOT_INGEST workers); web processes must '
+                                 'agree, so change the setting rather than only this flag')
+        parser.add_argument('--restart-delay', type=float, default=1,
+                            help='Seconds before restarting a worker that died (default: 1)')
+        parser.add_argument('--allow-local-cache', action='store_true',
+                            help='Start even if the web processes cannot see the cache updates of the workers')
+
+    def handle(self, *args, **options):
+        config = get_settings()
+        if options['workers'] is not None:
+            config['workers'] = options['workers']
+        if config['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        check_caches(self, options, 'the ingest workers')
+
+        # Spawned rather than forked: the parent may already hold database
+        # clients and their background threads
+        context = multiprocessing.get_context('spawn')
+        stopping = False
+
+        def start(index):
+            process = context.Process(target=run_worker, args=(index, config), name=f'ingest-worker-{index}')
+            process.start()
+            host, port = worker_address(config, index)
+            self.stdout.write(f'Worker {index} (pid {process.pid}) on {host}:{port}')
+            return process
+
+        def stop(*args):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        processes = {index: start(index) for index in range(config['workers'])}
+        failed = None
+        while not stopping:
+            time.sleep(options['restart_delay'])
+            for index, process in processes.items():
+                if process.is_alive() or stopping:
+                    continue
+                if process.exitcode == EXIT_ADDRESS_IN_USE:
+                    failed = f'Worker {index} could not bind {":".join(map(str, worker_address(config, index)))}'
+                    stopping = True
+                    break
+                self.stderr.write(f'Worker {index} exited with {process.exitcode}, restarting')
+                processes[index] = start(index)
+
+        # Each worker drains its queue before exiting
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            process.join()
+        if failed:
+            raise CommandError(failed)
+        self.stdout.write(self.style.SUCCESS('Ingest workers stopped'))
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import random
+import time
+from datetime import datetime
+from urllib import request as urlrequest
+from urllib.error import URLError
+from django.core.management.base import BaseCommand
+from iot_app.wire import ACK, ACK_OK, LENGTH, decode_ack, encode_frame
+
+DEFAULT_PORTS = {'udp': 9100, 'tcp': 9101, 'http': 8000}
+
+
+class SimulatedDevice:
+    # DHT22-like readings drifting around a set point
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.temperature = random.uniform(20, 30)
+        self.humidity = random.uniform(35, 65)
+
+    def read(self):
+        self.temperature = min(max(self.temperature + random.gauss(0, 0.2), -40), 80)
+        self.humidity = min(max(self.humidity + random.gauss(0, 0.5), 0), 100)
+        return datetime.now(), round(self.temperature, 2), round(self.humidity, 2)
+
+
+class Command(BaseCommand):
+    help = ('Simulate devices sending telemetry over the binary UDP/TCP protocol '
+            '(see ingest_listener) or the JSON HTTP API, for testing without hardware')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=10)
+        parser.add_argument('--interval', type=float, default=15, help='Seconds between readings per device')
+        parser.add_argument('--batch', type=int, default=1, help='Readings buffered per frame/request')
+        parser.add_argument('--transport', choices=('udp', 'tcp', 'http'), default='udp')
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=None,
+                            help='Default: 9100 for udp, 9101 for tcp, 8000 for http')
+        parser.add_argument('--duration', type=float, default=0, help='Seconds to run, 0 for until interrupted')
+        parser.add_argument('--prefix', default='sim-', help='Device id prefix')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.port = options['port'] or DEFAULT_PORTS[options['transport']]
+        self.stats = {'readings': 0, 'sent': 0, 'acked': 0, 'errors': 0, 'bytes': 0}
+        started = time.perf_counter()
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.perf_counter() - started
+        self.stdout.write(json.dumps({**self.stats, 'seconds': round(elapsed, 1)}))
+
+    async def run(self):
+        devices = [SimulatedDevice(f"{self.options['prefix']}{i:04d}") for i in range(self.options['devices'])]
+        tasks = [asyncio.create_task(self.device_loop(device)) for device in devices]
+        try:
+            if self.options['duration']:
+                await asyncio.sleep(self.options['duration'])
+            else:
+                await asyncio.Event().wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def device_loop(self, device):
+        send = await self.connect()
+        # Spread devices over the interval like a real fleet
+        await asyncio.sleep(random.uniform(0, self.options['interval']))
+        buffered = []
+        try:
+            while True:
+                buffered.append(device.read())
+                self.stats['readings'] += 1
+                if len(buffered) >= self.options['batch']:
+                    try:
+                        await send(device.device_id, buffered)
+                    except (OSError, URLError, asyncio.IncompleteReadError):
+                        self.stats['errors'] += 1
+                    buffered = []
+                await asyncio.sleep(self.options['interval'])
+        finally:
+            close = getattr(send, 'close', None)
+            if close:
+                close()
+
+    async def connect(self):
+        transport = self.options['transport']
+        loop = asyncio.get_running_loop()
+
+        if transport == 'udp':
+            udp, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=(self.options['host'], self.port)
+            )
+
+            async def send(device_id, readings):
+                frame = encode_frame(device_id, readings)
+                udp.sendto(frame)
+                self.stats['sent'] += 1
+                self.stats['bytes'] += len(frame)
+            send.close = udp.close
+            return send
+
+        if transport == 'tcp':
+            # One persistent connection per device
+            reader, writer = await asyncio.open_connection(self.options['host'], self.port)
+
+            async def send(device_id, readings):
+                frame = encode_frame(device_id, readings)
+                writer.write(LENGTH.pack(len(frame)) + frame)
+                await writer.drain()
+                self.stats['sent'] += 1
+                self.stats['bytes'] += LENGTH.size + len(frame)
+                status, _ = decode_ack(await reader.readexactly(ACK.size))
+                if status == ACK_OK:
+                    self.stats['acked'] += 1
+                else:
+                    self.stats['errors'] += 1
+            send.close = writer.close
+            return send
+
+        base_url = f"http://{self.options['host']}:{self.port}"
+
+        def post(device_id, readings):
+            if len(readings) == 1:
+                path, (timestamp, temperature, humidity) = '/api/telemetry/', readings[0]
+                body = {'device_id': device_id, 'temperature': temperature, 'humidity': humidity}
+            else:
+                path = '/api/telemetry/batch/'
+                body = [
+                    {'device_id': device_id, 'temperature': t, 'humidity': h, 'timestamp': ts.isoformat()}
+                    for ts, t, h in readings
+                ]
+            data = json.dumps(body).encode()
+            req = urlrequest.Request(base_url + path, data=data, headers={'Content-Type': 'application/json'})
+            with urlrequest.urlopen(req, timeout=10) as response:
+                response.read()
+            return len(data)
+
+        async def send(device_id, readings):
+            size = await asyncio.to_thread(post, device_id, readings)
+            self.stats['sent'] += 1
+            self.stats['acked'] += 1
+            self.stats['bytes'] += size
+        return send
@@ -0,0 +1,745 @@
+"""
+In-process stand-in for a MongoDB database.
+
+Implements the subset of the PyMongo collection API the app uses so the
+dashboard, tests and benchmarks can run without a server. Select it with
+MONGODB_SETTINGS['backend'] = 'memory' or IOT_STORAGE_BACKEND=memory.
+"""
+import math
+import threading
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.operations import DeleteMany, DeleteOne, InsertOne, UpdateMany, UpdateOne
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+_MISSING = object()
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _get(doc, path):
+    for part in path.split('.'):
+        if isinstance(doc, dict):
+            doc = doc.get(part, _MISSING)
+        elif isinstance(doc, list) and part.isdigit() and int(part) < len(doc):
+            doc = doc[int(part)]
+        else:
+            return _MISSING
+        if doc is _MISSING:
+            return _MISSING
+    return doc
+
+
+def _set(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+# BSON comparison order, so mixed types sort the way the server sorts them
+def _rank(value):
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def _sort_key(value):
+    rank = _rank(value)
+    if rank == 1:
+        return (rank, 0)
+    if rank in (4, 5):
+        return (rank, repr(value))
+    return (rank, value)
+
+
+def _compare(a, b):
+    ka, kb = _sort_key(a), _sort_key(b)
+    return (ka > kb) - (ka < kb)
+
+
+def _values_equal(value, expected):
+    if isinstance(value, list) and not isinstance(expected, list):
+        return any(_values_equal(v, expected) for v in value)
+    if value is _MISSING:
+        return expected is None
+    return value == expected
+
+
+def _match_operator(value, op, arg):
+    if op == '$eq':
+        return _values_equal(value, arg)
+    if op == '$ne':
+        return not _values_equal(value, arg)
+    if op == '$in':
+        return any(_values_equal(value, a) for a in arg)
+    if op == '$nin':
+        return not any(_values_equal(value, a) for a in arg)
+    if op == '$exists':
+        return (value is not _MISSING) == bool(arg)
+    if op in ('$gt', '$gte', '$lt', '$lte'):
+        if value is _MISSING or _rank(value) != _rank(arg):
+            return False
+        result = _compare(value, arg)
+        return {'$gt': result > 0, '$gte': result >= 0, '$lt': result < 0, '$lte': result <= 0}[op]
+    if op == '$not':
+        return not _match_condition(value, arg)
+    raise OperationFailure(f'Unsupported query operator {op}')
+
+
+def _match_condition(value, condition):
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        return all(_match_operator(value, op, arg) for op, arg in condition.items())
+    return _values_equal(value, condition)
+
+
+def matches(doc, query):
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, q) for q in condition):
+                return False
+        elif not _match_condition(_get(doc, key), condition):
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return _copy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include = {k for k, v in projection.items() if v and k != '_id'}
+    if include:
+        result = {}
+        for path in include:
+            value = _get(doc, path)
+            if value is not _MISSING:
+                _set(result, path, _copy(value))
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    result = _copy(doc)
+    for path, value in projection.items():
+        if not value:
+            _unset(result, path)
+    return result
+
+
+def _sort_docs(docs, spec):
+    for field, direction in reversed(spec):
+        docs.sort(key=lambda d: _sort_key(_get(d, field)), reverse=direction < 0)
+    return docs
+
+
+def _normalize_sort(key, direction=None):
+    if isinstance(key, str):
+        return [(key, direction if direction is not None else 1)]
+    if isinstance(key, dict):
+        return list(key.items())
+    return list(key)
+
+
+def _apply_update(doc, update, inserting=False):
+    if not any(k.startswith('$') for k in update):
+        # Replacement document
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(_copy(update))
+        if _id is not None:
+            doc['_id'] = _id
+        return
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            current = _get(doc, path)
+            if op == '$set':
+                _set(doc, path, _copy(arg))
+            elif op == '$setOnInsert':
+                if inserting:
+                    _set(doc, path, _copy(arg))
+            elif op == '$unset':
+                _unset(doc, path)
+            elif op == '$inc':
+                _set(doc, path, (0 if current is _MISSING else current) + arg)
+            elif op == '$mul':
+                _set(doc, path, (0 if current is _MISSING else current) * arg)
+            elif op == '$min':
+                if current is _MISSING or _compare(arg, current) < 0:
+                    _set(doc, path, arg)
+            elif op == '$max':
+                if current is _MISSING or _compare(arg, current) > 0:
+                    _set(doc, path, arg)
+            elif op == '$push':
+                items = [] if current is _MISSING else current
+                if isinstance(arg, dict) and '$each' in arg:
+                    items.extend(_copy(arg['$each']))
+                    if '$slice' in arg:
+                        items[:] = items[arg['$slice']:] if arg['$slice'] < 0 else items[:arg['$slice']]
+                else:
+                    items.append(_copy(arg))
+                _set(doc, path, items)
+            else:
+                raise OperationFailure(f'Unsupported update operator {op}')
+
+
+def _upsert_document(query, update):
+    doc = {}
+    for key, value in query.items():
+        if key.startswith('$'):
+            continue
+        if isinstance(value, dict) and any(k.startswith('$') for k in value):
+            if '$eq' in value:
+                _set(doc, key, _copy(value['$eq']))
+            continue
+        _set(doc, key, _copy(value))
+    _apply_update(doc, update, inserting=True)
+    return doc
+
+
+# Aggregation expressions
+
+def evaluate(expr, doc):
+    if isinstance(expr, str):
+        if expr.startswith('$$ROOT'):
+            return doc
+        if expr.startswith('$'):
+            value = _get(doc, expr[1:])
+            return None if value is _MISSING else value
+        return expr
+    if isinstance(expr, list):
+        return [evaluate(e, doc) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) == 1:
+        op, args = next(iter(expr.items()))
+        if op.startswith('$'):
+            return _evaluate_operator(op, args, doc)
+    return {k: evaluate(v, doc) for k, v in expr.items()}
+
+
+def _evaluate_operator(op, args, doc):
+    if op == '$literal':
+        return args
+    if op == '$cond':
+        if isinstance(args, dict):
+            args = [args['if'], args['then'], args['else']]
+        return evaluate(args[1] if evaluate(args[0], doc) else args[2], doc)
+    if op == '$ifNull':
+        for arg in args:
+            value = evaluate(arg, doc)
+            if value is not None:
+                return value
+        return None
+
+    values = evaluate(args, doc)
+    if not isinstance(args, list):
+        values = [values]
+    if op in ('$subtract', '$add', '$multiply', '$divide', '$mod', '$floor', '$ceil',
+              '$abs', '$sqrt', '$toDouble', '$toLong') and any(v is None for v in values):
+        return None
+    if op == '$subtract':
+        a, b = values
+        if isinstance(a, datetime) and isinstance(b, datetime):
+            return (a - b) // timedelta(milliseconds=1)
+        if isinstance(a, datetime):
+            return a - timedelta(milliseconds=b)
+        return a - b
+    if op == '$add':
+        base = next((v for v in values if isinstance(v, datetime)), None)
+        total = sum(v for v in values if not isinstance(v, datetime))
+        return base + timedelta(milliseconds=total) if base else total
+    if op == '$multiply':
+        return math.prod(values)
+    if op == '$divide':
+        return values[0] / values[1]
+    if op == '$mod':
+        return math.fmod(values[0], values[1])
+    if op == '$floor':
+        return math.floor(values[0])
+    if op == '$ceil':
+        return math.ceil(values[0])
+    if op == '$abs':
+        return abs(values[0])
+    if op == '$sqrt':
+        return math.sqrt(values[0])
+    if op == '$toDouble':
+        return float(values[0])
+    if op == '$toLong':
+        value = values[0]
+        return int(value.timestamp() * 1000) if isinstance(value, datetime) else int(value)
+    if op in ('$min', '$max'):
+        items = values[0] if len(values) == 1 and isinstance(values[0], list) else values
+        items = [v for v in items if v is not None]
+        if not items:
+            return None
+        return (min if op == '$min' else max)(items, key=_sort_key)
+    if op in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte'):
+        result = _compare(values[0], values[1])
+        return {'$eq': result == 0, '$ne': result != 0, '$gt': result > 0,
+                '$gte': result >= 0, '$lt': result < 0, '$lte': result <= 0}[op]
+    if op == '$and':
+        return all(values)
+    if op == '$or':
+        return any(values)
+    if op == '$not':
+        return not values[0]
+    raise OperationFailure(f'Unsupported aggregation operator {op}')
+
+
+class _Accumulator:
+    def __init__(self, op, expr):
+        self.op = op
+        self.expr = expr
+        self.value = None
+        self.count = 0
+        self.seen = False
+
+    def add(self, doc):
+        value = evaluate(self.expr, doc)
+        if self.op == '$sum':
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.value = (self.value or 0) + value
+            else:
+                self.value = self.value or 0
+        elif self.op == '$avg':
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.value = (self.value or 0) + value
+                self.count += 1
+        elif self.op in ('$min', '$max'):
+            if value is not None:
+                if self.value is None:
+                    self.value = value
+                else:
+                    result = _compare(value, self.value)
+                    if (self.op == '$min' and result < 0) or (self.op == '$max' and result > 0):
+                        self.value = value
+        elif self.op == '$first':
+            if not self.seen:
+                self.value = value
+        elif self.op == '$last':
+            self.value = value
+        elif self.op == '$push':
+            self.value = (self.value or []) + [value]
+        elif self.op == '$addToSet':
+            self.value = self.value or []
+            if value not in self.value:
+                self.value.append(value)
+        else:
+            raise OperationFailure(f'Unsupported accumulator {self.op}')
+        self.seen = True
+
+    def result(self):
+        if self.op == '$avg':
+            return self.value / self.count if self.count else None
+        if self.op == '$sum':
+            return self.value or 0
+        return self.value
+
+
+def _group(docs, spec):
+    groups = {}
+    for doc in docs:
+        key = evaluate(spec['_id'], doc)
+        hashable = repr(key) if isinstance(key, (dict, list)) else key
+        entry = groups.get(hashable)
+        if entry is None:
+            entry = groups[hashable] = (key, {
+                field: _Accumulator(*next(iter(acc.items())))
+                for field, acc in spec.items() if field != '_id'
+            })
+        for accumulator in entry[1].values():
+            accumulator.add(doc)
+    return [
+        {'_id': key, **{field: acc.result() for field, acc in accumulators.items()}}
+        for key, accumulators in groups.values()
+    ]
+
+
+def _project_stage(docs, spec):
+    # Plain 0/1 entries include or exclude fields, anything else is an expression
+    flags = {k: v for k, v in spec.items() if isinstance(v, (bool, int))}
+    computed = {k: v for k, v in spec.items() if k not in flags}
+    include = {k: 1 for k, v in flags.items() if v and k != '_id'}
+    result = []
+    for doc in docs:
+        if include or computed:
+            out = _project(doc, include) if include else {}
+            out.pop('_id', None)
+            if flags.get('_id', 1) and '_id' in doc:
+                out['_id'] = doc['_id']
+        else:
+            out = _project(doc, flags)
+        for key, expr in computed.items():
+            _set(out, key, evaluate(expr, doc))
+        result.append(out)
+    return result
+
+
+def run_pipeline(docs, pipeline):
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == '$match':
+            docs = [d for d in docs if matches(d, spec)]
+        elif name == '$group':
+            docs = _group(docs, spec)
+        elif name == '$sort':
+            docs = _sort_docs(list(docs), list(spec.items()))
+        elif name == '$limit':
+            docs = docs[:spec]
+        elif name == '$skip':
+            docs = docs[spec:]
+        elif name == '$project':
+            docs = _project_stage(docs, spec)
+        elif name in ('$addFields', '$set'):
+            for doc in docs:
+                for key, expr in spec.items():
+                    _set(doc, key, evaluate(expr, doc))
+        elif name == '$unset':
+            for doc in docs:
+                for key in ([spec] if isinstance(spec, str) else spec):
+                    _unset(doc, key)
+        elif name == '$count':
+            docs = [{spec: len(docs)}] if docs else []
+        else:
+            raise OperationFailure(f'Unsupported pipeline stage {name}')
+    return docs
+
+
+class MemoryCursor:
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query or {}
+        self._projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key, direction=None):
+        self._sort = _normalize_sort(key, direction)
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def _evaluate(self):
+        docs = self._collection._matching(self._query)
+        if self._sort:
+            _sort_docs(docs, self._sort)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [_project(d, self._projection) for d in docs]
+
+    def __iter__(self):
+        if self._results is None:
+            self._results = self._evaluate()
+        return iter(self._results)
+
+    def __next__(self):
+        if not hasattr(self, '_iterator'):
+            self._iterator = iter(self)
+        return next(self._iterator)
+
+    def close(self):
+        pass
+
+    def explain(self):
+        fields = set(self._query)
+        for index in self._collection._indexes.values():
+            if index['key'][0][0] in fields:
+                stage = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': index['name']}}
+                break
+        else:
+            stage = {'stage': 'COLLSCAN'}
+        return {'queryPlanner': {'namespace': self._collection.full_name, 'winningPlan': stage}}
+
+
+class MemoryCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = f'{database.name}.{name}'
+        self._docs = {}
+        self._indexes = {'_id_': {'name': '_id_', 'key': [('_id', 1)], 'unique': True}}
+        self._lock = threading.RLock()
+
+    def _matching(self, query):
+        with self._lock:
+            if '_id' in query and not isinstance(query['_id'], dict):
+                doc = self._docs.get(query['_id'])
+                return [doc] if doc is not None and matches(doc, query) else []
+            return [d for d in self._docs.values() if matches(d, query)]
+
+    def _check_unique(self, doc, ignore_id=None):
+        for index in self._indexes.values():
+            if not index.get('unique') or index['name'] == '_id_':
+                continue
+            key = tuple(_get(doc, field) for field, _ in index['key'])
+            for other in self._docs.values():
+                if other['_id'] != ignore_id and tuple(_get(other, f) for f, _ in index['key']) == key:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: {index['name']}")
+
+    def _insert(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        if doc['_id'] in self._docs:
+            raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.full_name} index: _id_')
+        self._check_unique(doc)
+        self._docs[doc['_id']] = _copy(doc)
+        return doc['_id']
+
+    # Queries
+
+    def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, **kwargs):
+        cursor = MemoryCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        return next(iter(self.find(filter, projection, sort=sort, limit=1)), None)
+
+    def count_documents(self, filter, **kwargs):
+        return len(self._matching(filter))
+
+    def estimated_document_count(self, **kwargs):
+        return len(self._docs)
+
+    def distinct(self, key, filter=None):
+        values = []
+        for doc in self._matching(filter or {}):
+            value = _get(doc, key)
+            if value is not _MISSING and value not in values:
+                values.append(value)
+        return values
+
+    def aggregate(self, pipeline, **kwargs):
+        with self._lock:
+            docs = [_copy(d) for d in self._docs.values()]
+        return iter(run_pipeline(docs, pipeline))
+
+    # Writes
+
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        inserted, errors = [], []
+        with self._lock:
+            for index, document in enumerate(documents):
+                try:
+                    inserted.append(self._insert(document))
+                except DuplicateKeyError as e:
+                    errors.append({'index': index, 'code': 11000, 'errmsg': str(e), 'op': document})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted), 'writeConcernErrors': [],
+                                  'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []})
+        return InsertManyResult(inserted, True)
+
+    def _update(self, filter, update, upsert, many):
+        with self._lock:
+            docs = self._matching(filter)
+            if not many:
+                docs = docs[:1]
+            modified = 0
+            for doc in docs:
+                updated = _copy(doc)
+                _apply_update(updated, update)
+                if updated != doc:
+                    self._check_unique(updated, ignore_id=doc['_id'])
+                    self._docs[doc['_id']] = updated
+                    modified += 1
+            raw = {'n': len(docs), 'nModified': modified, 'ok': 1.0, 'updatedExisting': bool(docs)}
+            if not docs and upsert:
+                raw['upserted'] = self._insert(_upsert_document(filter, update))
+                raw['n'] = 1
+            return raw
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        return UpdateResult(self._update(filter, update, upsert, many=False), True)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        return UpdateResult(self._update(filter, update, upsert, many=True), True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        return UpdateResult(self._update(filter, replacement, upsert, many=False), True)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        with self._lock:
+            docs = self._matching(filter)
+            if sort:
+                _sort_docs(docs, _normalize_sort(sort))
+            before = docs[0] if docs else None
+            raw = self._update({'_id': before['_id']} if before else filter, update, upsert and not before, many=False)
+            if return_document == ReturnDocument.BEFORE:
+                return _project(before, projection) if before else None
+            _id = before['_id'] if before else raw.get('upserted')
+            return self.find_one({'_id': _id}, projection) if _id is not None else None
+
+    def delete_one(self, filter, **kwargs):
+        return self._delete(filter, many=False)
+
+    def delete_many(self, filter, **kwargs):
+        return self._delete(filter, many=True)
+
+    def _delete(self, filter, many):
+        with self._lock:
+            docs = self._matching(filter)
+            if not many:
+                docs = docs[:1]
+            for doc in docs:
+                del self._docs[doc['_id']]
+            return DeleteResult({'n': len(docs), 'ok': 1.0}, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        result = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+                  'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self._lock:
+            for index, request in enumerate(requests):
+                try:
+                    if isinstance(request, InsertOne):
+                        self._insert(request._doc)
+                        result['nInserted'] += 1
+                    elif isinstance(request, (UpdateOne, UpdateMany)):
+                        raw = self._update(request._filter, request._doc, request._upsert,
+                                           many=isinstance(request, UpdateMany))
+                        if 'upserted' in raw:
+                            result['nUpserted'] += 1
+                            result['upserted'].append({'index': index, '_id': raw['upserted']})
+                        else:
+                            result['nMatched'] += raw['n']
+                            result['nModified'] += raw['nModified']
+                    elif isinstance(request, (DeleteOne, DeleteMany)):
+                        result['nRemoved'] += self._delete(request._filter, many=isinstance(request, DeleteMany)).deleted_count
+                    else:
+                        raise OperationFailure(f'Unsupported bulk operation {type(request).__name__}')
+                except DuplicateKeyError as e:
+                    result['writeErrors'].append({'index': index, 'code': 11000, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    # Indexes
+
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        keys = _normalize_sort(keys)
+        name = name or '_'.join(f'{field}_{direction}' for field, direction in keys)
+        with self._lock:
+            self._indexes[name] = {'name': name, 'key': keys, 'unique': unique, **kwargs}
+            if unique:
+                seen = set()
+                for doc in self._docs.values():
+                    key = tuple(repr(_get(doc, field)) for field, _ in keys)
+                    if key in seen:
+                        del self._indexes[name]
+                        raise DuplicateKeyError(f'E11000 duplicate key error building index {name}')
+                    seen.add(key)
+        return name
+
+    def index_information(self):
+        return {name: {'key': index['key'], **({'unique': True} if index.get('unique') else {})}
+                for name, index in self._indexes.items()}
+
+    def drop_index(self, name):
+        self._indexes.pop(name, None)
+
+
+class MemoryDatabase:
+    def __init__(self, name):
+        self.name = name
+        self._collections = {}
+        self._options = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            with self._lock:
+                collection = self._collections.setdefault(name, MemoryCollection(self, name))
+        return collection
+
+    def get_collection(self, name, **kwargs):
+        return self[name]
+
+    def list_collection_names(self, **kwargs):
+        return list(self._collections)
+
+    def list_collections(self, filter=None, **kwargs):
+        return iter([
+            {'name': name, 'type': self._options.get(name, {}).get('type', 'collection'), 'options': {}}
+            for name in self._collections
+            if not filter or matches({'name': name}, filter)
+        ])
+
+    def create_collection(self, name, **options):
+        if name in self._collections:
+            raise OperationFailure(f'Collection {self.name}.{name} already exists')
+        self._options[name] = {'type': 'timeseries' if 'timeseries' in options else 'collection'}
+        return self[name]
+
+    def drop_collection(self, name):
+        self._collections.pop(name, None)
+        self._options.pop(name, None)
+
+    def command(self, command, value=None, **kwargs):
+        # Collection options (collMod, TTL) have no effect in memory
+        return {'ok': 1.0}
@@ -0,0 +1,58 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core.exceptions import MiddlewareNotUsed
+from .instrumentation import COUNT_BUCKETS, end_request, get_settings, metrics, start_request
+
+
+class InstrumentationMiddleware:
+    # Per-request timings, MongoDB op counts and a Server-Timing header.
+    # Streaming responses are measured up to the first byte.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = get_settings()
+        if not config['enabled']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.server_timing = config['server_timing']
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats, token = start_request()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            end_request(token)
+        self.finish(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        stats, token = start_request()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            end_request(token)
+        self.finish(request, response, stats, time.perf_counter() - started)
+        return response
+
+    def finish(self, request, response, stats, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        route = (match.view_name or match.route) if match else 'unmatched'
+        labels = (('route', route), ('method', request.method))
+        metrics.inc('iot_http_requests_total', labels + (('status', response.status_code),))
+        metrics.observe('iot_http_request_duration_seconds', elapsed, labels)
+        metrics.observe('iot_http_request_mongo_operations', stats.db_ops, labels, buckets=COUNT_BUCKETS)
+
+        if self.server_timing:
+            app = elapsed - stats.db_seconds - sum(stats.phases.values())
+            entries = [f'db;dur={stats.db_seconds * 1000:.2f};desc="{stats.db_ops} ops, {stats.db_docs} docs"']
+            entries += [f'{name};dur={seconds * 1000:.2f}' for name, seconds in stats.phases.items()]
+            entries.append(f'app;dur={max(app, 0) * 1000:.2f}')
+            entries.append(f'total;dur={elapsed * 1000:.2f}')
+            response['Server-Timing'] = ', '.join(entries)
@@ -1,61 +1,284 @@
-from pymongo import MongoClient
-from datetime import datetime
+import asyncio
+import hashlib
+import heapq
+import time
+from collections import defaultdict
+from itertools import groupby
+from pymongo import DeleteMany, InsertOne, UpdateOne, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, timedelta
 from bson import ObjectId
-
-# MongoDB connection
-client = MongoClient('mongodb://localhost:27017/')
-db = client['iot_dashboard']
+from django.conf import settings
+from .aggregation import (
+    EPOCH, align, bucket_index, bucket_pipeline, rollup_pipeline, bucket_readings, partial_update, empty_partial,
+    merge_partial, merge_intervals, split_interval,
+)
+from .archive import VERSION as ARCHIVE_VERSION, decode_block, encode_block
+from .storage import AsyncCollection, Collection
+from .cache import get_device_cache, get_history_cache
+from .pagination import keyset_query, keyset_sort
+from .events import publish_device
 
 class Device:
-    collection = db['devices']
+    collection = Collection('devices')
+    acollection = AsyncCollection('devices')
+    indexes = [
+        {'keys': [('device_id', ASCENDING)], 'unique': True},
+        # Online/offline filters and counts for the fleet overview
+        {'keys': [('last_seen', ASCENDING), ('device_id', ASCENDING)]},
+    ]
+    page_fields = ('device_id',)
 
     @classmethod
     def get_all(cls):
         return list(cls.collection.find())
 
+    @classmethod
+    def find_page(cls, after=None, limit=100, query=None, projection=None):
+        query = keyset_query(query or {}, cls.page_fields, after)
+        return list(cls.collection.find(query, projection).sort(keyset_sort(cls.page_fields)).limit(limit))
+
+    @staticmethod
+    def status_query(online, cutoff):
+        if online:
+            return {'last_seen': {'$gte': cutoff}}
+        return {'$or': [{'last_seen': None}, {'last_seen': {'$lt': cutoff}}]}
+
+    @classmethod
+    def count_online(cls, cutoff):
+        online = cls.collection.count_documents(cls.status_query(True, cutoff))
+        return online, cls.collection.estimated_document_count() - online
+
     @classmethod
     def get_by_id(cls, device_id):
-        return cls.collection.find_one({'device_id': device_id})
+        cache = get_device_cache()
+        device = cache.get(device_id)
+        if device is None:
+            device = cls.collection.find_one({'device_id': device_id})
+            if device is not None:
+                cache.set(device_id, device)
+        return device
+
+    @classmethod
+    async def aget_by_id(cls, device_id, fresh=False):
+        # fresh: skip the cache (it may hold another process's old copy)
+        # and store what was read
+        cache = get_device_cache()
+        device = None if fresh else await cache.aget(device_id)
+        if device is None:
+            device = await cls.acollection.find_one({'device_id': device_id})
+            if device is not None:
+                await cache.aset(device_id, device)
+        return device
+
+    @staticmethod
+    def new_document(device_id):
+        return {
+            'device_id': device_id,
+            'relay_state': False,
+            'temp_threshold_high': 30,
+            'temp_threshold_low': 20,
+            'auto_mode': True,
+            'state_version': 0,
+            'relay_changed_at': None,
+            # Set by ingest from the newest reading
+            'last_seen': None,
+            'last_reading': None
+        }
 
     @classmethod
     def get_or_create(cls, device_id):
         device = cls.get_by_id(device_id)
         if not device:
-            device = {
-                'device_id': device_id,
-                'relay_state': False,
-                'temp_threshold_high': 30,
-                'temp_threshold_low': 20,
-                'auto_mode': True,
-                'last_seen': datetime.now()
-            }
-            cls.collection.insert_one(device)
+            device = cls.new_document(device_id)
+            try:
+                cls.collection.insert_one(device)
+                get_device_cache().set(device_id, device)
+            except DuplicateKeyError:
+                # Created concurrently by another request
+                device = cls.get_by_id(device_id)
         return device
 
+    @classmethod
+    def get_or_create_many(cls, device_ids):
+        cache = get_device_cache()
+        devices = cache.get_many(device_ids)
+        uncached = [device_id for device_id in device_ids if device_id not in devices]
+        if uncached:
+            for device in cls.collection.find({'device_id': {'$in': uncached}}):
+                devices[device['device_id']] = device
+                cache.set(device['device_id'], device)
+
+        missing = [cls.new_document(device_id) for device_id in device_ids if device_id not in devices]
+        if missing:
+            try:
+                cls.collection.insert_many(missing, ordered=False)
+                created = missing
+            except BulkWriteError:
+                # Some were created concurrently, read back what is there now
+                ids = [device['device_id'] for device in missing]
+                created = list(cls.collection.find({'device_id': {'$in': ids}}))
+            for device in created:
+                devices[device['device_id']] = device
+                cache.set(device['device_id'], device)
+        return devices
+
+    @classmethod
+    async def aget_or_create_many(cls, device_ids):
+        cache = get_device_cache()
+        devices = await cache.aget_many(device_ids)
+        uncached = [device_id for device_id in device_ids if device_id not in devices]
+        if uncached:
+            for device in await cls.acollection.find({'device_id': {'$in': uncached}}):
+                devices[device['device_id']] = device
+                await cache.aset(device['device_id'], device)
+
+        missing = [cls.new_document(device_id) for device_id in device_ids if device_id not in devices]
+        if missing:
+            try:
+                await cls.acollection.insert_many(missing, ordered=False)
+                created = missing
+            except BulkWriteError:
+                ids = [device['device_id'] for device in missing]
+                created = await cls.acollection.find({'device_id': {'$in': ids}})
+            for device in created:
+                devices[device['device_id']] = device
+                await cache.aset(device['device_id'], device)
+        return devices
+
     @classmethod
     def update(cls, device_id, update_data):
-        cls.collection.update_one(
+        device = cls.collection.find_one_and_update(
             {'device_id': device_id},
-            {'$set': update_data}
+            {'$set': update_data, '$inc': {'state_version': 1}},
+            return_document=ReturnDocument.AFTER
         )
+        # Write through so the next poll sees the new state without a read
+        if device is not None:
+            get_device_cache().set(device_id, device)
+            publish_device(device_id, device)
+            # Relay state and runtime show up in responses revalidated by
+            # the history mtime (daily logs, bootstrap)
+            history = get_history_cache()
+            if history is not None:
+                history.touch([device_id])
+        else:
+            get_device_cache().invalidate(device_id)
+        return device
+
+    @classmethod
+    def update_many(cls, updates, latest=None):
+        # updates: {device_id: update_data}, latest: {device_id: newest reading}
+        ops = cls.update_ops(updates) + cls.latest_ops(latest or {})
+        if not ops:
+            return
+        cls.collection.bulk_write(ops, ordered=False)
+        cls.updated_many(updates, latest or {})
+
+    @classmethod
+    async def aupdate_many(cls, updates, latest=None):
+        ops = cls.update_ops(updates) + cls.latest_ops(latest or {})
+        if not ops:
+            return
+        await cls.acollection.bulk_write(ops, ordered=False)
+        await cls.aupdated_many(updates, latest or {})
+
+    @staticmethod
+    def last_reading(reading):
+        return {
+            'timestamp': reading['timestamp'],
+            'temperature': reading['temperature'],
+            'humidity': reading['humidity'],
+        }
+
+    @classmethod
+    def latest_ops(cls, latest):
+        # The filter skips devices that already have something newer, e.g.
+        # when a backfill arrives after live readings
+        return [
+            UpdateOne(
+                {'device_id': device_id, '$or': [{'last_seen': None}, {'last_seen': {'$lt': reading['timestamp']}}]},
+                {'$set': {'last_seen': reading['timestamp'], 'last_reading': cls.last_reading(reading)}}
+            )
+            for device_id, reading in latest.items()
+        ]
+
+    @staticmethod
+    def update_ops(updates):
+        return [
+            UpdateOne({'device_id': device_id}, {'$set': update_data, '$inc': {'state_version': 1}})
+            for device_id, update_data in updates.items()
+        ]
+
+    @classmethod
+    def patch_cached(cls, cached, updates, latest):
+        # Applies the writes to cached documents; returns the changed ones
+        changed = {}
+        for device_id, reading in latest.items():
+            device = cached.get(device_id)
+            if device is not None and (device.get('last_seen') is None or device['last_seen'] < reading['timestamp']):
+                device['last_seen'] = reading['timestamp']
+                device['last_reading'] = cls.last_reading(reading)
+                changed[device_id] = device
+        for device_id, update_data in updates.items():
+            device = cached.get(device_id)
+            if device is not None:
+                device.update(update_data)
+                device['state_version'] = device.get('state_version', 0) + 1
+                changed[device_id] = device
+        return changed
+
+    @classmethod
+    def updated_many(cls, updates, latest):
+        # Patch cached documents in place of a read back
+        cache = get_device_cache()
+        cached = cache.get_many(list({**latest, **updates}))
+        for device_id, device in cls.patch_cached(cached, updates, latest).items():
+            cache.set(device_id, device)
+        for device_id, update_data in updates.items():
+            publish_device(device_id, cached.get(device_id) or update_data)
+
+    @classmethod
+    async def aupdated_many(cls, updates, latest):
+        cache = get_device_cache()
+        cached = await cache.aget_many(list({**latest, **updates}))
+        for device_id, device in cls.patch_cached(cached, updates, latest).items():
+            await cache.aset(device_id, device)
+        for device_id, update_data in updates.items():
+            publish_device(device_id, cached.get(device_id) or update_data)
 
 class Telemetry:
-    collection = db['telemetry']
+    collection = Collection('telemetry')
+    acollection = AsyncCollection('telemetry')
+    indexes = [
+        # _id is included so keyset pagination never needs an in-memory sort
+        {'keys': [('device_id', ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)]},
+        {'keys': [('timestamp', ASCENDING), ('_id', ASCENDING)]},
+    ]
+    page_fields = ('timestamp', '_id')
 
     @classmethod
     def get_all(cls):
         return list(cls.collection.find())
 
     @classmethod
-    def create(cls, device_id, temperature, humidity):
+    def create(cls, device_id, temperature, humidity, timestamp=None):
         telemetry = {
             'device_id': device_id,
             'temperature': temperature,
             'humidity': humidity,
-            'timestamp': datetime.now()
+            'timestamp': timestamp or datetime.now()
         }
         return cls.collection.insert_one(telemetry)
 
+    @classmethod
+    def insert_many(cls, readings):
+        return cls.collection.insert_many(readings, ordered=False)
+
+    @classmethod
+    async def ainsert_many(cls, readings):
+        return await cls.acollection.insert_many(readings, ordered=False)
+
     @classmethod
     def get_range(cls, start_time, end_time, device_id=None):
         query = {
@@ -66,14 +289,658 @@ class Telemetry:
         }
         if device_id:
             query['device_id'] = device_id
-        return list(cls.collection.find(query))
+        readings = list(cls.collection.find(query))
+        if archive_enabled():
+            readings += TelemetryArchive.get_range(start_time, end_time, device_id)
+        return readings
+
+    @classmethod
+    def find_range(cls, start_time=None, end_time=None, device_id=None, after=None,
+                   descending=False, batch_size=1000):
+        # Server-side cursor in (timestamp, _id) order, resumable from `after`
+        query = {}
+        if start_time or end_time:
+            query['timestamp'] = {}
+            if start_time:
+                query['timestamp']['$gte'] = start_time
+            if end_time:
+                query['timestamp']['$lt'] = end_time
+        if device_id:
+            query['device_id'] = device_id
+        query = keyset_query(query, cls.page_fields, after, descending)
+        return cls.collection.find(query).sort(keyset_sort(cls.page_fields, descending)).batch_size(batch_size)
+
+    @classmethod
+    def export_range(cls, start_time=None, end_time=None, device_id=None, after=None, batch_size=1000):
+        # find_range with archived readings merged in, in the same order
+        live = cls.find_range(start_time, end_time, device_id, after=after, batch_size=batch_size)
+        if not archive_enabled():
+            return live
+        archived = TelemetryArchive.find_readings(start_time, end_time, device_id, after)
+
+        def merged():
+            try:
+                yield from heapq.merge(live, archived, key=lambda r: (r['timestamp'], r['_id']))
+            finally:
+                live.close()
+        return merged()
+
+    @staticmethod
+    def rollup_split(start_time, end_time, bucket, complete_from):
+        # First bucket boundary from which the rollup tier holds every reading
+        if complete_from is None:
+            return end_time
+        if complete_from <= start_time:
+            return start_time
+        return min(start_time - ((start_time - complete_from) // bucket) * bucket, end_time)
+
+    @staticmethod
+    def add_rollup_partials(partials, rollup, offset):
+        for index, partial in rollup.items():
+            partials[offset + index] = partial
+        return partials
+
+    @classmethod
+    def raw_buckets(cls, start_time, end_time, bucket, device_id=None):
+        pipeline = bucket_pipeline(start_time, end_time, bucket, device_id)
+        partials = {
+            int(row.pop('_id')): row
+            for row in cls.collection.aggregate(pipeline)
+        }
+        if archive_enabled():
+            blocks = TelemetryArchive.find_blocks(start_time, end_time, device_id)
+            TelemetryArchive.add_partials(partials, blocks, start_time, end_time, bucket)
+        return partials
+
+    @classmethod
+    async def araw_buckets(cls, start_time, end_time, bucket, device_id=None):
+        pipeline = bucket_pipeline(start_time, end_time, bucket, device_id)
+        if not archive_enabled():
+            return {
+                int(row.pop('_id')): row
+                for row in await cls.acollection.aggregate(pipeline)
+            }
+        rows, blocks = await asyncio.gather(
+            cls.acollection.aggregate(pipeline),
+            TelemetryArchive.afind_blocks(start_time, end_time, device_id),
+        )
+        partials = {int(row.pop('_id')): row for row in rows}
+        return TelemetryArchive.add_partials(partials, blocks, start_time, end_time, bucket)
+
+    @classmethod
+    def aggregate_buckets(cls, start_time, end_time, bucket, device_id=None):
+        # Serve from the coarsest rollup tier that can represent the buckets,
+        # and from raw readings before the point the tier is complete from
+        tier = TelemetryRollup.tier_for(bucket, start_time) if rollups_enabled() else None
+        if tier is None:
+            return cls.raw_buckets(start_time, end_time, bucket, device_id)
+        split = cls.rollup_split(start_time, end_time, bucket, RollupWatermark.complete_from(tier))
+        partials = cls.raw_buckets(start_time, split, bucket, device_id) if split > start_time else {}
+        if split < end_time:
+            rollup = tier.aggregate_buckets(split, end_time, bucket, device_id)
+            cls.add_rollup_partials(partials, rollup, (split - start_time) // bucket)
+        return partials
+
+    @classmethod
+    async def aaggregate_buckets(cls, start_time, end_time, bucket, device_id=None):
+        tier = TelemetryRollup.tier_for(bucket, start_time) if rollups_enabled() else None
+        if tier is None:
+            return await cls.araw_buckets(start_time, end_time, bucket, device_id)
+        split = cls.rollup_split(start_time, end_time, bucket, await RollupWatermark.acomplete_from(tier))
+        if split >= end_time:
+            return await cls.araw_buckets(start_time, end_time, bucket, device_id)
+        if split == start_time:
+            return await tier.aaggregate_buckets(start_time, end_time, bucket, device_id)
+        partials, rollup = await asyncio.gather(
+            cls.araw_buckets(start_time, split, bucket, device_id),
+            tier.aaggregate_buckets(split, end_time, bucket, device_id),
+        )
+        return cls.add_rollup_partials(partials, rollup, (split - start_time) // bucket)
+
+    @staticmethod
+    def closed_keys(history, generation, start_time, end_time, bucket, device_id):
+        closed = max(0, (end_time - history.grace - start_time) // bucket)
+        return history.bucket_keys(device_id, generation, start_time, bucket, closed)
+
+    @staticmethod
+    def split_cached(keys, cached):
+        # Closed buckets available in the history cache up to the first miss
+        first_miss = next((i for i, key in enumerate(keys) if key not in cached), len(keys))
+        partials = {i: cached[keys[i]] for i in range(first_miss) if cached[keys[i]]['count']}
+        return partials, keys[first_miss:], first_miss
+
+    @staticmethod
+    def merge_fresh(partials, fresh, missing_keys, first_miss):
+        # Returns the cache entries for the buckets that were missing
+        for index, partial in fresh.items():
+            partials[first_miss + index] = partial
+        return {
+            key: partials.get(first_miss + i) or empty_partial()
+            for i, key in enumerate(missing_keys)
+        }
+
+    @classmethod
+    def cached_buckets(cls, start_time, end_time, bucket, device_id=None):
+        # Closed buckets come from the history cache; the database is only
+        # asked for the buckets from the first miss up to the open bucket
+        history = get_history_cache()
+        if history is None:
+            return cls.aggregate_buckets(start_time, end_time, bucket, device_id)
+        generation, _ = history.state(device_id)
+        keys = cls.closed_keys(history, generation, start_time, end_time, bucket, device_id)
+        partials, missing_keys, first_miss = cls.split_cached(keys, history.get_many(keys))
+        fresh = cls.aggregate_buckets(start_time + first_miss * bucket, end_time, bucket, device_id)
+        history.set_many(cls.merge_fresh(partials, fresh, missing_keys, first_miss))
+        return partials
+
+    @classmethod
+    async def acached_buckets(cls, start_time, end_time, bucket, device_id=None):
+        history = get_history_cache()
+        if history is None:
+            return await cls.aaggregate_buckets(start_time, end_time, bucket, device_id)
+        generation, _ = await history.astate(device_id)
+        keys = cls.closed_keys(history, generation, start_time, end_time, bucket, device_id)
+        partials, missing_keys, first_miss = cls.split_cached(keys, await history.aget_many(keys))
+        fresh = await cls.aaggregate_buckets(start_time + first_miss * bucket, end_time, bucket, device_id)
+        await history.aset_many(cls.merge_fresh(partials, fresh, missing_keys, first_miss))
+        return partials
+
+class Anomaly:
+    # Readings flagged or quarantined by the ingest screening (anomaly.py)
+    collection = Collection('anomalies')
+    acollection = AsyncCollection('anomalies')
+    indexes = [
+        {'keys': [('device_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)]},
+        {'keys': [('timestamp', DESCENDING), ('_id', DESCENDING)]},
+    ]
+    page_fields = ('timestamp', '_id')
+
+    @classmethod
+    def insert_many(cls, events):
+        return cls.collection.insert_many(events, ordered=False)
+
+    @classmethod
+    async def ainsert_many(cls, events):
+        return await cls.acollection.insert_many(events, ordered=False)
+
+    @classmethod
+    def find_page(cls, since, device_id=None, kind=None, after=None, limit=100):
+        # Newest first
+        query = {'timestamp': {'$gte': since}}
+        if device_id:
+            query['device_id'] = device_id
+        if kind:
+            query['kind'] = kind
+        query = keyset_query(query, cls.page_fields, after, descending=True)
+        return list(cls.collection.find(query).sort(keyset_sort(cls.page_fields, descending=True)).limit(limit))
+
+def rollups_enabled():
+    return getattr(settings, 'IOT_ROLLUPS', {}).get('enabled', False)
+
+def archive_enabled():
+    return getattr(settings, 'IOT_ARCHIVE', {}).get('enabled', False)
+
+class TelemetryArchive:
+    # Closed days of raw telemetry packed into one compressed column block
+    # per device and day (see archive.py) by `manage.py archive_telemetry`.
+    # Each block also carries the count/sum/min/max of its readings.
+    collection = Collection('telemetry_archive')
+    acollection = AsyncCollection('telemetry_archive')
+    indexes = [
+        {'keys': [('device_id', ASCENDING), ('date', ASCENDING)], 'unique': True},
+        {'keys': [('date', ASCENDING)]},
+        {'keys': [('pending_ids', ASCENDING)], 'sparse': True},
+    ]
+    projection = {'_id': 0, 'pending_ids': 0}
+
+    @staticmethod
+    def range_query(start_time, end_time, device_id=None):
+        # A block holds readings from [date, date + 1 day)
+        query = {'date': {'$gt': start_time - timedelta(days=1), '$lt': end_time}}
+        if isinstance(device_id, list):
+            query['device_id'] = {'$in': device_id}
+        elif device_id:
+            query['device_id'] = device_id
+        return query
+
+    @classmethod
+    def find_blocks(cls, start_time, end_time, device_id=None):
+        return list(cls.collection.find(cls.range_query(start_time, end_time, device_id), cls.projection))
+
+    @classmethod
+    async def afind_blocks(cls, start_time, end_time, device_id=None):
+        return await cls.acollection.find(cls.range_query(start_time, end_time, device_id), cls.projection)
+
+    @staticmethod
+    def build(device_id, date, readings, decimals=2):
+        readings = sorted(readings, key=lambda r: r['timestamp'])
+        return {
+            'device_id': device_id,
+            'date': date,
+            'start': readings[0]['timestamp'],
+            'end': readings[-1]['timestamp'],
+            'version': ARCHIVE_VERSION,
+            'decimals': decimals,
+            'data': encode_block(readings, date, decimals),
+            **bucket_readings(readings, date, timedelta(days=1))[0],
+        }
+
+    @staticmethod
+    def decode(block):
+        timestamps, values = decode_block(block['data'], block['date'], block['count'], block['decimals'])
+        return [
+            {'device_id': block['device_id'], 'timestamp': timestamp, 'temperature': temperature, 'humidity': humidity}
+            for timestamp, temperature, humidity in zip(timestamps, values['temperature'], values['humidity'])
+        ]
+
+    @staticmethod
+    def reading_id(device_id, timestamp, occurrence):
+        # Stable stand-in for the _id the reading had before it was archived,
+        # so keyset cursors work across live and archived readings
+        key = f'{device_id}:{timestamp.isoformat()}:{occurrence}'.encode()
+        return ObjectId(hashlib.blake2b(key, digest_size=12).digest())
+
+    @classmethod
+    def decode_with_ids(cls, block):
+        readings = cls.decode(block)
+        seen = defaultdict(int)
+        for reading in readings:
+            occurrence = seen[reading['timestamp']]
+            seen[reading['timestamp']] += 1
+            reading['_id'] = cls.reading_id(reading['device_id'], reading['timestamp'], occurrence)
+        return readings
+
+    @classmethod
+    def find_readings(cls, start_time=None, end_time=None, device_id=None, after=None):
+        # Archived readings in Telemetry.find_range order, decoding one day
+        # of blocks at a time
+        lower = max((t for t in (start_time, after and after[0]) if t), default=None)
+        query = {}
+        if lower or end_time:
+            query['date'] = {}
+            if lower:
+                query['date']['$gt'] = lower - timedelta(days=1)
+            if end_time:
+                query['date']['$lt'] = end_time
+        if device_id:
+            query['device_id'] = device_id
+        blocks = cls.collection.find(query, cls.projection).sort('date', ASCENDING).batch_size(10)
+        for _, day in groupby(blocks, key=lambda block: block['date']):
+            readings = sorted(
+                (reading for block in day for reading in cls.decode_with_ids(block)),
+                key=lambda r: (r['timestamp'], r['_id'])
+            )
+            for reading in readings:
+                if start_time and reading['timestamp'] < start_time:
+                    continue
+                if end_time and reading['timestamp'] >= end_time:
+                    return
+                if after and (reading['timestamp'], reading['_id']) <= tuple(after):
+                    continue
+                yield reading
+
+    @classmethod
+    def readings(cls, blocks, start_time, end_time):
+        for block in blocks:
+            for reading in cls.decode(block):
+                if start_time <= reading['timestamp'] < end_time:
+                    yield reading
+
+    @classmethod
+    def get_range(cls, start_time, end_time, device_id=None):
+        return list(cls.readings(cls.find_blocks(start_time, end_time, device_id), start_time, end_time))
+
+    @classmethod
+    def add_partials(cls, partials, blocks, start_time, end_time, bucket):
+        # Folds archived readings into {bucket index: partial}. A block that
+        # sits inside a single bucket is added from its totals, undecoded.
+        for block in blocks:
+            index = (block['start'] - start_time) // bucket
+            if block['start'] >= start_time and block['end'] < end_time and index == (block['end'] - start_time) // bucket:
+                block_partials = {index: {key: block[key] for key in empty_partial()}}
+            else:
+                block_partials = bucket_readings(cls.readings([block], start_time, end_time), start_time, bucket)
+            for index, partial in block_partials.items():
+                if index in partials:
+                    merge_partial(partials[index], partial)
+                else:
+                    partials[index] = partial
+        return partials
+
+    @classmethod
+    def finish_pending(cls):
+        # Completes the raw deletes of a run that stopped part way
+        for block in cls.collection.find({'pending_ids': {'$exists': True}}, {'pending_ids': 1}):
+            Telemetry.collection.delete_many({'_id': {'$in': block['pending_ids']}})
+            cls.collection.update_one({'_id': block['_id']}, {'$unset': {'pending_ids': ''}})
+
+    @classmethod
+    def archive_day(cls, date, decimals=2):
+        # Moves one day of raw readings into blocks; returns (devices, readings)
+        end = date + timedelta(days=1)
+        window = {'timestamp': {'$gte': date, '$lt': end}}
+        pipeline = [{'$match': window}, {'$group': {'_id': '$device_id'}}]
+        device_ids = [row['_id'] for row in Telemetry.collection.aggregate(pipeline)]
+        archived = 0
+        for device_id in device_ids:
+            key = {'device_id': device_id, 'date': date}
+            readings = list(Telemetry.collection.find({**window, 'device_id': device_id}))
+            ids = [reading['_id'] for reading in readings]
+            existing = cls.collection.find_one(key, cls.projection)
+            if existing is not None:
+                # Late readings for a day that is already archived
+                readings += cls.decode(existing)
+            # The raw ids stay on the block until they are deleted, so an
+            # interrupted run finishes the delete rather than archive twice
+            cls.collection.replace_one(key, {**cls.build(device_id, date, readings, decimals), 'pending_ids': ids}, upsert=True)
+            Telemetry.collection.delete_many({'_id': {'$in': ids}})
+            cls.collection.update_one(key, {'$unset': {'pending_ids': ''}})
+            archived += len(ids)
+        return len(device_ids), archived
+
+class TelemetryRollup:
+    # Per-device count/sum/min/max partials at a fixed resolution
+    resolution = None
+    indexes = [
+        {'keys': [('device_id', ASCENDING), ('bucket', ASCENDING)], 'unique': True},
+        {'keys': [('bucket', ASCENDING)]},
+    ]
+
+    @classmethod
+    def tiers(cls):
+        # Coarsest first
+        return sorted(cls.__subclasses__(), key=lambda tier: tier.resolution, reverse=True)
+
+    @classmethod
+    def tier_for(cls, bucket, start_time):
+        for tier in cls.tiers():
+            if bucket % tier.resolution == timedelta(0) and (start_time - EPOCH) % tier.resolution == timedelta(0):
+                return tier
+        return None
+
+    @classmethod
+    def update_ops(cls, partials):
+        return [
+            UpdateOne(
+                {'device_id': device_id, 'bucket': EPOCH + index * cls.resolution},
+                partial_update(partial),
+                upsert=True
+            )
+            for (device_id, index), partial in partials.items()
+        ]
+
+    @classmethod
+    def readings_ops(cls, readings):
+        return cls.update_ops(bucket_readings(readings, EPOCH, cls.resolution, by_device=True))
+
+    @classmethod
+    def add_readings(cls, readings):
+        ops = cls.readings_ops(readings)
+        if ops:
+            cls.collection.bulk_write(ops, ordered=False)
+
+    @classmethod
+    async def aadd_readings(cls, readings):
+        ops = cls.readings_ops(readings)
+        if ops:
+            await cls.acollection.bulk_write(ops, ordered=False)
+
+    @classmethod
+    def add_readings_all_tiers(cls, readings):
+        for tier in cls.tiers():
+            tier.add_readings(readings)
+
+    @classmethod
+    async def aadd_readings_all_tiers(cls, readings):
+        await asyncio.gather(*(tier.aadd_readings(readings) for tier in cls.tiers()))
+
+    @classmethod
+    def raw_partials(cls, start_time, end_time, device_id=None):
+        # {(device_id, index): partial} at this tier's resolution, computed
+        # from raw telemetry and archived days
+        pipeline = bucket_pipeline(start_time, end_time, cls.resolution, device_id, by_device=True)
+        partials = {}
+        for row in Telemetry.collection.aggregate(pipeline):
+            key = row.pop('_id')
+            partials[(key['device_id'], int(key['index']))] = row
+        if archive_enabled():
+            blocks = TelemetryArchive.find_blocks(start_time, end_time, device_id)
+            readings = TelemetryArchive.readings(blocks, start_time, end_time)
+            for key, partial in bucket_readings(readings, start_time, cls.resolution, by_device=True).items():
+                if key in partials:
+                    merge_partial(partials[key], partial)
+                else:
+                    partials[key] = partial
+        return partials
+
+    @classmethod
+    def rebuild(cls, start_time, end_time):
+        # Recompute the tier from raw telemetry, replacing what is stored
+        partials = cls.raw_partials(start_time, end_time)
+        ops = [
+            UpdateOne(
+                {'device_id': device_id, 'bucket': start_time + index * cls.resolution},
+                {'$set': partial},
+                upsert=True
+            )
+            for (device_id, index), partial in partials.items()
+        ]
+        if ops:
+            cls.collection.bulk_write(ops, ordered=False)
+        return len(ops)
+
+    @classmethod
+    def aggregate_buckets(cls, start_time, end_time, bucket, device_id=None):
+        pipeline = rollup_pipeline(start_time, end_time, bucket, device_id)
+        return {
+            int(row.pop('_id')): row
+            for row in cls.collection.aggregate(pipeline)
+        }
+
+    @classmethod
+    async def aaggregate_buckets(cls, start_time, end_time, bucket, device_id=None):
+        pipeline = rollup_pipeline(start_time, end_time, bucket, device_id)
+        return {
+            int(row.pop('_id')): row
+            for row in await cls.acollection.aggregate(pipeline)
+        }
+
+class MinuteRollup(TelemetryRollup):
+    collection = Collection('telemetry_1m')
+    acollection = AsyncCollection('telemetry_1m')
+    resolution = timedelta(minutes=1)
+
+class HourRollup(TelemetryRollup):
+    collection = Collection('telemetry_1h')
+    acollection = AsyncCollection('telemetry_1h')
+    resolution = timedelta(hours=1)
+
+class DayRollup(TelemetryRollup):
+    collection = Collection('telemetry_1d')
+    acollection = AsyncCollection('telemetry_1d')
+    resolution = timedelta(days=1)
+
+class RollupWatermark:
+    # One document per rollup tier: the tier holds every reading from
+    # complete_from on. The first ingest with rollups on starts it at the
+    # next tier boundary, an ingest with rollups off removes it (the tiers
+    # miss what arrives meanwhile), and backfill_rollups moves it back over
+    # what it rebuilt. History before it is read from raw telemetry.
+    # Ingest checks once per process; reads are cached for `ttl` seconds.
+    collection = Collection('rollup_watermarks')
+    acollection = AsyncCollection('rollup_watermarks')
+    indexes = []
+    ttl = 60
+    _cached = {}
+    # True once this process made sure the watermarks exist, False once it
+    # removed them
+    _maintained = None
+
+    @classmethod
+    def reset(cls):
+        cls._cached.clear()
+        cls._maintained = None
+
+    @staticmethod
+    def start_ops(now):
+        ops = []
+        for tier in TelemetryRollup.tiers():
+            start = align(now, tier.resolution)
+            if start < now:
+                start += tier.resolution
+            ops.append(UpdateOne({'_id': tier.collection.name}, {'$setOnInsert': {'complete_from': start}}, upsert=True))
+        return ops
+
+    @classmethod
+    def ensure(cls):
+        # Before the first rollup write of this process
+        if cls._maintained is True:
+            return
+        try:
+            cls.collection.bulk_write(cls.start_ops(datetime.now()), ordered=False)
+        except BulkWriteError:
+            pass  # Started concurrently by another process
+        cls._cached.clear()
+        cls._maintained = True
+
+    @classmethod
+    async def aensure(cls):
+        if cls._maintained is True:
+            return
+        try:
+            await cls.acollection.bulk_write(cls.start_ops(datetime.now()), ordered=False)
+        except BulkWriteError:
+            pass
+        cls._cached.clear()
+        cls._maintained = True
+
+    @classmethod
+    def drop(cls):
+        if cls._maintained is False:
+            return
+        cls.collection.bulk_write([DeleteMany({})])
+        cls._cached.clear()
+        cls._maintained = False
+
+    @classmethod
+    async def adrop(cls):
+        if cls._maintained is False:
+            return
+        await cls.acollection.bulk_write([DeleteMany({})])
+        cls._cached.clear()
+        cls._maintained = False
+
+    @classmethod
+    def extend(cls, tier, start_time, end_time):
+        # After rebuilding [start_time, end_time): complete from start_time
+        # if it already was from some point up to end_time
+        result = cls.collection.update_one(
+            {'_id': tier.collection.name, 'complete_from': {'$lte': end_time}},
+            {'$min': {'complete_from': start_time}}
+        )
+        cls._cached.pop(tier, None)
+        return result.matched_count > 0
+
+    @classmethod
+    def cached(cls, tier):
+        entry = cls._cached.get(tier)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry
+        return None
+
+    @classmethod
+    def store(cls, tier, doc):
+        complete_from = doc['complete_from'] if doc else None
+        cls._cached[tier] = (time.monotonic() + cls.ttl, complete_from)
+        return complete_from
+
+    @classmethod
+    def complete_from(cls, tier, fresh=False):
+        # None when the tier can't be trusted for any range
+        entry = None if fresh else cls.cached(tier)
+        if entry is not None:
+            return entry[1]
+        return cls.store(tier, cls.collection.find_one({'_id': tier.collection.name}))
+
+    @classmethod
+    async def acomplete_from(cls, tier):
+        entry = cls.cached(tier)
+        if entry is not None:
+            return entry[1]
+        return cls.store(tier, await cls.acollection.find_one({'_id': tier.collection.name}))
 
 class DailyLog:
-    collection = db['daily_logs']
+    collection = Collection('daily_logs')
+    acollection = AsyncCollection('daily_logs')
+    indexes = [
+        {'keys': [('device_id', ASCENDING), ('date', ASCENDING)], 'unique': True},
+        {'keys': [('date', DESCENDING)]},
+    ]
+
+    @staticmethod
+    def with_averages(log):
+        # Averages are derived from the running sums kept by add_readings
+        count = log.get('reading_count')
+        if count:
+            log['avg_temperature'] = log['temperature_sum'] / count
+            log['avg_humidity'] = log['humidity_sum'] / count
+        log.setdefault('avg_temperature', 0)
+        log.setdefault('avg_humidity', 0)
+        for key in ('min_temperature', 'max_temperature', 'min_humidity', 'max_humidity'):
+            log.setdefault(key, None)
+        log.setdefault('fan_runtime_minutes', 0)
+        return log
 
     @classmethod
     def get_all(cls):
-        return list(cls.collection.find())
+        return [cls.with_averages(log) for log in cls.collection.find()]
+
+    @staticmethod
+    def range_query(start_date, device_id=None):
+        query = {'date': {'$gte': start_date}}
+        if device_id:
+            query['device_id'] = device_id
+        return query
+
+    @classmethod
+    def with_runtime(cls, logs, runtime, start_date):
+        # Fan runtime comes from the relay interval sums; days before the
+        # event log existed keep the per-reading count stored on the log
+        logs = [cls.with_averages(log) for log in logs]
+        for log in logs:
+            seconds = runtime.get((log['device_id'], (log['date'] - start_date) // timedelta(days=1)))
+            if seconds is not None:
+                log['fan_runtime_minutes'] = round(seconds / 60)
+        return logs
+
+    @classmethod
+    def get_range(cls, start_date, device_id=None):
+        day = timedelta(days=1)
+        logs = cls.collection.find(cls.range_query(start_date, device_id)).sort('date', -1)
+        runtime = RelayRuntime.runtime_seconds(start_date, datetime.now() + day, day, device_id)
+        return cls.with_runtime(logs, runtime, start_date)
+
+    @classmethod
+    async def aget_range(cls, start_date, device_id=None):
+        day = timedelta(days=1)
+        logs, runtime = await asyncio.gather(
+            cls.acollection.find(cls.range_query(start_date, device_id), sort=[('date', DESCENDING)]),
+            RelayRuntime.aruntime_seconds(start_date, datetime.now() + day, day, device_id),
+        )
+        return cls.with_runtime(logs, runtime, start_date)
+
+    @classmethod
+    def for_devices(cls, device_ids, date):
+        # {device_id: log} for one day, with runtime from the relay sums
+        logs = {
+            log['device_id']: cls.with_averages(log)
+            for log in cls.collection.find({'device_id': {'$in': device_ids}, 'date': date})
+        }
+        day = timedelta(days=1)
+        for (device_id, index), seconds in RelayRuntime.runtime_seconds(date, date + day, day, device_ids).items():
+            if device_id in logs and index == 0:
+                logs[device_id]['fan_runtime_minutes'] = round(seconds / 60)
+        return logs
 
     @classmethod
     def get_or_create(cls, device_id, date):
@@ -85,18 +952,221 @@ class DailyLog:
             log = {
                 'device_id': device_id,
                 'date': date,
-                'avg_temperature': 0,
-                'avg_humidity': 0,
-                'min_temperature': None,
-                'max_temperature': None,
+                'reading_count': 0,
+                'temperature_sum': 0,
+                'humidity_sum': 0,
                 'fan_runtime_minutes': 0
             }
             cls.collection.insert_one(log)
-        return log
+        return cls.with_averages(log)
+
+    @staticmethod
+    def rollup_update(readings):
+        temperatures = [r['temperature'] for r in readings]
+        humidities = [r['humidity'] for r in readings]
+        return {
+            '$inc': {
+                'reading_count': len(readings),
+                'temperature_sum': sum(temperatures),
+                'humidity_sum': sum(humidities),
+            },
+            '$min': {
+                'min_temperature': min(temperatures),
+                'min_humidity': min(humidities)
+            },
+            '$max': {
+                'max_temperature': max(temperatures),
+                'max_humidity': max(humidities)
+            }
+        }
+
+    @classmethod
+    def add_readings(cls, device_id, date, readings):
+        cls.collection.update_one(
+            {'device_id': device_id, 'date': date},
+            cls.rollup_update(readings),
+            upsert=True
+        )
+
+    @classmethod
+    def add_readings_many(cls, updates):
+        # updates: (device_id, date, readings) tuples
+        if updates:
+            cls.collection.bulk_write(cls.add_readings_ops(updates), ordered=False)
+
+    @classmethod
+    async def aadd_readings_many(cls, updates):
+        if updates:
+            await cls.acollection.bulk_write(cls.add_readings_ops(updates), ordered=False)
+
+    @classmethod
+    def add_readings_ops(cls, updates):
+        return [
+            UpdateOne(
+                {'device_id': device_id, 'date': date},
+                cls.rollup_update(readings),
+                upsert=True
+            )
+            for device_id, date, readings in updates
+        ]
 
     @classmethod
     def update(cls, device_id, date, update_data):
         cls.collection.update_one(
             {'device_id': device_id, 'date': date},
             {'$set': update_data}
-        )
\ No newline at end of file
+        )
+
+class RelayEvent:
+    # One document per on-period: {device_id, start, end}, end None while on
+    collection = Collection('relay_events')
+    acollection = AsyncCollection('relay_events')
+    indexes = [
+        {'keys': [('device_id', ASCENDING), ('start', ASCENDING)]},
+        # Open runs (end: None) for one or all devices
+        {'keys': [('end', ASCENDING), ('device_id', ASCENDING)]},
+        {'keys': [('start', ASCENDING), ('end', ASCENDING)]},
+    ]
+
+    @staticmethod
+    def interval_ops(device_id, was_on, on_since, transitions):
+        # transitions: (timestamp, state) in order. Returns the event writes
+        # and the (device_id, start, end) runs that ended.
+        ops, ended = [], []
+        open_stored = was_on
+        start = on_since
+        for at, state in transitions:
+            if state:
+                start = at
+                continue
+            if open_stored:
+                ops.append(UpdateOne({'device_id': device_id, 'end': None}, {'$set': {'end': at}}))
+                open_stored = False
+            elif start is not None:
+                ops.append(InsertOne({'device_id': device_id, 'start': start, 'end': at}))
+            if start is not None:
+                ended.append((device_id, start, at))
+        if transitions and transitions[-1][1]:
+            ops.append(InsertOne({'device_id': device_id, 'start': start, 'end': None}))
+        return ops, ended
+
+    @classmethod
+    def prepare(cls, changes):
+        # changes: (device_id, was_on, on_since, transitions) tuples
+        ops, ended = [], []
+        for change in changes:
+            change_ops, change_ended = cls.interval_ops(*change)
+            ops += change_ops
+            ended += change_ended
+        return ops, RelayRuntime.add_ops(ended)
+
+    @classmethod
+    def record_many(cls, changes):
+        ops, runtime_ops = cls.prepare(changes)
+        if ops:
+            # Ordered, so closing a run can't match the one opened after it
+            cls.collection.bulk_write(ops, ordered=True)
+        if runtime_ops:
+            RelayRuntime.collection.bulk_write(runtime_ops, ordered=False)
+
+    @classmethod
+    async def arecord_many(cls, changes):
+        ops, runtime_ops = cls.prepare(changes)
+        if ops:
+            await cls.acollection.bulk_write(ops, ordered=True)
+        if runtime_ops:
+            await RelayRuntime.acollection.bulk_write(runtime_ops, ordered=False)
+
+    @staticmethod
+    def open_runs_query(device_id=None):
+        # device_id may also be a list
+        query = {'end': None}
+        if isinstance(device_id, list):
+            query['device_id'] = {'$in': device_id}
+        elif device_id:
+            query['device_id'] = device_id
+        return query
+
+    @classmethod
+    def open_runs(cls, device_id=None):
+        return list(cls.collection.find(cls.open_runs_query(device_id)))
+
+    @classmethod
+    async def aopen_runs(cls, device_id=None):
+        return await cls.acollection.find(cls.open_runs_query(device_id))
+
+    @classmethod
+    def find_overlapping(cls, start_time, end_time, device_id=None):
+        query = {'start': {'$lt': end_time}, '$or': [{'end': None}, {'end': {'$gt': start_time}}]}
+        if device_id:
+            query['device_id'] = device_id
+        return list(cls.collection.find(query).sort('start', 1))
+
+class RelayRuntime:
+    # Relay on-time in seconds per device and hour, added as runs end
+    collection = Collection('relay_runtime_1h')
+    acollection = AsyncCollection('relay_runtime_1h')
+    resolution = timedelta(hours=1)
+    indexes = [
+        {'keys': [('device_id', ASCENDING), ('hour', ASCENDING)], 'unique': True},
+        {'keys': [('hour', ASCENDING)]},
+    ]
+
+    @classmethod
+    def add_ops(cls, runs):
+        seconds = defaultdict(float)
+        for device_id, start, end in runs:
+            for hour, run_seconds in split_interval(start, end, cls.resolution):
+                seconds[(device_id, hour)] += run_seconds
+        return [
+            UpdateOne({'device_id': device_id, 'hour': hour}, {'$inc': {'seconds': total}}, upsert=True)
+            for (device_id, hour), total in seconds.items()
+        ]
+
+    @classmethod
+    def runtime_seconds(cls, start_time, end_time, bucket, device_id=None, now=None):
+        # {(device_id, bucket index): seconds} for one device, a list or all.
+        # bucket must be a whole number of hours and start_time aligned to it.
+        # Runs still in progress are not in the sums yet and are added up to now.
+        pipeline = cls.runtime_pipeline(start_time, end_time, bucket, device_id)
+        rows = cls.collection.aggregate(pipeline)
+        return cls.runtime_totals(rows, RelayEvent.open_runs(device_id), start_time, end_time, bucket, now)
+
+    @classmethod
+    async def aruntime_seconds(cls, start_time, end_time, bucket, device_id=None, now=None):
+        pipeline = cls.runtime_pipeline(start_time, end_time, bucket, device_id)
+        rows, events = await asyncio.gather(cls.acollection.aggregate(pipeline), RelayEvent.aopen_runs(device_id))
+        return cls.runtime_totals(rows, events, start_time, end_time, bucket, now)
+
+    @staticmethod
+    def runtime_pipeline(start_time, end_time, bucket, device_id=None):
+        match = {'hour': {'$gte': start_time, '$lt': end_time}}
+        if isinstance(device_id, list):
+            match['device_id'] = {'$in': device_id}
+        elif device_id:
+            match['device_id'] = device_id
+        return [
+            {'$match': match},
+            {'$group': {
+                '_id': {'device_id': '$device_id', 'index': bucket_index(start_time, bucket, time_field='hour')},
+                'seconds': {'$sum': '$seconds'},
+            }},
+        ]
+
+    @staticmethod
+    def runtime_totals(rows, events, start_time, end_time, bucket, now=None):
+        totals = defaultdict(float)
+        for row in rows:
+            totals[(row['_id']['device_id'], int(row['_id']['index']))] += row['seconds']
+
+        now = min(now or datetime.now(), end_time)
+        runs = defaultdict(list)
+        for event in events:
+            runs[event['device_id']].append((max(event['start'], start_time), now))
+        for run_device, intervals in runs.items():
+            # Overlapping open runs (e.g. a lost close) count once
+            for start, end in merge_intervals(intervals):
+                for bucket_start, seconds in split_interval(start, end, bucket):
+                    totals[(run_device, (bucket_start - start_time) // bucket)] += seconds
+        return totals
+
@@ -0,0 +1,56 @@
+import base64
+import json
+from datetime import datetime
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'d': value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {'o': str(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if 'd' in value:
+            return datetime.fromisoformat(value['d'])
+        if 'o' in value:
+            return ObjectId(value['o'])
+    return value
+
+
+def encode_cursor(doc, fields):
+    values = [_encode_value(doc[field]) for field in fields]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, fields):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = [_decode_value(v) for v in json.loads(base64.urlsafe_b64decode(padded))]
+    except (ValueError, TypeError, InvalidId):
+        raise ValueError('Invalid cursor')
+    if len(values) != len(fields):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def keyset_query(query, fields, after=None, descending=False):
+    # Rows strictly after the cursor in (fields...) order, e.g. for
+    # (timestamp, _id): timestamp > t OR (timestamp == t AND _id > id)
+    if after is None:
+        return query
+    op = '$lt' if descending else '$gt'
+    clauses = []
+    for i, field in enumerate(fields):
+        clause = {f: after[j] for j, f in enumerate(fields[:i])}
+        clause[field] = {op: after[i]}
+        clauses.append(clause)
+    return {'$and': [query, {'$or': clauses}]} if query else {'$or': clauses}
+
+
+def keyset_sort(fields, descending=False):
+    return [(field, -1 if descending else 1) for field in fields]
@@ -0,0 +1,337 @@
+import bisect
+import asyncio
+import hashlib
+import logging
+import signal
+import socket
+import sys
+import threading
+from collections import defaultdict
+from datetime import datetime
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Connection, Listener, answer_challenge, deliver_challenge
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Exit code of a worker that couldn't bind its port; not worth restarting
+EXIT_ADDRESS_IN_USE = 3
+
+# Partitioned ingest ('partitioned' mode in IOT_INGEST). `manage.py
+# ingest_workers` runs a fixed set of worker processes, each listening on
+# port + index. Web processes and ingest_listener hash every reading's
+# device_id onto a consistent-hash ring and send it to the worker that owns
+# the device. A worker buffers what it receives in an IngestQueue and writes
+# it in batches from a single thread, so a device's readings are only ever
+# handled by one writer: relay hysteresis, rule state and the anomaly
+# detector live in that worker's memory without being raced by another
+# process. The device and history caches have to be shared with the web
+# processes (ingest_workers checks), and events published by a worker only
+# reach subscribers in that worker.
+#
+# Rebalancing: the ring has `replicas` points per worker, so going from N to
+# N + 1 workers moves about 1/(N + 1) of the devices and leaves the rest where
+# they were. Change 'workers' in IOT_INGEST, restart ingest_workers (workers
+# drain their queues before exiting, so the old and new owner of a device
+# never write at the same time), then restart the web processes. Moved
+# devices start with cold in-memory state: rules seed from the device's
+# last_reading and the anomaly detector warms up again. Workers report their
+# ring when a client connects; a client whose settings disagree follows the
+# workers and logs a warning.
+
+
+def partition_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=128):
+        points = sorted(
+            (partition_hash(f'{node}:{replica}'), node)
+            for node in range(nodes) for replica in range(replicas)
+        )
+        self.nodes = nodes
+        self._keys = [key for key, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node(self, device_id):
+        index = bisect.bisect(self._keys, partition_hash(device_id))
+        return self._owners[index % len(self._keys)]
+
+    def split(self, readings):
+        # {node: [index into readings]}, order within each node kept
+        parts = defaultdict(list)
+        for index, reading in enumerate(readings):
+            parts[self.node(reading['device_id'])].append(index)
+        return parts
+
+
+def authkey(config):
+    if config.get('authkey'):
+        return config['authkey'].encode()
+    return hashlib.sha256(f'ingest-workers:{settings.SECRET_KEY}'.encode()).digest()
+
+
+def worker_address(config, index):
+    host, port = config['partition_address']
+    return host, port + index
+
+
+class PartitionWorker:
+    # One per worker process: accepts readings for its devices and writes
+    # them through the usual batched queue
+
+    def __init__(self, index, config):
+        from .ingest import IngestQueue
+        self.index = index
+        self.config = config
+        self.replicas = config['partition_replicas']
+        self.ring = HashRing(config['workers'], self.replicas)
+        self.queue = IngestQueue(
+            max_size=config['queue_size'],
+            flush_size=config['flush_size'],
+            flush_interval=config['flush_interval'],
+            retry_limit=config['retry_limit'],
+            retry_backoff=config['retry_backoff'],
+            retry_backoff_max=config['retry_backoff_max']
+        )
+        self.misrouted = 0
+        self.listener = None
+        self.stopped = threading.Event()
+
+    def handle(self, conn):
+        try:
+            conn.send(('hello', self.index, self.ring.nodes, self.replicas))
+            while True:
+                message = conn.recv()
+                kind = message[0] if isinstance(message, tuple) and message else None
+                if kind == 'put' and len(message) == 2 and isinstance(message[1], list):
+                    readings = message[1]
+                    foreign = sum(1 for r in readings if self.ring.node(r['device_id']) != self.index)
+                    if foreign:
+                        # Still written: dropping them would lose data
+                        if not self.misrouted:
+                            logger.warning('Worker %d received readings for devices it does not own', self.index)
+                        self.misrouted += foreign
+                    conn.send(self.queue.put_many(readings))
+                elif kind == 'stats':
+                    conn.send({**self.queue.stats(), 'misrouted': self.misrouted})
+                else:
+                    logger.warning('Worker %d got an unknown message, closing the connection', self.index)
+                    conn.send(('error', 'unknown message'))
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def accept_loop(self):
+        while not self.stopped.is_set():
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                if self.stopped.is_set():
+                    return
+                logger.exception('Worker %d failed to accept a connection', self.index)
+                continue
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def serve(self):
+        address = worker_address(self.config, self.index)
+        try:
+            self.listener = Listener(address, backlog=128, authkey=authkey(self.config))
+        except OSError as e:
+            logger.error('Worker %d cannot listen on %s:%d: %s', self.index, *address, e)
+            sys.exit(EXIT_ADDRESS_IN_USE)
+        self.queue.start()
+        threading.Thread(target=self.accept_loop, name='partition-accept', daemon=True).start()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            self.stopped.wait()
+        finally:
+            self.listener.close()
+            # Drain before exiting so a restarted ring doesn't race this one
+            self.queue.stop(timeout=None)
+
+
+def run_worker(index, config):
+    # Process entry point; spawned processes start without Django set up
+    import django
+    django.setup()
+    PartitionWorker(index, config).serve()
+
+
+class PartitionClient:
+    """
+    Routes readings to the ingest worker that owns each device.
+
+    Has the IngestQueue interface (put, put_many, put_batch, their async
+    twins, stats, stop), so views and ingest_listener don't need to know which
+    mode they run in. Every wait on a worker is bounded by partition_timeout
+    and the async methods run in a thread, so a stalled worker costs its
+    callers a timeout rather than the event loop or every request thread.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.replicas = config['partition_replicas']
+        self.ring = HashRing(config['workers'], self.replicas)
+        self._key = authkey(config)
+        self.timeout = config['partition_timeout']
+        self._conns = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._stats = {'accepted': 0, 'rejected': 0, 'unreachable': 0}
+
+    def _recv(self, conn):
+        if not conn.poll(self.timeout):
+            raise TimeoutError(f'No reply within {self.timeout}s')
+        return conn.recv()
+
+    def _connect(self, node):
+        # multiprocessing's Client(), with the connect and the handshake bounded
+        with socket.create_connection(worker_address(self.config, node), timeout=self.timeout) as sock:
+            sock.setblocking(True)
+            conn = Connection(sock.detach())
+        try:
+            if not conn.poll(self.timeout):
+                raise TimeoutError(f'No challenge within {self.timeout}s')
+            answer_challenge(conn, self._key)
+            deliver_challenge(conn, self._key)
+            _, index, workers, replicas = self._recv(conn)
+        except BaseException:
+            conn.close()
+            raise
+        if (workers, replicas) != (self.ring.nodes, self.replicas):
+            logger.warning('Ingest workers run a ring of %d x %d, settings say %d x %d; following the workers',
+                           workers, replicas, self.ring.nodes, self.replicas)
+            self.replicas = replicas
+            self.ring = HashRing(workers, replicas)
+        return conn
+
+    def _call(self, node, message=None):
+        # None when the worker can't be reached in time; the next call
+        # reconnects. A put that timed out may still have been queued by the
+        # worker. Without a message this only makes sure the connection is open.
+        lock = self._locks.setdefault(node, threading.Lock())
+        if not lock.acquire(timeout=self.timeout):
+            logger.warning('Ingest worker %d busy for more than %ss', node, self.timeout)
+            return None
+        try:
+            conn = self._conns.get(node)
+            if conn is None:
+                conn = self._conns[node] = self._connect(node)
+            if message is None:
+                return True
+            conn.send(message)
+            return self._recv(conn)
+        except (EOFError, OSError, AuthenticationError) as e:
+            # Also drops a connection whose late reply would answer the next call
+            logger.warning('Ingest worker %d unreachable: %r', node, e)
+            conn = self._conns.pop(node, None)
+            if conn is not None:
+                conn.close()
+            return None
+        finally:
+            lock.release()
+
+    def put_batch(self, readings):
+        # Indexes of the readings that were not queued. A batch spanning
+        # several workers can be partly accepted when one of them is full or
+        # down; resending only these keeps the retry from duplicating the rest.
+        now = datetime.now()
+        readings = [{**r, 'timestamp': r.get('timestamp') or now} for r in readings]
+        if not self._conns:
+            # Learn the workers' ring size before routing anything
+            self._call(0)
+        rejected = []
+        pending = list(range(len(readings)))
+        for last in (False, True):
+            # Each pass routes by one ring. A handshake in the first pass
+            # that replaces it sends what is left round again, split by the
+            # workers' ring; the second pass keeps its ring whatever happens.
+            ring = self.ring
+            rerouted = []
+            for node, indexes in ring.split([readings[i] for i in pending]).items():
+                indexes = [pending[i] for i in indexes]
+                if not last and self.ring is not ring:
+                    rerouted += indexes
+                    continue
+                connected = self._call(node)
+                if not last and self.ring is not ring:
+                    rerouted += indexes
+                    continue
+                accepted = self._call(node, ('put', [readings[i] for i in indexes])) if connected else None
+                with self._lock:
+                    if accepted is True:
+                        self._stats['accepted'] += len(indexes)
+                    else:
+                        self._stats['rejected'] += len(indexes)
+                        if accepted is None:
+                            self._stats['unreachable'] += 1
+                        rejected += indexes
+            if not rerouted:
+                break
+            pending = sorted(rerouted)
+        return sorted(rejected)
+
+    def put_many(self, readings):
+        return not self.put_batch(readings)
+
+    def put(self, reading):
+        return self.put_many([reading])
+
+    async def aput_batch(self, readings):
+        return await asyncio.to_thread(self.put_batch, readings)
+
+    async def aput_many(self, readings):
+        return await asyncio.to_thread(self.put_many, readings)
+
+    async def aput(self, reading):
+        return await asyncio.to_thread(self.put, reading)
+
+    def stats(self):
+        # Worker queues summed, plus what this process sent
+        totals = defaultdict(float)
+        reachable = 0
+        for node in range(self.ring.nodes):
+            stats = self._call(node, ('stats',))
+            if stats is None:
+                continue
+            reachable += 1
+            for key, value in stats.items():
+                if key.endswith('_max'):
+                    totals[key] = max(totals[key], value)
+                elif key not in ('flush_size', 'flush_interval', 'last_flush_seconds'):
+                    totals[key] += value
+        with self._lock:
+            sent = {f'sent_{key}': value for key, value in self._stats.items()}
+        return {
+            'workers': self.ring.nodes,
+            'reachable': reachable,
+            'depth': int(totals['depth']),
+            'capacity': int(totals['capacity']),
+            'accepted': int(totals['accepted']),
+            'rejected': int(totals['rejected']),
+            'written': int(totals['written']),
+            'failed': int(totals['failed']),
+            'retries': int(totals['retries']),
+            'dropped': int(totals['dropped']),
+            'flushes': int(totals['flushes']),
+            'flush_seconds_total': totals['flush_seconds_total'],
+            'flush_seconds_max': totals['flush_seconds_max'],
+            'misrouted': int(totals['misrouted']),
+            **sent,
+        }
+
+    def stop(self, timeout=None):
+        # Only closes connections; the workers keep running and flush on their own
+        for node in list(self._conns):
+            with self._locks.setdefault(node, threading.Lock()):
+                conn = self._conns.pop(node, None)
+                if conn is not None:
+                    conn.close()
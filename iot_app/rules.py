@@ -0,0 +1,258 @@
+import threading
+from datetime import timedelta
+
+# Automation rules stored on the device document, e.g.
+#
+#   'rules': [
+#       {'type': 'schedule', 'start': '22:00', 'end': '06:00', 'state': False},
+#       {'type': 'hysteresis', 'field': 'temperature', 'on_above': 30, 'off_below': 20},
+#       {'type': 'hysteresis', 'field': 'humidity', 'on_above': 80, 'off_below': 60},
+#       {'type': 'rate', 'field': 'temperature', 'per_minute': 0.5, 'state': True},
+#       {'type': 'min_duration', 'on': 120, 'off': 60},
+#   ]
+#
+# Rules are checked in order for every reading and the first one with an
+# opinion sets the desired relay state; with none the relay stays as it is.
+# min_duration (seconds) holds off a change until the relay has been in its
+# current state long enough. Devices without rules use their
+# temp_threshold_high/low as a single temperature hysteresis.
+
+FIELDS = ('temperature', 'humidity')
+
+
+def _field(spec):
+    field = spec.get('field', 'temperature')
+    if field not in FIELDS:
+        raise ValueError(f"Unknown field {field!r}, expected one of {', '.join(FIELDS)}")
+    return field
+
+
+def _number(spec, key, required=True):
+    value = spec.get(key)
+    if value is None and not required:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f'{spec.get("type")} rule needs a numeric {key!r}')
+    return float(value)
+
+
+def _state(spec):
+    state = spec.get('state')
+    if not isinstance(state, bool):
+        raise ValueError(f'{spec.get("type")} rule needs a boolean state')
+    return state
+
+
+def _minute_of_day(value):
+    try:
+        if not isinstance(value, str):
+            raise ValueError
+        hours, minutes = (int(part) for part in value.split(':'))
+    except ValueError:
+        raise ValueError(f'Invalid time {value!r}, expected HH:MM')
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f'Invalid time {value!r}, expected HH:MM')
+    return hours * 60 + minutes
+
+
+def _weekdays(value):
+    if value is None:
+        return None
+    if not isinstance(value, list) or not all(
+        isinstance(day, int) and not isinstance(day, bool) and 0 <= day <= 6 for day in value
+    ):
+        raise ValueError('schedule days must be a list of weekdays 0-6 (0 = Monday)')
+    return frozenset(value)
+
+
+class Hysteresis:
+    # Cooling (on_above/off_below) or heating (on_below/off_above) band
+
+    def __init__(self, spec):
+        self.field = _field(spec)
+        if 'on_below' in spec or 'off_above' in spec:
+            self.on, self.off = _number(spec, 'on_below'), _number(spec, 'off_above')
+            if self.on > self.off:
+                raise ValueError('on_below must not be above off_above')
+            self.evaluate = self.heating
+        else:
+            self.on, self.off = _number(spec, 'on_above'), _number(spec, 'off_below')
+            if self.off > self.on:
+                raise ValueError('off_below must not be above on_above')
+            self.evaluate = self.cooling
+
+    def cooling(self, reading, previous):
+        value = reading[self.field]
+        if value >= self.on:
+            return True
+        if value <= self.off:
+            return False
+        return None
+
+    def heating(self, reading, previous):
+        value = reading[self.field]
+        if value <= self.on:
+            return True
+        if value >= self.off:
+            return False
+        return None
+
+
+class Schedule:
+    # Forces a state between start and end (local time, may wrap midnight),
+    # optionally only on some weekdays (0 = Monday)
+
+    def __init__(self, spec):
+        self.start = _minute_of_day(spec.get('start'))
+        self.end = _minute_of_day(spec.get('end'))
+        self.state = _state(spec)
+        self.days = _weekdays(spec.get('days'))
+
+    def evaluate(self, reading, previous):
+        timestamp = reading['timestamp']
+        if self.days is not None and timestamp.weekday() not in self.days:
+            return None
+        minute = timestamp.hour * 60 + timestamp.minute
+        if self.start <= self.end:
+            inside = self.start <= minute < self.end
+        else:
+            inside = minute >= self.start or minute < self.end
+        return self.state if inside else None
+
+
+class RateOfChange:
+    # Fires when the field moves faster than per_minute between consecutive
+    # readings: rising for a positive threshold, falling for a negative one
+
+    def __init__(self, spec):
+        self.field = _field(spec)
+        self.per_minute = _number(spec, 'per_minute')
+        if not self.per_minute:
+            raise ValueError('rate rule needs a non-zero per_minute')
+        self.state = _state(spec)
+
+    def evaluate(self, reading, previous):
+        if previous is None:
+            return None
+        minutes = (reading['timestamp'] - previous['timestamp']).total_seconds() / 60
+        if minutes <= 0:
+            return None
+        rate = (reading[self.field] - previous[self.field]) / minutes
+        if self.per_minute > 0 and rate >= self.per_minute:
+            return self.state
+        if self.per_minute < 0 and rate <= self.per_minute:
+            return self.state
+        return None
+
+
+RULE_TYPES = {
+    'hysteresis': Hysteresis,
+    'schedule': Schedule,
+    'rate': RateOfChange,
+}
+
+
+class RuleSet:
+    def __init__(self, rules, min_on=timedelta(0), min_off=timedelta(0)):
+        self.rules = rules
+        self.min_on = min_on
+        self.min_off = min_off
+
+    def desired(self, reading, state, previous):
+        for rule in self.rules:
+            decision = rule.evaluate(reading, previous)
+            if decision is not None:
+                return decision
+        return state
+
+    def can_switch(self, state, changed_at, at):
+        if changed_at is None:
+            return True
+        return at - changed_at >= (self.min_on if state else self.min_off)
+
+
+def device_rules(device):
+    rules = device.get('rules')
+    if rules is None:
+        return [{
+            'type': 'hysteresis',
+            'field': 'temperature',
+            'on_above': device['temp_threshold_high'],
+            'off_below': device['temp_threshold_low'],
+        }]
+    return rules
+
+
+def compile_rules(specs):
+    # Raises ValueError with a message suitable for an API response
+    if not isinstance(specs, list):
+        raise ValueError('rules must be a list')
+    rules = []
+    min_on = min_off = timedelta(0)
+    for spec in specs:
+        if not isinstance(spec, dict):
+            raise ValueError('Each rule must be an object')
+        kind = spec.get('type')
+        if kind == 'min_duration':
+            min_on = timedelta(seconds=_number(spec, 'on', required=False) or 0)
+            min_off = timedelta(seconds=_number(spec, 'off', required=False) or 0)
+        elif kind in RULE_TYPES:
+            rules.append(RULE_TYPES[kind](spec))
+        else:
+            raise ValueError(f"Unknown rule type {kind!r}, expected one of "
+                             f"{', '.join([*RULE_TYPES, 'min_duration'])}")
+    return RuleSet(rules, min_on, min_off)
+
+
+# Compiled rules and the last reading seen, per device and process. Recompiled
+# only when the rules (or legacy thresholds) on the device document change.
+_compiled = {}
+_lock = threading.Lock()
+
+
+def get_ruleset(device):
+    specs = device_rules(device)
+    signature = repr(specs)
+    entry = _compiled.get(device['device_id'])
+    if entry is None or entry['signature'] != signature:
+        try:
+            ruleset = compile_rules(specs)
+        except ValueError:
+            # Stored rules are validated on write; never let one stop ingest
+            ruleset = RuleSet([])
+        with _lock:
+            # A fresh process picks up from the last reading stored on the device
+            previous = entry['previous'] if entry else device.get('last_reading')
+            entry = _compiled[device['device_id']] = {'signature': signature, 'ruleset': ruleset, 'previous': previous}
+    return entry
+
+
+def evaluate(device, readings):
+    # readings in timestamp order. Returns the final relay state, when it
+    # last changed and the (timestamp, state) transitions on the way.
+    state = device['relay_state']
+    changed_at = device.get('relay_changed_at')
+    transitions = []
+    entry = get_ruleset(device)
+    previous = entry['previous']
+
+    if device['auto_mode']:
+        ruleset = entry['ruleset']
+        for reading in readings:
+            desired = ruleset.desired(reading, state, previous)
+            at = reading['timestamp']
+            if desired != state and ruleset.can_switch(state, changed_at, at):
+                state, changed_at = desired, at
+                transitions.append((at, state))
+            previous = reading
+
+    if readings and (previous is None or readings[-1]['timestamp'] >= previous['timestamp']):
+        entry['previous'] = readings[-1]
+    return state, changed_at, transitions
+
+
+def switch(device, state, at):
+    # A manual change: device fields to set and the transition, if any
+    if state == device['relay_state']:
+        return {}, []
+    return {'relay_state': state, 'relay_changed_at': at}, [(at, state)]
@@ -11,7 +11,8 @@ class TelemetrySerializer(serializers.Serializer):
         return Telemetry.create(
             device_id=validated_data['device_id'],
             temperature=validated_data['temperature'],
-            humidity=validated_data['humidity']
+            humidity=validated_data['humidity'],
+            timestamp=validated_data.get('timestamp')
         )
 
 class DeviceSerializer(serializers.Serializer):
@@ -20,6 +21,8 @@ class DeviceSerializer(serializers.Serializer):
     temp_threshold_high = serializers.FloatField(default=30)
     temp_threshold_low = serializers.FloatField(default=20)
     auto_mode = serializers.BooleanField(default=True)
+    rules = serializers.ListField(child=serializers.DictField(), required=False, allow_null=True)
+    relay_changed_at = serializers.DateTimeField(required=False, allow_null=True)
     last_seen = serializers.DateTimeField(required=False)
 
     def create(self, validated_data):
@@ -36,4 +39,7 @@ class DailyLogSerializer(serializers.Serializer):
     avg_humidity = serializers.FloatField()
     min_temperature = serializers.FloatField(allow_null=True)
     max_temperature = serializers.FloatField(allow_null=True)
+    min_humidity = serializers.FloatField(allow_null=True)
+    max_humidity = serializers.FloatField(allow_null=True)
+    reading_count = serializers.IntegerField(default=0)
     fan_runtime_minutes = serializers.IntegerField()
\ No newline at end of file
@@ -0,0 +1,266 @@
+import asyncio
+import inspect
+import os
+import threading
+import time
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULTS = {
+    'backend': 'mongo',
+    'uri': None,
+    'host': 'localhost',
+    'port': 27017,
+    'db': 'iot_dashboard',
+    'max_pool_size': 100,
+    'min_pool_size': 0,
+    'max_idle_time_ms': 60000,
+    'server_selection_timeout_ms': 5000,
+    'connect_timeout_ms': 5000,
+    'socket_timeout_ms': 20000,
+    'write_concern': 1,
+    'journal': None,
+    'app_name': 'iot_dashboard',
+}
+
+# Reentrant: get_database() holds it while the mongo factory calls get_client()
+_lock = threading.RLock()
+_client = None
+_database = None
+_collections = {}
+_async_client = None
+_async_collections = {}
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'MONGODB_SETTINGS', {})}
+
+
+def client_options(config):
+    options = {
+        'maxPoolSize': config['max_pool_size'],
+        'minPoolSize': config['min_pool_size'],
+        'maxIdleTimeMS': config['max_idle_time_ms'],
+        'serverSelectionTimeoutMS': config['server_selection_timeout_ms'],
+        'connectTimeoutMS': config['connect_timeout_ms'],
+        'socketTimeoutMS': config['socket_timeout_ms'],
+        'w': config['write_concern'],
+        'appname': config['app_name'],
+        # Don't open sockets until the first operation
+        'connect': False,
+    }
+    if config['journal'] is not None:
+        options['journal'] = config['journal']
+    return options
+
+
+def connect(client_class, config):
+    if config['uri']:
+        return client_class(config['uri'], **client_options(config))
+    return client_class(config['host'], config['port'], **client_options(config))
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                from pymongo import MongoClient
+                _client = connect(MongoClient, get_settings())
+    return _client
+
+
+def mongo_database(config):
+    return get_client()[config['db']]
+
+
+def memory_database(config):
+    from .memstore import MemoryDatabase
+    return MemoryDatabase(config['db'])
+
+
+BACKENDS = {
+    'mongo': mongo_database,
+    'memory': memory_database,
+}
+
+
+def get_database():
+    global _database
+    if _database is None:
+        with _lock:
+            if _database is None:
+                config = get_settings()
+                backend = os.environ.get('IOT_STORAGE_BACKEND', config['backend'])
+                factory = BACKENDS.get(backend) or import_string(backend)
+                _database = factory(config)
+    return _database
+
+
+def reset():
+    # Drop the cached client and database, e.g. after changing settings
+    global _client, _database, _async_client
+    with _lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _database = None
+        _collections.clear()
+        # The async client is bound to the event loop that used it; drop the
+        # reference and let that loop close it
+        _async_client = None
+        _async_collections.clear()
+
+
+class Collection:
+    # Resolves the collection on first use instead of at import time
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        collection = _collections.get(self.name)
+        if collection is None:
+            from .instrumentation import InstrumentedCollection, get_settings as instrumentation_settings
+            collection = get_database()[self.name]
+            if instrumentation_settings()['enabled']:
+                collection = InstrumentedCollection(collection)
+            _collections[self.name] = collection
+        return collection
+
+
+def async_client_class():
+    # PyMongo's native asyncio client (4.10+), then Motor, else None
+    try:
+        from pymongo import AsyncMongoClient
+        return AsyncMongoClient
+    except ImportError:
+        pass
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient
+    except ImportError:
+        return None
+
+
+def get_async_collection(name):
+    global _async_client
+    collection = _async_collections.get(name)
+    if collection is None:
+        with _lock:
+            config = get_settings()
+            backend = os.environ.get('IOT_STORAGE_BACKEND', config['backend'])
+            client_class = async_client_class() if backend == 'mongo' else None
+            if client_class is not None:
+                if _async_client is None:
+                    _async_client = connect(client_class, config)
+                collection = NativeAsyncCollection(_async_client[config['db']][name])
+            else:
+                collection = ThreadedAsyncCollection(name)
+            _async_collections[name] = collection
+    return collection
+
+
+class NativeAsyncCollection:
+    # The subset of the collection API the models use, on an asyncio driver.
+    # Reads return lists so callers don't depend on driver cursor types.
+
+    def __init__(self, collection):
+        from .instrumentation import get_settings as instrumentation_settings
+        self.collection = collection
+        self.name = collection.name
+        self.instrumented = instrumentation_settings()['enabled']
+
+    async def _run(self, operation, spec, awaitable):
+        started = time.perf_counter()
+        result = await awaitable
+        if self.instrumented:
+            from .instrumentation import record_operation
+            if isinstance(result, list):
+                docs = len(result)
+            else:
+                docs = 1 if operation == 'find_one' and result is not None else 0
+            record_operation(self.name, operation, time.perf_counter() - started, docs, spec)
+        return result
+
+    async def _find(self, filter, projection, sort, limit):
+        cursor = self.collection.find(filter, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(None)
+
+    async def _aggregate(self, pipeline):
+        # PyMongo's aggregate is a coroutine, Motor's returns the cursor
+        cursor = self.collection.aggregate(pipeline)
+        if inspect.isawaitable(cursor):
+            cursor = await cursor
+        return await cursor.to_list(None)
+
+    def find_one(self, filter, projection=None):
+        return self._run('find_one', filter, self.collection.find_one(filter, projection))
+
+    def find(self, filter, projection=None, sort=None, limit=0):
+        return self._run('find', filter, self._find(filter, projection, sort, limit))
+
+    def aggregate(self, pipeline):
+        return self._run('aggregate', pipeline, self._aggregate(pipeline))
+
+    def insert_many(self, documents, ordered=True):
+        return self._run('insert_many', None, self.collection.insert_many(documents, ordered=ordered))
+
+    def bulk_write(self, requests, ordered=True):
+        return self._run('bulk_write', f'{len(requests)} ops', self.collection.bulk_write(requests, ordered=ordered))
+
+    def find_one_and_update(self, filter, update, **kwargs):
+        return self._run('find_one_and_update', filter, self.collection.find_one_and_update(filter, update, **kwargs))
+
+
+class ThreadedAsyncCollection:
+    # Same interface for backends without an async driver (the memory store,
+    # or PyMongo without asyncio support): sync calls on a worker thread
+
+    def __init__(self, name):
+        self.name = name
+        self.descriptor = Collection(name)
+
+    @property
+    def collection(self):
+        return self.descriptor.__get__(None, None)
+
+    def _find(self, filter, projection, sort, limit):
+        cursor = self.collection.find(filter, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    async def find_one(self, filter, projection=None):
+        return await asyncio.to_thread(self.collection.find_one, filter, projection)
+
+    async def find(self, filter, projection=None, sort=None, limit=0):
+        return await asyncio.to_thread(self._find, filter, projection, sort, limit)
+
+    async def aggregate(self, pipeline):
+        return await asyncio.to_thread(lambda: list(self.collection.aggregate(pipeline)))
+
+    async def insert_many(self, documents, ordered=True):
+        return await asyncio.to_thread(self.collection.insert_many, documents, ordered=ordered)
+
+    async def bulk_write(self, requests, ordered=True):
+        return await asyncio.to_thread(self.collection.bulk_write, requests, ordered=ordered)
+
+    async def find_one_and_update(self, filter, update, **kwargs):
+        return await asyncio.to_thread(self.collection.find_one_and_update, filter, update, **kwargs)
+
+
+class AsyncCollection:
+    # Async counterpart of Collection, resolved on first use
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return get_async_collection(self.name)
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from iot_app import anomaly, ingest, rules, storage
+from iot_app.cache import reset_device_cache
+from iot_app.indexes import ensure_indexes
+from iot_app.models import RollupWatermark
+
+# Every test runs against a fresh in-memory store, so no MongoDB server is
+# needed. Features that change what gets stored are off unless a test turns
+# them on.
+MEMORY_STORAGE = {'backend': 'memory', 'db': 'iot_test', 'auto_index': False}
+
+
+@override_settings(
+    MONGODB_SETTINGS=MEMORY_STORAGE,
+    IOT_INGEST={'mode': 'sync'},
+    IOT_ROLLUPS={'enabled': False},
+    IOT_ANOMALY={'enabled': False},
+    IOT_ARCHIVE={'enabled': True},
+)
+class StoreTestCase(TestCase):
+
+    def setUp(self):
+        storage.reset()
+        self.clear_caches()
+        ensure_indexes()
+        self.addCleanup(self.stop_ingest_queue)
+
+    @staticmethod
+    def clear_caches():
+        # Per-process state, as after a restart
+        reset_device_cache()
+        caches['default'].clear()
+        rules._compiled.clear()
+        anomaly.reset_detector()
+        RollupWatermark.reset()
+
+    @staticmethod
+    def stop_ingest_queue():
+        if ingest._queue is not None:
+            ingest._queue.stop()
+            ingest._queue = None
+
+    @staticmethod
+    def reading(device_id='dev-1', timestamp=None, temperature=25.0, humidity=50.0):
+        reading = {'device_id': device_id, 'temperature': temperature, 'humidity': humidity}
+        if timestamp is not None:
+            reading['timestamp'] = timestamp
+        return reading
+
+    @staticmethod
+    def hours_ago(hours, now=None):
+        # Safely inside a closed bucket of any size up to an hour
+        now = (now or datetime.now()).replace(minute=0, second=0, microsecond=0)
+        return now - timedelta(hours=hours) + timedelta(minutes=30)
+
+    def post_json(self, path, data, **extra):
+        return self.client.post(path, data, content_type='application/json', **extra)
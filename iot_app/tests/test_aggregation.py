@@ -0,0 +1,165 @@
+import io
+from datetime import datetime, timedelta
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from iot_app.aggregation import bucket_readings, bucket_window, build_series, parse_duration, resolve_window
+from iot_app.ingest import ingest_readings
+from iot_app.models import HourRollup, RollupWatermark, Telemetry
+from .base import StoreTestCase
+
+
+class WindowTests(SimpleTestCase):
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('90s'), timedelta(seconds=90))
+        self.assertEqual(parse_duration('2w'), timedelta(weeks=2))
+        for value in ('', '0h', '1y', 'h', '-1h'):
+            with self.assertRaises(ValueError):
+                parse_duration(value)
+
+    def test_resolve_window_defaults(self):
+        self.assertEqual(resolve_window('24h'), (timedelta(hours=24), timedelta(hours=1)))
+        self.assertEqual(resolve_window('7d'), (timedelta(days=7), timedelta(days=1)))
+        # Other spans pick the smallest ladder step giving at most 24 buckets
+        self.assertEqual(resolve_window('2h')[1], timedelta(minutes=5))
+
+    def test_resolve_window_rejects_too_many_buckets(self):
+        with self.assertRaises(ValueError):
+            resolve_window('30d', '1m')
+
+    def test_bucket_window_is_aligned(self):
+        now = datetime(2026, 3, 4, 10, 17, 30)
+        start, count = bucket_window(now, timedelta(hours=1), timedelta(minutes=10))
+        self.assertEqual(start, datetime(2026, 3, 4, 9, 10))
+        self.assertEqual(count, 7)
+
+    def test_build_series_fills_empty_buckets(self):
+        start = datetime(2026, 3, 4)
+        readings = [
+            {'timestamp': start + timedelta(minutes=5), 'temperature': 20.0, 'humidity': 40.0},
+            {'timestamp': start + timedelta(minutes=7), 'temperature': 22.0, 'humidity': 44.0},
+        ]
+        series = build_series(start, timedelta(minutes=10), 3, bucket_readings(readings, start, timedelta(minutes=10)))
+        self.assertEqual([point['count'] for point in series], [2, 0, 0])
+        self.assertEqual(series[0]['temperature'], 21.0)
+        self.assertEqual(series[0]['min_humidity'], 40.0)
+        self.assertEqual(series[0]['max_humidity'], 44.0)
+        self.assertIsNone(series[1]['min_temperature'])
+
+
+class BucketQueryTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.start = self.hours_ago(6).replace(minute=0)
+        self.readings = [
+            self.reading(device_id, self.start + timedelta(minutes=7 * i), 20 + i % 5, 40 + i % 3)
+            for i in range(40) for device_id in ('dev-1', 'dev-2')
+        ]
+        ingest_readings(self.readings)
+
+    def test_pipeline_matches_in_memory_bucketing(self):
+        bucket = timedelta(minutes=30)
+        end = self.start + timedelta(hours=5)
+        expected = bucket_readings(
+            [r for r in self.readings if r['device_id'] == 'dev-1' and r['timestamp'] < end], self.start, bucket
+        )
+        self.assertEqual(Telemetry.aggregate_buckets(self.start, end, bucket, 'dev-1'), expected)
+
+    def test_all_devices(self):
+        partials = Telemetry.aggregate_buckets(self.start, self.start + timedelta(hours=6), timedelta(hours=1))
+        self.assertEqual(sum(p['count'] for p in partials.values()), len(self.readings))
+
+    def test_history_endpoint(self):
+        response = self.client.get('/api/telemetry/', {'timespan': '24h', 'device_id': 'dev-1'})
+        self.assertEqual(response.status_code, 200)
+        series = response.json()
+        self.assertEqual(len(series), 25)
+        self.assertEqual(sum(point['count'] for point in series), 40)
+
+    def test_invalid_window(self):
+        response = self.client.get('/api/telemetry/', {'timespan': 'soon'})
+        self.assertEqual(response.status_code, 400)
+
+
+class RollupTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Three days of readings stored before rollups were turned on, the
+        # last one at least ten minutes ago
+        start = self.hours_ago(72)
+        ingest_readings([
+            self.reading(device_id, start + timedelta(minutes=20 * i), 18 + i % 7, 45 + i % 4)
+            for i in range(3 * 72 - 1) for device_id in ('dev-1', 'dev-2')
+        ])
+
+    def history(self):
+        self.clear_caches()
+        return {
+            timespan: self.client.get('/api/telemetry/', {'timespan': timespan, 'device_id': 'dev-1'}).json()
+            for timespan in ('24h', '7d')
+        }
+
+    def test_enabling_rollups_keeps_history(self):
+        before = self.history()
+        with self.settings(IOT_ROLLUPS={'enabled': True}):
+            ingest_readings([self.reading('dev-3')])
+            self.assertEqual(self.history(), before)
+
+            start, end = self.hours_ago(48).replace(minute=0), self.hours_ago(0)
+            self.assertEqual(
+                async_to_sync(Telemetry.aaggregate_buckets)(start, end, timedelta(hours=1), 'dev-1'),
+                Telemetry.aggregate_buckets(start, end, timedelta(hours=1), 'dev-1'),
+            )
+
+    @override_settings(IOT_ROLLUPS={'enabled': True})
+    def test_backfill_moves_the_watermark(self):
+        ingest_readings([self.reading('dev-3')])
+        before = self.history()
+        call_command('backfill_rollups', '--since', '7d', stdout=io.StringIO())
+        self.assertLess(RollupWatermark.complete_from(HourRollup), self.hours_ago(72))
+        self.assertEqual(self.history(), before)
+
+        # Served from the tiers now, the raw readings aren't read
+        Telemetry.collection.delete_many({})
+        self.assertEqual(self.history(), before)
+
+    @override_settings(IOT_ROLLUPS={'enabled': True})
+    def test_backfill_stops_at_the_watermark(self):
+        # Ingest maintains the tier from the watermark on; the backfill
+        # must not overwrite what it added there
+        ingest_readings([self.reading('dev-3')])
+        watermark = self.hours_ago(3).replace(minute=0)
+        RollupWatermark.collection.update_one({'_id': 'telemetry_1h'}, {'$set': {'complete_from': watermark}})
+        HourRollup.collection.update_one(
+            {'device_id': 'dev-1', 'bucket': watermark}, {'$set': {'count': 999}}, upsert=True
+        )
+        call_command('backfill_rollups', '--since', '7d', stdout=io.StringIO())
+        self.assertEqual(HourRollup.collection.find_one({'device_id': 'dev-1', 'bucket': watermark})['count'], 999)
+        before = HourRollup.collection.find_one({'device_id': 'dev-1', 'bucket': watermark - timedelta(hours=1)})
+        self.assertEqual(before['count'], 3)
+
+    def test_split_at_the_watermark(self):
+        start = self.hours_ago(48).replace(minute=0)
+        bucket = timedelta(hours=6)
+        with self.settings(IOT_ROLLUPS={'enabled': True}):
+            ingest_readings([self.reading('dev-3')])
+            expected = Telemetry.aggregate_buckets(start, start + 8 * bucket, bucket)
+            # Complete from the middle of the third bucket: two buckets come
+            # from raw readings
+            HourRollup.rebuild(start, start + 8 * bucket)
+            complete_from = start + 2 * bucket + timedelta(hours=3)
+            RollupWatermark.collection.update_one({'_id': 'telemetry_1h'}, {'$set': {'complete_from': complete_from}})
+            RollupWatermark.reset()
+            self.assertEqual(Telemetry.rollup_split(start, start + 8 * bucket, bucket, complete_from), start + 3 * bucket)
+            Telemetry.collection.delete_many({'timestamp': {'$gte': start + 3 * bucket}})
+            self.assertEqual(Telemetry.aggregate_buckets(start, start + 8 * bucket, bucket), expected)
+
+    def test_disabling_rollups_drops_the_watermark(self):
+        with self.settings(IOT_ROLLUPS={'enabled': True}):
+            ingest_readings([self.reading()])
+        self.assertIsNotNone(RollupWatermark.collection.find_one({'_id': 'telemetry_1h'}))
+        ingest_readings([self.reading()])
+        self.assertIsNone(RollupWatermark.collection.find_one({'_id': 'telemetry_1h'}))
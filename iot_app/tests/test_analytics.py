@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+from unittest import mock
+from django.test import override_settings
+from iot_app import analytics
+from iot_app.aggregation import bucket_window
+from iot_app.ingest import ingest_readings
+from iot_app.models import DayRollup, HourRollup, RollupWatermark, Telemetry
+from .base import StoreTestCase
+
+
+class AnalyticsTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.now = datetime.now()
+        self.start, _ = bucket_window(self.now, timedelta(days=3), timedelta(days=1))
+        # Readings every 20 minutes over three days, dev-2 only on the first
+        ingest_readings([
+            self.reading(device_id, self.start + timedelta(minutes=20 * i), 18 + i % 7, 45 + i % 4)
+            for i in range(3 * 72) for device_id in ('dev-1', 'dev-2')
+            if device_id == 'dev-1' or i < 72
+        ])
+
+    def analyze(self, bucket, device_ids=None):
+        return analytics.analyze(self.start, self.now, bucket, bucket, device_ids)
+
+    def test_columns_are_ordered_by_device(self):
+        columns = analytics.fetch_columns(self.start, self.now)
+        self.assertEqual(list(columns['device_id']), ['dev-1'] * 216 + ['dev-2'] * 72)
+        self.assertTrue((columns['time'][1:216] > columns['time'][:215]).all())
+        with mock.patch.object(analytics, 'MAX_RAW_ROWS', 100):
+            self.assertIsNone(analytics.fetch_columns(self.start, self.now))
+
+    def test_rollup_matches_raw(self):
+        raw = self.analyze(timedelta(hours=6))
+        self.assertEqual(raw['source'], 'raw')
+        with mock.patch.object(analytics, 'MAX_RAW_ROWS', 100):
+            rolled = self.analyze(timedelta(hours=6))
+        self.assertEqual(rolled['source'], HourRollup.collection.name)
+        for expected, device in zip(raw['devices'], rolled['devices']):
+            self.assertEqual(device['count'], expected['count'])
+            for field in ('temperature', 'humidity'):
+                for key in ('mean', 'min', 'max'):
+                    self.assertAlmostEqual(device[field][key], expected[field][key])
+            self.assertEqual(device['series'], expected['series'])
+
+    @override_settings(IOT_ROLLUPS={'enabled': True})
+    def test_coarse_buckets_read_the_tier(self):
+        expected = self.analyze(timedelta(days=1))
+        ingest_readings([self.reading('dev-3')])
+        DayRollup.rebuild(self.start, self.now)
+        RollupWatermark.collection.update_one({'_id': 'telemetry_1d'}, {'$set': {'complete_from': self.start}})
+        RollupWatermark.reset()
+        # Served from the tier, the raw readings aren't read
+        Telemetry.collection.delete_many({})
+        result = self.analyze(timedelta(days=1), ['dev-1', 'dev-2'])
+        self.assertEqual(result['source'], DayRollup.collection.name)
+        self.assertEqual(
+            [device['temperature']['mean'] for device in result['devices']],
+            [device['temperature']['mean'] for device in expected['devices']],
+        )
+
+    def test_span_is_capped(self):
+        with self.assertRaises(ValueError):
+            analytics.analyze(self.now - timedelta(days=400), self.now, timedelta(days=1), timedelta(days=1))
+        response = self.client.get('/api/analytics/', {'timespan': '400d', 'bucket': '1d'})
+        self.assertEqual(response.status_code, 400)
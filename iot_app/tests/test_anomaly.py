@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+from django.test import SimpleTestCase, override_settings
+from iot_app.anomaly import DEFAULTS, Detector
+from iot_app.models import Anomaly, Device, Telemetry
+from .base import StoreTestCase
+
+START = datetime(2026, 3, 2, 12, 0)
+
+
+def readings(*values, device_id='dev-1', start=START, step=timedelta(minutes=1)):
+    # values: temperature, or (temperature, humidity)
+    docs = []
+    for i, value in enumerate(values):
+        temperature, humidity = value if isinstance(value, tuple) else (value, 50.0)
+        docs.append({
+            'device_id': device_id, 'timestamp': start + i * step,
+            'temperature': temperature, 'humidity': humidity,
+        })
+    return docs
+
+
+class DetectorTests(SimpleTestCase):
+
+    def detector(self, **config):
+        return Detector({**DEFAULTS, **config})
+
+    def kinds(self, events):
+        return [(event['kind'], event['action']) for event in events]
+
+    def test_steady_readings_pass(self):
+        accepted, events = self.detector().screen(readings(21.0, 21.2, 21.1, 21.3))
+        self.assertEqual(len(accepted), 4)
+        self.assertEqual(events, [])
+
+    def test_out_of_range_is_quarantined(self):
+        accepted, events = self.detector().screen(readings(21.0, (21.0, 120.0), 21.1))
+        self.assertEqual(len(accepted), 2)
+        self.assertEqual(self.kinds(events), [('range', 'quarantined')])
+        self.assertEqual(events[0]['field'], 'humidity')
+
+    def test_spike_is_quarantined_and_state_kept(self):
+        detector = self.detector()
+        accepted, events = detector.screen(readings(21.0, 45.0, 21.2))
+        self.assertEqual([doc['temperature'] for doc in accepted], [21.0, 21.2])
+        self.assertEqual(self.kinds(events), [('rate', 'quarantined')])
+
+    def test_genuine_jump_passes_after_enough_time(self):
+        detector = self.detector()
+        detector.screen(readings(21.0))
+        # 10 °C over an hour is within 5 °C per minute
+        accepted, events = detector.screen(readings(31.0, start=START + timedelta(hours=1)))
+        self.assertEqual(len(accepted), 1)
+        self.assertEqual(events, [])
+
+    def test_stuck_sensor_is_reported_once(self):
+        accepted, events = self.detector(stuck_count=5).screen(readings(*[21.0] * 8))
+        self.assertEqual(len(accepted), 8)
+        self.assertEqual(self.kinds(events), [('stuck', 'flagged')])
+
+    def test_zscore_flags_after_warmup(self):
+        values = [21.0 + (i % 2) * 0.1 for i in range(10)] + [23.5]
+        accepted, events = self.detector(warmup=10).screen(readings(*values))
+        self.assertEqual(len(accepted), 11)
+        self.assertEqual(self.kinds(events), [('zscore', 'flagged')])
+
+    def test_devices_are_independent(self):
+        detector = self.detector()
+        docs = readings(21.0, device_id='a') + readings(35.0, device_id='b')
+        accepted, events = detector.screen(docs)
+        self.assertEqual(len(accepted), 2)
+        self.assertEqual(events, [])
+        self.assertEqual(detector.tracked(), 2)
+
+
+@override_settings(IOT_ANOMALY={'enabled': True})
+class ScreeningTests(StoreTestCase):
+
+    def test_ingest_quarantines_faults(self):
+        start = self.hours_ago(1)
+        batch = [
+            self.reading(timestamp=(start + timedelta(minutes=i)).isoformat(), temperature=temperature)
+            for i, temperature in enumerate((21.0, 21.1, 85.0, 21.2))
+        ]
+        response = self.post_json('/api/telemetry/batch/', batch)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Telemetry.collection.count_documents({}), 3)
+        self.assertEqual(Device.get_by_id('dev-1')['last_reading']['temperature'], 21.2)
+
+        anomalies = list(Anomaly.collection.find({}))
+        self.assertEqual(len(anomalies), 1)
+        self.assertEqual(anomalies[0]['kind'], 'range')
+        self.assertEqual(anomalies[0]['value'], 85.0)
+
+    def test_anomalies_endpoint(self):
+        start = self.hours_ago(1)
+        for i, temperature in enumerate((21.0, 90.0, 21.0, -60.0)):
+            self.post_json('/api/telemetry/', self.reading(
+                timestamp=(start + timedelta(minutes=i)).isoformat(), temperature=temperature
+            ))
+        response = self.client.get('/api/anomalies/', {'device_id': 'dev-1', 'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertEqual([event['value'] for event in page['results']], [-60.0])
+        self.assertIsNotNone(page['next'])
+
+        response = self.client.get('/api/anomalies/', {'device_id': 'dev-1', 'after': page['next']})
+        self.assertEqual([event['value'] for event in response.json()['results']], [90.0])
+        self.assertEqual(self.client.get('/api/anomalies/', {'limit': 0}).status_code, 400)
@@ -0,0 +1,208 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
+from unittest import mock
+from django.core.cache import caches
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, override_settings
+from django.utils.http import http_date
+from iot_app import views
+from iot_app.cache import get_device_cache, get_history_cache
+from iot_app.ingest import aingest_readings, ingest_readings
+from iot_app.models import Device, Telemetry
+from .base import StoreTestCase
+
+
+class DeviceCacheTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Device.get_or_create('dev-1')
+
+    def test_command_reads_are_cached(self):
+        self.client.get('/api/devices/dev-1/command/')
+        # A write straight to the collection isn't seen until the entry expires
+        Device.collection.update_one({'device_id': 'dev-1'}, {'$set': {'temp_threshold_high': 99}})
+        response = self.client.get('/api/devices/dev-1/command/')
+        self.assertEqual(response.json()['temp_threshold_high'], 30)
+
+    def test_updates_write_through(self):
+        self.client.get('/api/devices/dev-1/command/')
+        self.post_json('/api/devices/dev-1/set_relay/', {'temp_threshold_high': 28})
+        payload = self.client.get('/api/devices/dev-1/command/').json()
+        self.assertEqual(payload['temp_threshold_high'], 28)
+        self.assertEqual(payload['version'], 1)
+
+    def test_ingest_patches_cached_device(self):
+        Device.get_by_id('dev-1')
+        ingest_readings([self.reading(temperature=23.5)])
+        self.assertEqual(get_device_cache().get('dev-1')['last_reading']['temperature'], 23.5)
+
+
+class RevalidationTests(StoreTestCase):
+
+    def test_command_etag(self):
+        Device.get_or_create('dev-1')
+        first = self.client.get('/api/devices/dev-1/command/')
+        etag = first['ETag']
+        self.assertEqual(self.client.get('/api/devices/dev-1/command/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.post_json('/api/devices/dev-1/set_relay/', {'auto_mode': False})
+        changed = self.client.get('/api/devices/dev-1/command/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+
+    def test_history_etag(self):
+        ingest_readings([self.reading(timestamp=self.hours_ago(2))])
+        params = {'timespan': '24h', 'device_id': 'dev-1'}
+        etag = self.client.get('/api/telemetry/', params)['ETag']
+        self.assertEqual(self.client.get('/api/telemetry/', params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_bootstrap_etag(self):
+        ingest_readings([self.reading(timestamp=self.hours_ago(2))])
+        params = {'device_id': 'dev-1', 'timespan': '24h', 'days': 7}
+        first = self.client.get('/api/bootstrap/', params)
+        self.assertEqual(first.status_code, 200)
+        body = first.json()
+        self.assertEqual(body['device']['device_id'], 'dev-1')
+        self.assertEqual(sum(body['series']['count']), 1)
+        self.assertEqual(self.client.get('/api/bootstrap/', params, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+
+@override_settings(IOT_BOOTSTRAP={'workers': 1, 'timeout': 5})
+class BootstrapPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        views._bootstrap_pool = None
+        self.addCleanup(self.shutdown_pool)
+
+    @staticmethod
+    def shutdown_pool():
+        views.get_bootstrap_pool().shutdown()
+        views._bootstrap_pool = None
+
+    def test_busy_pool_runs_calls_on_the_request_thread(self):
+        # Another request holds the only pool thread
+        release = threading.Event()
+        views.get_bootstrap_pool().submit(release.wait)
+        try:
+            started = time.monotonic()
+            results = views.gather_sync((threading.get_ident,), (threading.get_ident,), (sum, [1, 2]))
+            self.assertEqual(results, [threading.get_ident(), threading.get_ident(), 3])
+            self.assertLess(time.monotonic() - started, 1)
+        finally:
+            release.set()
+
+    def test_timeout(self):
+        running = threading.Event()
+
+        def slow():
+            running.set()
+            time.sleep(1)
+
+        with self.assertRaises(FutureTimeoutError):
+            views.gather_sync((running.wait,), (slow,), timeout=0.1)
+
+    def test_no_call_starts_after_the_deadline(self):
+        # The pool is busy, so the second call would run on the request thread
+        release = threading.Event()
+        views.get_bootstrap_pool().submit(release.wait)
+        self.addCleanup(release.set)
+        calls = []
+        with self.assertRaises(FutureTimeoutError):
+            views.gather_sync((time.sleep, 0.2), (calls.append, 1), timeout=0.1)
+        self.assertEqual(calls, [])
+
+    def test_days_are_clamped(self):
+        log_start = views.bootstrap_window({'device_id': 'dev-1', 'days': '1000000000'})[-1]
+        self.assertEqual(log_start.date(), (datetime.now() - timedelta(days=views.BOOTSTRAP_MAX_DAYS)).date())
+
+    def test_oversized_timespan_answers_400(self):
+        for timespan in ('1000000000d', '99999w'):
+            with self.subTest(timespan=timespan):
+                request = RequestFactory().get('/api/bootstrap/', {'device_id': 'dev-1', 'timespan': timespan})
+                self.assertEqual(views.bootstrap(request).status_code, 400)
+
+    def test_view_answers_504(self):
+        request = RequestFactory().get('/api/bootstrap/', {'device_id': 'dev-1'})
+        with mock.patch('iot_app.views.gather_sync', side_effect=FutureTimeoutError):
+            response = views.bootstrap(request)
+        self.assertEqual(response.status_code, 504)
+
+
+class HistoryCacheTests(StoreTestCase):
+
+    def history(self, device_id='dev-1'):
+        series = self.client.get('/api/telemetry/', {'timespan': '24h', 'device_id': device_id}).json()
+        return [point['count'] for point in series]
+
+    def test_late_reading_invalidates_closed_buckets(self):
+        at = self.hours_ago(3)
+        ingest_readings([self.reading(timestamp=at)])
+        before = self.history()
+        self.assertEqual(sum(before), 1)
+        # Served from the cache: a write that bypasses ingest isn't seen
+        Telemetry.insert_many([self.reading(timestamp=at)])
+        self.assertEqual(self.history(), before)
+        # A late reading through ingest drops the cached buckets
+        ingest_readings([self.reading(timestamp=at + timedelta(minutes=1))])
+        self.assertEqual(sum(self.history()), 3)
+
+    def test_relay_change_moves_last_modified(self):
+        Device.get_or_create('dev-1')
+        self.post_json('/api/devices/dev-1/set_relay/', {'auto_mode': False})
+        # Last touched a while ago; the client has a copy from after that
+        history = get_history_cache()
+        history.cache.set(history.state_keys('dev-1')[1], datetime.now() - timedelta(seconds=10), None)
+        since = http_date(time.time() - 5)
+        params = {'device_id': 'dev-1'}
+        self.assertEqual(self.client.get('/api/daily-logs/', params, HTTP_IF_MODIFIED_SINCE=since).status_code, 304)
+        self.post_json('/api/devices/dev-1/set_relay/', {'state': True})
+        self.assertEqual(self.client.get('/api/daily-logs/', params, HTTP_IF_MODIFIED_SINCE=since).status_code, 200)
+
+    def test_other_devices_keep_their_cache(self):
+        at = self.hours_ago(3)
+        ingest_readings([self.reading('dev-1', at), self.reading('dev-2', at)])
+        self.history('dev-2')
+        ingest_readings([self.reading('dev-1', at)])
+        self.assertEqual(sum(self.history('dev-1')), 2)
+        self.assertEqual(sum(self.history('dev-2')), 1)
+
+
+@override_settings(IOT_DEVICE_CACHE={'shared': True})
+class AsyncCacheTests(StoreTestCase):
+    # A Redis backend does network I/O in its sync methods; the async paths
+    # must go through the async cache API instead of blocking the loop
+
+    def setUp(self):
+        super().setUp()
+        ingest_readings([self.reading(timestamp=self.hours_ago(2))])
+        cache = caches['default']
+        for name in ('get', 'get_many', 'set', 'set_many', 'add', 'delete'):
+            patcher = mock.patch.object(cache, name, side_effect=self.off_loop(getattr(cache, name)))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def off_loop(method):
+        def call(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return method(*args, **kwargs)
+            raise AssertionError(f'Blocking cache call on the event loop: {method.__name__}')
+        return call
+
+    async def test_async_views(self):
+        factory = AsyncRequestFactory()
+        response = await views.telemetry_collection(factory.get('/api/telemetry/', {'timespan': '24h', 'device_id': 'dev-1'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+        response = await views.async_bootstrap(factory.get('/api/bootstrap/', {'device_id': 'dev-1'}))
+        self.assertEqual(response.status_code, 200)
+        response = await views.device_command(factory.get('/api/devices/dev-1/command/'), 'dev-1')
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_ingest(self):
+        await aingest_readings([self.reading(), self.reading('dev-2', datetime.now() - timedelta(hours=1))])
+        self.assertEqual((await Device.aget_by_id('dev-2'))['last_reading']['temperature'], 25.0)
@@ -0,0 +1,76 @@
+import asyncio
+import time
+from unittest import mock
+from asgiref.sync import sync_to_async
+from iot_app.models import Device
+from .base import StoreTestCase
+
+
+class CommandWaitTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Device.get_or_create('dev-1')
+
+    async def test_changed_version_answers_at_once(self):
+        response = await self.async_client.get('/api/devices/dev-1/command/wait/', {'version': -1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], 0)
+
+    async def test_wakes_up_on_update(self):
+        started = time.monotonic()
+        request = asyncio.ensure_future(
+            self.async_client.get('/api/devices/dev-1/command/wait/', {'version': 0, 'timeout': 10})
+        )
+        await asyncio.sleep(0.1)
+        self.assertFalse(request.done())
+        await sync_to_async(Device.update)('dev-1', {'relay_state': True})
+        response = await asyncio.wait_for(request, 5)
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertTrue(payload['relay'])
+        self.assertEqual(payload['version'], 1)
+        self.assertLess(time.monotonic() - started, 5)
+
+    async def test_recheck_sees_updates_from_other_processes(self):
+        # Written straight to the database: no event, and the device cache
+        # still holds the old document
+        await sync_to_async(Device.get_by_id)('dev-1')
+        with mock.patch('iot_app.views.COMMAND_WAIT_RECHECK', 0.05):
+            request = asyncio.ensure_future(
+                self.async_client.get('/api/devices/dev-1/command/wait/', {'version': 0, 'timeout': 10})
+            )
+            await asyncio.sleep(0.1)
+            await sync_to_async(Device.collection.update_one)(
+                {'device_id': 'dev-1'}, {'$set': {'relay_state': True}, '$inc': {'state_version': 1}}
+            )
+            response = await asyncio.wait_for(request, 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], 1)
+
+    async def test_times_out_unchanged(self):
+        response = await self.async_client.get('/api/devices/dev-1/command/wait/', {'version': 0, 'timeout': 0.2})
+        self.assertEqual(response.status_code, 304)
+        self.assertTrue(response['ETag'])
+
+    async def test_unknown_device(self):
+        response = await self.async_client.get('/api/devices/nope/command/wait/', {'timeout': 0.1})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_invalid_version(self):
+        response = await self.async_client.get('/api/devices/dev-1/command/wait/', {'version': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_invalid_timeout(self):
+        for timeout in ('x', 'nan', 'inf', '-inf'):
+            with self.subTest(timeout=timeout):
+                response = await self.async_client.get(
+                    '/api/devices/dev-1/command/wait/', {'version': 0, 'timeout': timeout}
+                )
+                self.assertEqual(response.status_code, 400)
+
+    async def test_negative_timeout_answers_at_once(self):
+        response = await asyncio.wait_for(
+            self.async_client.get('/api/devices/dev-1/command/wait/', {'version': 0, 'timeout': -5}), 2
+        )
+        self.assertEqual(response.status_code, 304)
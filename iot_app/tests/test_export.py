@@ -0,0 +1,81 @@
+import csv
+import io
+import json
+from datetime import timedelta
+from iot_app.models import Telemetry
+from .base import StoreTestCase
+
+
+class ExportTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        start = self.hours_ago(3)
+        Telemetry.insert_many([
+            {'device_id': f'dev-{i % 2}', 'timestamp': start + timedelta(minutes=i),
+             'temperature': 20 + i / 10, 'humidity': 50.0}
+            for i in range(25)
+        ])
+
+    def export(self, **params):
+        response = self.client.get('/api/telemetry/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        response, body = self.export()
+        rows = list(csv.reader(io.StringIO(body)))
+        self.assertEqual(rows[0], ['device_id', 'timestamp', 'temperature', 'humidity'])
+        self.assertEqual(len(rows), 26)
+        self.assertNotIn('next_cursor', body)
+
+    def test_csv_page_ends_with_the_cursor(self):
+        _, body = self.export(limit=10)
+        lines = body.splitlines()
+        self.assertEqual(len(lines), 12)
+        self.assertTrue(lines[-1].startswith('# next_cursor='))
+        _, rest = self.export(limit=100, after=lines[-1].split('=', 1)[1])
+        self.assertEqual(len(list(csv.reader(io.StringIO(rest)))), 16)
+
+    def test_ndjson_device(self):
+        _, body = self.export(format='ndjson', device_id='dev-1')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(len(rows), 12)
+        self.assertEqual({row['device_id'] for row in rows}, {'dev-1'})
+
+    def test_pages_follow_the_cursor(self):
+        seen, after = [], None
+        while True:
+            params = {'format': 'ndjson', 'limit': 10}
+            if after:
+                params['after'] = after
+            _, body = self.export(**params)
+            lines = [json.loads(line) for line in body.splitlines()]
+            after = lines.pop()['next_cursor'] if lines and 'next_cursor' in lines[-1] else None
+            seen += [line['timestamp'] for line in lines]
+            if after is None:
+                break
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_arrow_page_carries_the_cursor(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        response = self.client.get('/api/telemetry/export/', {'format': 'arrow', 'limit': 10})
+        reader = pa.ipc.open_stream(b''.join(response.streaming_content))
+        rows, metadata = 0, None
+        while True:
+            try:
+                batch, metadata = reader.read_next_batch_with_custom_metadata()
+            except StopIteration:
+                break
+            rows += batch.num_rows
+        self.assertEqual(rows, 10)
+        self.assertIn(b'next_cursor', dict(metadata))
+
+        for params in ({'format': 'xml'}, {'start': 'yesterday'}, {'after': 'garbage'},
+                       {'limit': 'ten'}, {'limit': -1}, {'limit': 10 ** 9}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get('/api/telemetry/export/', params).status_code, 400)
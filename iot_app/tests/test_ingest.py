@@ -0,0 +1,145 @@
+from datetime import timedelta
+from unittest import mock
+from django.test import override_settings
+from iot_app.ingest import MAX_BATCH_SIZE, IngestBatch, IngestQueue, get_ingest_queue
+from iot_app.models import DailyLog, Device, Telemetry
+from .base import StoreTestCase
+
+
+class IngestTests(StoreTestCase):
+
+    def test_create(self):
+        response = self.post_json('/api/telemetry/', self.reading(temperature=26.5))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Telemetry.collection.count_documents({'device_id': 'dev-1'}), 1)
+        device = Device.get_by_id('dev-1')
+        self.assertEqual(device['last_reading']['temperature'], 26.5)
+
+    def test_create_invalid(self):
+        response = self.post_json('/api/telemetry/', {'device_id': 'dev-1', 'temperature': 'warm'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Telemetry.collection.count_documents({}), 0)
+
+    def test_batch(self):
+        start = self.hours_ago(2)
+        readings = [
+            self.reading(f'dev-{i % 3}', (start + timedelta(minutes=i)).isoformat(), 20 + i % 4)
+            for i in range(30)
+        ]
+        response = self.post_json('/api/telemetry/batch/', readings)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'inserted': 30})
+        self.assertEqual(Telemetry.collection.count_documents({}), 30)
+        self.assertEqual(len(Device.get_all()), 3)
+
+        day = start.replace(hour=0, minute=0)
+        log = DailyLog.collection.find_one({'device_id': 'dev-0', 'date': day})
+        self.assertEqual(log['reading_count'], 10)
+        self.assertEqual(log['min_temperature'], 20)
+        self.assertEqual(log['max_temperature'], 23)
+
+    def test_batch_object_form(self):
+        response = self.post_json('/api/telemetry/batch/', {'readings': [self.reading()]})
+        self.assertEqual(response.status_code, 201)
+
+    def test_batch_rejects_bad_bodies(self):
+        self.assertEqual(self.post_json('/api/telemetry/batch/', {'device_id': 'x'}).status_code, 400)
+        too_many = [self.reading()] * (MAX_BATCH_SIZE + 1)
+        self.assertEqual(self.post_json('/api/telemetry/batch/', too_many).status_code, 400)
+        # One invalid reading rejects the whole batch
+        response = self.post_json('/api/telemetry/batch/', [self.reading(), {'device_id': 'dev-1'}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Telemetry.collection.count_documents({}), 0)
+
+    def test_last_reading_keeps_newest(self):
+        newer, older = self.hours_ago(1), self.hours_ago(3)
+        self.post_json('/api/telemetry/', self.reading(timestamp=newer.isoformat(), temperature=24))
+        self.post_json('/api/telemetry/', self.reading(timestamp=older.isoformat(), temperature=21))
+        device = Device.collection.find_one({'device_id': 'dev-1'})
+        self.assertEqual(device['last_seen'], newer)
+        self.assertEqual(device['last_reading']['temperature'], 24)
+
+
+@override_settings(IOT_INGEST={'mode': 'queue', 'flush_size': 10, 'flush_interval': 0.05})
+class IngestQueueTests(StoreTestCase):
+
+    def test_queued_readings_are_written(self):
+        response = self.post_json('/api/telemetry/batch/', [self.reading(f'dev-{i}') for i in range(25)])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.post_json('/api/telemetry/', self.reading()).status_code, 202)
+        queue = get_ingest_queue()
+        queue.stop()
+        self.assertEqual(Telemetry.collection.count_documents({}), 26)
+        stats = queue.stats()
+        self.assertEqual((stats['accepted'], stats['written'], stats['depth']), (26, 26, 0))
+
+    @override_settings(IOT_INGEST={'mode': 'queue', 'queue_size': 5, 'flush_interval': 60})
+    def test_full_queue_answers_429(self):
+        self.assertEqual(self.post_json('/api/telemetry/batch/', [self.reading()] * 5).status_code, 202)
+        response = self.post_json('/api/telemetry/', self.reading())
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_queue_stats_endpoint(self):
+        response = self.client.get('/api/telemetry/queue/')
+        self.assertEqual(response.json()['mode'], 'queue')
+
+    def failing_queue(self, failures, target=Telemetry, method='insert_many'):
+        # `method` fails `failures` times, then goes through
+        calls = []
+        original = getattr(target, method)
+
+        def write(*args):
+            calls.append(len(args[-1]))
+            if len(calls) <= failures:
+                raise ConnectionError('database down')
+            return original(*args)
+
+        patcher = mock.patch.object(target, method, side_effect=write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        queue = IngestQueue(flush_size=10, flush_interval=0.01, retry_limit=2, retry_backoff=0.01).start()
+        self.addCleanup(queue.stop)
+        return queue, calls
+
+    def test_failed_write_is_retried(self):
+        queue, calls = self.failing_queue(2)
+        self.assertTrue(queue.put_many([self.reading(f'dev-{i}') for i in range(3)]))
+        queue.stop()
+        self.assertEqual(calls, [3, 3, 3])
+        self.assertEqual(Telemetry.collection.count_documents({}), 3)
+        stats = queue.stats()
+        self.assertEqual((stats['written'], stats['retries'], stats['dropped']), (3, 2, 0))
+
+    def test_batch_is_dropped_after_retry_limit(self):
+        queue, calls = self.failing_queue(3)
+        queue.put_many([self.reading(f'dev-{i}') for i in range(3)])
+        queue.stop()
+        self.assertEqual(calls, [3, 3, 3])
+        self.assertEqual(Telemetry.collection.count_documents({}), 0)
+        stats = queue.stats()
+        self.assertEqual((stats['written'], stats['failed'], stats['dropped']), (0, 9, 3))
+
+    def test_retry_resumes_at_the_failed_step(self):
+        # Telemetry and device writes went through before the failure
+        queue, calls = self.failing_queue(1, Device, 'updated_many')
+        screen = mock.patch('iot_app.ingest.screen', side_effect=lambda docs: (docs, []))
+        screened = screen.start()
+        self.addCleanup(screen.stop)
+        queue.put_many([self.reading('dev-1', temperature=20 + i) for i in range(3)])
+        queue.stop()
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(screened.call_count, 1)
+        self.assertEqual(Telemetry.collection.count_documents({}), 3)
+        self.assertEqual(sum(log['reading_count'] for log in DailyLog.collection.find()), 3)
+        self.assertEqual(queue.stats()['retries'], 1)
+
+    def test_retried_insert_skips_readings_already_stored(self):
+        batch = IngestBatch([self.reading('dev-1'), self.reading('dev-2')])
+        # The first reading made it in on an attempt that then lost its connection
+        Telemetry.collection.insert_many([dict(batch.docs[0])])
+        batch._uncertain.add('telemetry')
+        batch.write()
+        self.assertEqual(Telemetry.collection.count_documents({}), 2)
+        self.assertEqual(sum(log['reading_count'] for log in DailyLog.collection.find()), 2)
+
@@ -0,0 +1,227 @@
+import asyncio
+import socket
+import threading
+import time
+from collections import Counter
+from multiprocessing.connection import Client, Listener
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, override_settings
+from iot_app import ingest
+from iot_app.models import Telemetry
+from iot_app.partition import HashRing, PartitionClient, PartitionWorker, authkey, worker_address
+from .base import StoreTestCase
+
+
+def free_ports(count):
+    # First of `count` consecutive ports that are free right now
+    while True:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        try:
+            for offset in range(1, count):
+                with socket.socket() as probe:
+                    probe.bind(('127.0.0.1', port + offset))
+        except OSError:
+            continue
+        return port
+
+
+class HashRingTests(SimpleTestCase):
+    devices = [f'dev-{i}' for i in range(4000)]
+
+    def test_stable(self):
+        first, second = HashRing(4), HashRing(4)
+        self.assertEqual([first.node(d) for d in self.devices], [second.node(d) for d in self.devices])
+
+    def test_balanced(self):
+        counts = Counter(HashRing(4).node(d) for d in self.devices)
+        self.assertEqual(set(counts), {0, 1, 2, 3})
+        for count in counts.values():
+            self.assertLess(abs(count - 1000), 250)
+
+    def test_adding_a_node_moves_few_devices(self):
+        before, after = HashRing(4), HashRing(5)
+        moved = [d for d in self.devices if before.node(d) != after.node(d)]
+        # About 1/5 of the devices, all of them to the new node
+        self.assertLess(len(moved), len(self.devices) * 0.3)
+        self.assertEqual({after.node(d) for d in moved}, {4})
+
+    def test_split_keeps_order(self):
+        readings = [{'device_id': d} for d in self.devices[:50] * 2]
+        parts = HashRing(3).split(readings)
+        self.assertEqual(sorted(i for indexes in parts.values() for i in indexes), list(range(100)))
+        for node, indexes in parts.items():
+            self.assertEqual(indexes, sorted(indexes))
+            self.assertEqual({HashRing(3).node(readings[i]['device_id']) for i in indexes}, {node})
+
+
+class PartitionTests(StoreTestCase):
+    workers = 2
+
+    def setUp(self):
+        super().setUp()
+        self.config = self.partition_config()
+        self.nodes = [self.start_worker(self.config, index) for index in range(self.workers)]
+        override = override_settings(IOT_INGEST=self.config)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def partition_config(self):
+        return {
+            **ingest.DEFAULTS, 'mode': 'partitioned', 'workers': self.workers,
+            'partition_address': ('127.0.0.1', free_ports(self.workers)),
+            'flush_size': 10, 'flush_interval': 0.05,
+        }
+
+    def start_worker(self, config, index):
+        # PartitionWorker.serve() without its signal handlers, which only
+        # work in the main thread
+        worker = PartitionWorker(index, config)
+        worker.listener = Listener(worker_address(config, index), backlog=128, authkey=authkey(config))
+        worker.queue.start()
+        threading.Thread(target=worker.accept_loop, daemon=True).start()
+        self.addCleanup(self.stop_worker, worker)
+        return worker
+
+    @staticmethod
+    def stop_worker(worker):
+        worker.stop()
+        worker.listener.close()
+        worker.queue.stop(timeout=None)
+
+    def drain(self):
+        for worker in self.nodes:
+            worker.queue.stop(timeout=None)
+
+    def test_readings_reach_their_owner(self):
+        client = PartitionClient(self.config)
+        self.addCleanup(client.stop)
+        devices = [f'dev-{i}' for i in range(20)]
+        self.assertTrue(client.put_many([self.reading(d) for d in devices]))
+        stats = client.stats()
+        self.assertEqual(stats['reachable'], self.workers)
+        self.assertEqual(stats['accepted'], 20)
+        self.assertEqual(stats['misrouted'], 0)
+
+        self.drain()
+        self.assertEqual(Telemetry.collection.count_documents({}), 20)
+        owners = Counter(client.ring.node(d) for d in devices)
+        for worker in self.nodes:
+            self.assertEqual(worker.queue.stats()['written'], owners[worker.index])
+
+    def test_ingest_endpoint_routes_through_workers(self):
+        response = self.post_json('/api/telemetry/batch/', [self.reading(f'dev-{i}') for i in range(6)])
+        self.assertEqual(response.status_code, 202)
+        self.drain()
+        self.assertEqual(Telemetry.collection.count_documents({}), 6)
+
+    def test_client_follows_the_workers_ring(self):
+        client = PartitionClient({**self.config, 'workers': 5})
+        self.addCleanup(client.stop)
+        self.assertTrue(client.put(self.reading()))
+        self.assertEqual(client.ring.nodes, self.workers)
+
+    def test_ring_replaced_mid_batch(self):
+        # Settings disagree with the running worker on the ring. Node 0 is
+        # down, so the handshake that corrects it happens mid-batch.
+        config = {**self.partition_config(), 'partition_address': ('127.0.0.1', free_ports(3))}
+        worker = self.start_worker(config, 1)
+        client = PartitionClient({**config, 'workers': 3, 'partition_replicas': 4})
+        self.addCleanup(client.stop)
+        readings = [self.reading(f'dev-{i}') for i in range(40)]
+        rejected = client.put_batch(readings)
+        self.assertEqual(client.ring.nodes, 2)
+        # Only readings that node 1 owns were sent to it
+        self.assertEqual(worker.misrouted, 0)
+        accepted = set(range(len(readings))) - set(rejected)
+        self.assertTrue(accepted)
+        self.assertEqual({client.ring.node(readings[i]['device_id']) for i in accepted}, {1})
+
+    def test_unknown_message_closes_the_connection(self):
+        for message in (('bogus',), 42, ()):
+            with Client(worker_address(self.config, 0), authkey=authkey(self.config)) as conn:
+                self.assertEqual(conn.recv()[0], 'hello')
+                conn.send(message)
+                self.assertTrue(conn.poll(5))
+                self.assertEqual(conn.recv(), ('error', 'unknown message'))
+                self.assertTrue(conn.poll(5))
+                with self.assertRaises(EOFError):
+                    conn.recv()
+
+    def test_partly_accepted_batch_lists_the_rejected_readings(self):
+        config = self.partition_config()
+        self.start_worker(config, 0)
+        client = PartitionClient(config)
+        self.addCleanup(client.stop)
+        readings = [self.reading(f'dev-{i}') for i in range(20)]
+        rejected = client.put_batch(readings)
+        self.assertEqual(rejected, [i for i, r in enumerate(readings) if client.ring.node(r['device_id']) == 1])
+
+        ingest._queue = client
+        response = self.post_json('/api/telemetry/batch/', readings)
+        self.assertEqual(response.status_code, 429)
+        body = response.json()
+        self.assertEqual(body['rejected'], rejected)
+        self.assertEqual(body['queued'], 20 - len(rejected))
+
+    def test_stalled_worker_times_out(self):
+        # Node 0 accepts connections but never answers the handshake
+        config = {**self.partition_config(), 'partition_timeout': 0.2}
+        stalled = socket.create_server(worker_address(config, 0))
+        self.addCleanup(stalled.close)
+        self.start_worker(config, 1)
+        client = PartitionClient(config)
+        self.addCleanup(client.stop)
+        readings = [self.reading(f'dev-{i}') for i in range(20)]
+        started = time.monotonic()
+        rejected = client.put_batch(readings)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(rejected, [i for i, r in enumerate(readings) if client.ring.node(r['device_id']) == 0])
+
+    def test_async_put_keeps_the_event_loop_running(self):
+        # Node 0 is connected but stops replying
+        release = threading.Event()
+        self.nodes[0].queue.put_many = lambda readings: release.wait()
+        self.addCleanup(release.set)
+        client = PartitionClient({**self.config, 'partition_timeout': 0.3})
+        self.addCleanup(client.stop)
+        readings = [self.reading(f'dev-{i}') for i in range(20)]
+
+        async def put():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.ensure_future(tick())
+            rejected = await client.aput_batch(readings)
+            ticker.cancel()
+            return rejected, ticks
+
+        rejected, ticks = asyncio.run(put())
+        self.assertEqual(rejected, [i for i, r in enumerate(readings) if client.ring.node(r['device_id']) == 0])
+        self.assertGreater(ticks, 10)
+
+    def test_unreachable_worker(self):
+        # Only node 0 of this ring is running
+        config = self.partition_config()
+        self.start_worker(config, 0)
+        client = PartitionClient(config)
+        self.addCleanup(client.stop)
+        devices = [f'dev-{i}' for i in range(20)]
+        self.assertFalse(client.put_many([self.reading(d) for d in devices]))
+        stats = client.stats()
+        self.assertEqual(stats['reachable'], 1)
+        self.assertEqual(stats['sent_unreachable'], 1)
+
+
+class WorkersCacheTests(SimpleTestCase):
+
+    def test_local_caches_refuse_to_start(self):
+        # Checked before any worker is spawned
+        with self.assertRaisesMessage(CommandError, 'the ingest workers, whose device cache'):
+            call_command('ingest_workers')
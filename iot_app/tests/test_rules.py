@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+from django.test import SimpleTestCase
+from iot_app import rules
+from iot_app.models import Device, RelayEvent
+from .base import StoreTestCase
+
+START = datetime(2026, 3, 2, 12, 0)  # a Monday
+
+
+def device(**fields):
+    return {
+        'device_id': 'dev-1', 'relay_state': False, 'auto_mode': True,
+        'temp_threshold_high': 30, 'temp_threshold_low': 20, 'relay_changed_at': None, **fields,
+    }
+
+
+def readings(*temperatures, start=START, step=timedelta(minutes=1)):
+    return [
+        {'timestamp': start + i * step, 'temperature': t, 'humidity': 50.0}
+        for i, t in enumerate(temperatures)
+    ]
+
+
+class RuleTests(SimpleTestCase):
+
+    def setUp(self):
+        rules._compiled.clear()
+
+    def test_thresholds_are_a_hysteresis(self):
+        state, changed_at, transitions = rules.evaluate(device(), readings(25, 31, 25, 19, 25))
+        self.assertFalse(state)
+        self.assertEqual([s for _, s in transitions], [True, False])
+        self.assertEqual(changed_at, START + timedelta(minutes=3))
+
+    def test_heating_band(self):
+        spec = [{'type': 'hysteresis', 'field': 'temperature', 'on_below': 18, 'off_above': 21}]
+        state, _, _ = rules.evaluate(device(rules=spec), readings(20, 17, 19))
+        self.assertTrue(state)
+
+    def test_min_duration_holds_a_change(self):
+        spec = [
+            {'type': 'hysteresis', 'field': 'temperature', 'on_above': 30, 'off_below': 20},
+            {'type': 'min_duration', 'on': 300},
+        ]
+        _, _, transitions = rules.evaluate(device(rules=spec), readings(31, 19, 19, 19, 19, 19, 19))
+        self.assertEqual(transitions, [(START, True), (START + timedelta(minutes=5), False)])
+
+    def test_schedule_wraps_midnight(self):
+        spec = [{'type': 'schedule', 'start': '22:00', 'end': '06:00', 'state': True, 'days': [0]}]
+        night = readings(25, start=START.replace(hour=23))
+        self.assertTrue(rules.evaluate(device(rules=spec), night)[0])
+        rules._compiled.clear()
+        tuesday = readings(25, start=START.replace(hour=23) + timedelta(days=1))
+        self.assertFalse(rules.evaluate(device(rules=spec), tuesday)[0])
+
+    def test_rate_of_change(self):
+        spec = [{'type': 'rate', 'field': 'temperature', 'per_minute': 1, 'state': True}]
+        self.assertFalse(rules.evaluate(device(rules=spec), readings(20, 20.5))[0])
+        self.assertTrue(rules.evaluate(device(rules=spec), readings(22, 24))[0])
+
+    def test_previous_reading_carries_over_batches(self):
+        spec = [{'type': 'rate', 'field': 'temperature', 'per_minute': 1, 'state': True}]
+        rules.evaluate(device(rules=spec), readings(20))
+        state, _, _ = rules.evaluate(device(rules=spec), readings(23, start=START + timedelta(minutes=1)))
+        self.assertTrue(state)
+
+    def test_manual_mode_ignores_rules(self):
+        state, _, transitions = rules.evaluate(device(auto_mode=False), readings(35))
+        self.assertFalse(state)
+        self.assertEqual(transitions, [])
+
+    def test_compile_errors(self):
+        for specs in (
+            {'type': 'schedule'},
+            [{'type': 'laser'}],
+            [{'type': 'hysteresis', 'field': 'pressure', 'on_above': 1, 'off_below': 0}],
+            [{'type': 'hysteresis', 'on_above': 20, 'off_below': 30}],
+            [{'type': 'schedule', 'start': '25:00', 'end': '06:00', 'state': True}],
+            [{'type': 'rate', 'per_minute': 0, 'state': True}],
+        ):
+            with self.subTest(specs=specs), self.assertRaises(ValueError):
+                rules.compile_rules(specs)
+
+
+class RelayEndpointTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Device.get_or_create('dev-1')
+
+    def test_set_rules(self):
+        spec = [{'type': 'hysteresis', 'field': 'humidity', 'on_above': 70, 'off_below': 60}]
+        response = self.post_json('/api/devices/dev-1/set_relay/', {'rules': spec})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['rules'], spec)
+
+    def test_invalid_rules_are_rejected(self):
+        response = self.post_json('/api/devices/dev-1/set_relay/', {'rules': [{'type': 'laser'}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(Device.get_by_id('dev-1').get('rules'))
+
+    def test_invalid_schedules_are_rejected(self):
+        schedule = {'type': 'schedule', 'start': '22:00', 'end': '06:00', 'state': False}
+        for fields in (
+            {'days': 1}, {'days': 'mon'}, {'days': [7]}, {'days': [-1]}, {'days': [True]}, {'days': [1.5]},
+            {'start': 2200}, {'start': None}, {'end': '6'}, {'end': '06:00:00'}, {'end': '06:60'},
+        ):
+            with self.subTest(fields=fields):
+                response = self.post_json('/api/devices/dev-1/set_relay/', {'rules': [{**schedule, **fields}]})
+                self.assertEqual(response.status_code, 400)
+        response = self.post_json('/api/devices/dev-1/set_relay/', {'rules': [{**schedule, 'days': [0, 6]}]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_ingest_switches_relay_and_records_runs(self):
+        self.post_json('/api/telemetry/batch/', [
+            {**r, 'device_id': 'dev-1', 'timestamp': r['timestamp'].isoformat()}
+            for r in readings(31, 25, 19, start=self.hours_ago(2))
+        ])
+        device = Device.get_by_id('dev-1')
+        self.assertFalse(device['relay_state'])
+        runs = RelayEvent.find_overlapping(self.hours_ago(3), self.hours_ago(0))
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0]['end'] - runs[0]['start'], timedelta(minutes=2))
+
+    def test_manual_switch(self):
+        self.post_json('/api/devices/dev-1/set_relay/', {'auto_mode': False})
+        response = self.post_json('/api/devices/dev-1/set_relay/', {'state': True})
+        self.assertTrue(response.json()['relay_state'])
+        self.assertEqual(len(RelayEvent.open_runs('dev-1')), 1)
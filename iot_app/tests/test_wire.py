@@ -0,0 +1,62 @@
+import tempfile
+from datetime import datetime
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, override_settings
+from iot_app.cache import process_local_caches
+from iot_app.wire import (
+    ACK_BUSY, HEADER, MAX_READINGS, FrameError, decode_ack, decode_frame, encode_ack, encode_frame
+)
+
+
+class FrameTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        taken = datetime(2026, 3, 2, 12, 0, 5)
+        received = datetime(2026, 3, 2, 12, 1)
+        frame = encode_frame('dev-1', [(taken, 21.37, 48.5), (None, -12.05, 100.0)])
+        self.assertEqual(len(frame), HEADER.size + len('dev-1') + 2 + 2 * 8)
+        self.assertEqual(decode_frame(frame, received), [
+            {'device_id': 'dev-1', 'temperature': 21.37, 'humidity': 48.5, 'timestamp': taken},
+            {'device_id': 'dev-1', 'temperature': -12.05, 'humidity': 100.0, 'timestamp': received},
+        ])
+
+    def test_encode_rejects(self):
+        with self.assertRaises(FrameError):
+            encode_frame('', [])
+        with self.assertRaises(FrameError):
+            encode_frame('x' * 65, [])
+        with self.assertRaises(FrameError):
+            encode_frame('dev-1', [(None, 21.0, 50.0)] * (MAX_READINGS + 1))
+        with self.assertRaises(FrameError):
+            encode_frame('dev-1', [(None, 21.0, -1.0)])
+
+    def test_decode_rejects(self):
+        frame = encode_frame('dev-1', [(None, 21.0, 50.0)])
+        for bad in (b'', frame[:4], b'XX' + frame[2:], frame[:-1], frame + b'\0'):
+            with self.subTest(bad=bad), self.assertRaises(FrameError):
+                decode_frame(bad)
+
+    def test_ack(self):
+        self.assertEqual(decode_ack(encode_ack(ACK_BUSY, 7)), (ACK_BUSY, 7))
+        with self.assertRaises(FrameError):
+            decode_ack(b'XX' + encode_ack(ACK_BUSY, 7)[2:])
+
+
+class ListenerCacheTests(SimpleTestCase):
+
+    def test_local_caches_refuse_to_start(self):
+        self.assertEqual(len(process_local_caches()), 2)
+        with self.assertRaisesMessage(CommandError, '--allow-local-cache'):
+            call_command('ingest_listener')
+
+    def test_shared_caches(self):
+        shared = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                       'LOCATION': tempfile.mkdtemp()},
+        }
+        with override_settings(CACHES=shared, IOT_DEVICE_CACHE={'shared': True, 'cache_alias': 'shared'},
+                               IOT_HISTORY_CACHE={'cache_alias': 'shared'}):
+            self.assertEqual(process_local_caches(), [])
+        with override_settings(IOT_DEVICE_CACHE={'enabled': False}, IOT_HISTORY_CACHE={'enabled': False}):
+            self.assertEqual(process_local_caches(), [])
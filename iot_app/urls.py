@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from . import views
@@ -6,8 +7,25 @@ router = DefaultRouter()
 router.register(r'telemetry', views.TelemetryViewSet, basename='telemetry')
 router.register(r'devices', views.DeviceViewSet, basename='device')
 router.register(r'daily-logs', views.DailyLogViewSet, basename='daily-log')
+router.register(r'analytics', views.AnalyticsViewSet, basename='analytics')
+router.register(r'runtime', views.RuntimeViewSet, basename='runtime')
+router.register(r'fleet', views.FleetViewSet, basename='fleet')
+router.register(r'anomalies', views.AnomalyViewSet, basename='anomaly')
 
 urlpatterns = [
+    path('api/stream/', views.telemetry_stream, name='telemetry-stream'),
+    path('api/bootstrap/', views.bootstrap, name='bootstrap'),
+    path('api/telemetry/export/', views.telemetry_export, name='telemetry-export'),
+    path('api/devices/<str:pk>/command/wait/', views.command_wait, name='device-command-wait'),
     path('api/', include(router.urls)),
+    path('metrics', views.metrics_view, name='metrics'),
     path('', views.dashboard, name='dashboard'),
-]
\ No newline at end of file
+]
+
+if settings.IOT_ASYNC_VIEWS:
+    urlpatterns = [
+        path('api/telemetry/', views.telemetry_collection, name='telemetry-list'),
+        path('api/telemetry/batch/', views.telemetry_batch, name='telemetry-batch'),
+        path('api/devices/<str:pk>/command/', views.device_command, name='device-command'),
+        path('api/bootstrap/', views.async_bootstrap, name='bootstrap'),
+    ] + urlpatterns
\ No newline at end of file
@@ -1,146 +1,207 @@
+import asyncio
+import contextvars
+import csv
+import hashlib
+import io
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import pymongo
+from bson import ObjectId
+from pymongo.errors import PyMongoError
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .models import Telemetry, Device, DailyLog
+from .models import Anomaly, Telemetry, Device, DailyLog, RelayEvent, RelayRuntime
 from .serializers import TelemetrySerializer, DeviceSerializer, DailyLogSerializer
+from .aggregation import parse_duration, resolve_window, bucket_window, build_series, align
+from .events import broker
+from .pagination import encode_cursor, decode_cursor
+from .ingest import to_local, ingest_readings, aingest_readings, ingest_mode, queue_enabled, get_ingest_queue, MAX_BATCH_SIZE
+from .cache import get_device_cache, get_history_cache
+from .instrumentation import metrics, timed
+from .anomaly import get_detector
+from . import rules
 from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import render
-from statistics import mean
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.text import compress_string
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
+
+MIN_COMPRESS_SIZE = 512
+
+ANOMALY_PAGE_SIZE = 100
+MAX_ANOMALY_PAGE_SIZE = 1000
+
+FLEET_PAGE_SIZE = 100
+MAX_FLEET_PAGE_SIZE = 1000
+FLEET_FIELDS = {'_id': 0, 'device_id': 1, 'relay_state': 1, 'auto_mode': 1, 'last_seen': 1, 'last_reading': 1}
+
+def fleet_settings():
+    return {'offline_after': 120, **getattr(settings, 'IOT_FLEET', {})}
+
+def command_payload(device):
+    return {
+        'relay': device['relay_state'],
+        'auto_mode': device['auto_mode'],
+        'temp_threshold_high': device['temp_threshold_high'],
+        'temp_threshold_low': device['temp_threshold_low'],
+        'version': device.get('state_version', 0)
+    }
+
+def payload_etag(payload):
+    digest = hashlib.md5(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    return f'"{digest[:16]}"'
+
+def last_modified(device_id, floor):
+    # Responses change when a device reports and when the window moves on
+    # (floor), whichever came last; None without the history cache
+    history = get_history_cache()
+    if history is None:
+        return None
+    return max(history.state(device_id)[1], floor)
+
+async def alast_modified(device_id, floor):
+    history = get_history_cache()
+    if history is None:
+        return None
+    return max((await history.astate(device_id))[1], floor)
+
+def revalidate(request, payload, modified=None):
+    # (headers, not_modified) for ETag/Last-Modified revalidation
+    etag = payload_etag(payload)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if modified is not None:
+        headers['Last-Modified'] = http_date(modified.timestamp())
+    # If-None-Match takes precedence over If-Modified-Since
+    if 'If-None-Match' in request.headers:
+        not_modified = etag in request.headers['If-None-Match']
+    else:
+        since = parse_http_date_safe(request.headers.get('If-Modified-Since'))
+        not_modified = modified is not None and since is not None and int(modified.timestamp()) <= since
+    return headers, not_modified
+
+def conditional_response(request, payload, modified=None):
+    headers, not_modified = revalidate(request, payload, modified)
+    if not_modified:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(payload, headers=headers)
+
+def conditional_json_response(request, payload, modified=None):
+    headers, not_modified = revalidate(request, payload, modified)
+    if not_modified:
+        return HttpResponse(status=304, headers=headers)
+    return JsonResponse(payload, safe=False, headers=headers)
+
+def encode_body(request, body):
+    # (body, content encoding) using brotli when installed, else gzip;
+    # small bodies aren't worth the CPU
+    accepted = request.headers.get('Accept-Encoding', '')
+    if len(body) < MIN_COMPRESS_SIZE:
+        return body, None
+    if 'br' in accepted:
+        try:
+            import brotli
+        except ImportError:
+            pass
+        else:
+            return brotli.compress(body, quality=5), 'br'
+    if 'gzip' in accepted:
+        return compress_string(body), 'gzip'
+    return body, None
+
+def compact_json_response(request, payload, modified=None):
+    # conditional_json_response without whitespace, compressed when accepted
+    headers, not_modified = revalidate(request, payload, modified)
+    if not_modified:
+        return HttpResponse(status=304, headers=headers)
+    with timed('serialize'):
+        body = json.dumps(payload, separators=(',', ':'), cls=DjangoJSONEncoder).encode()
+        body, encoding = encode_body(request, body)
+    headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return HttpResponse(body, content_type='application/json', headers=headers)
+
+def queue_full_response(rejected=None, total=0):
+    # Plain JsonResponse so the async views can share it. A batch can be
+    # partly queued in partitioned mode; the client resends only `rejected`.
+    body = {'error': 'Ingest queue is full, retry later'}
+    if rejected is not None:
+        body.update(queued=total - len(rejected), rejected=rejected)
+    return JsonResponse(body, status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': '1'})
+
+def batch_serializer(data):
+    # (serializer, error) for a batch body, either a list or {'readings': [...]}
+    readings = data.get('readings') if isinstance(data, dict) else data
+    if not isinstance(readings, list):
+        return None, {'error': 'Expected a list of readings'}
+    if len(readings) > MAX_BATCH_SIZE:
+        return None, {'error': f'At most {MAX_BATCH_SIZE} readings per batch'}
+    return TelemetrySerializer(data=readings, many=True), None
 
 class TelemetryViewSet(viewsets.ViewSet):
     def list(self, request):
         timespan = request.query_params.get('timespan', '1h')
+        bucket = request.query_params.get('bucket', None)
         device_id = request.query_params.get('device_id', None)
-        
+
+        try:
+            span, bucket_size = resolve_window(timespan, bucket)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         now = datetime.now()
-        if timespan == '1h':
-            start_time = now - timedelta(hours=1)
-            start_time = start_time.replace(minute=(start_time.minute // 10) * 10, second=0, microsecond=0)
-            readings = Telemetry.get_range(start_time, now, device_id)
-            
-            data = []
-            current = start_time
-            while current <= now:
-                next_interval = current + timedelta(minutes=10)
-                interval_readings = [r for r in readings 
-                                  if current <= r['timestamp'] < next_interval]
-                
-                if interval_readings:
-                    temperatures = [r['temperature'] for r in interval_readings]
-                    humidities = [r['humidity'] for r in interval_readings]
-                    avg_temp = mean(temperatures) if temperatures else 0
-                    avg_hum = mean(humidities) if humidities else 0
-                else:
-                    avg_temp = 0
-                    avg_hum = 0
-                
-                data.append({
-                    'timestamp': current.isoformat(),
-                    'temperature': avg_temp,
-                    'humidity': avg_hum
-                })
-                current = next_interval
-                
-        elif timespan == '24h':
-            start_time = now - timedelta(days=1)
-            start_time = start_time.replace(minute=0, second=0, microsecond=0)
-            readings = Telemetry.get_range(start_time, now, device_id)
-            
-            data = []
-            current = start_time
-            while current <= now:
-                next_hour = current + timedelta(hours=1)
-                hour_readings = [r for r in readings 
-                               if current <= r['timestamp'] < next_hour]
-                
-                if hour_readings:
-                    temperatures = [r['temperature'] for r in hour_readings]
-                    humidities = [r['humidity'] for r in hour_readings]
-                    avg_temp = mean(temperatures) if temperatures else 0
-                    avg_hum = mean(humidities) if humidities else 0
-                else:
-                    avg_temp = 0
-                    avg_hum = 0
-                
-                data.append({
-                    'timestamp': current.isoformat(),
-                    'temperature': avg_temp,
-                    'humidity': avg_hum
-                })
-                current = next_hour
-                
-        elif timespan == '7d':
-            start_time = now - timedelta(days=7)
-            start_time = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
-            readings = Telemetry.get_range(start_time, now, device_id)
-            
-            data = []
-            current = start_time
-            while current <= now:
-                next_day = current + timedelta(days=1)
-                day_readings = [r for r in readings 
-                              if current <= r['timestamp'] < next_day]
-                
-                if day_readings:
-                    temperatures = [r['temperature'] for r in day_readings]
-                    humidities = [r['humidity'] for r in day_readings]
-                    avg_temp = mean(temperatures) if temperatures else 0
-                    avg_hum = mean(humidities) if humidities else 0
-                else:
-                    avg_temp = 0
-                    avg_hum = 0
-                
-                data.append({
-                    'timestamp': current.isoformat(),
-                    'temperature': avg_temp,
-                    'humidity': avg_hum
-                })
-                current = next_day
-        
-        return Response(data)
+        start_time, count = bucket_window(now, span, bucket_size)
+        partials = Telemetry.cached_buckets(start_time, now, bucket_size, device_id)
+
+        with timed('bucketing'):
+            series = build_series(start_time, bucket_size, count, partials)
+        return conditional_response(request, series, last_modified(device_id, align(now, bucket_size)))
 
     def create(self, request):
         serializer = TelemetrySerializer(data=request.data)
         if serializer.is_valid():
-            # Create telemetry record
-            telemetry = Telemetry.create(
-                device_id=serializer.validated_data['device_id'],
-                temperature=serializer.validated_data['temperature'],
-                humidity=serializer.validated_data['humidity']
-            )
-            
-            # Get or create device
-            device = Device.get_or_create(serializer.validated_data['device_id'])
-            
-            # Auto fan control if auto_mode is enabled
-            if device['auto_mode']:
-                if serializer.validated_data['temperature'] >= device['temp_threshold_high'] and not device['relay_state']:
-                    Device.update(device['device_id'], {'relay_state': True})
-                elif serializer.validated_data['temperature'] <= device['temp_threshold_low'] and device['relay_state']:
-                    Device.update(device['device_id'], {'relay_state': False})
-            
-            # Update daily log
-            today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-            daily_log = DailyLog.get_or_create(device['device_id'], today)
-            
-            # Get today's readings
-            today_readings = Telemetry.get_range(today, today + timedelta(days=1), device['device_id'])
-            
-            if today_readings:
-                temperatures = [r['temperature'] for r in today_readings]
-                humidities = [r['humidity'] for r in today_readings]
-                
-                DailyLog.update(device['device_id'], today, {
-                    'avg_temperature': mean(temperatures),
-                    'avg_humidity': mean(humidities),
-                    'min_temperature': min(temperatures),
-                    'max_temperature': max(temperatures),
-                    'fan_runtime_minutes': daily_log['fan_runtime_minutes'] + (1 if device['relay_state'] else 0)
-                })
-
+            if queue_enabled():
+                if not get_ingest_queue().put(serializer.validated_data):
+                    return queue_full_response()
+                return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+            ingest_readings([serializer.validated_data])
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        serializer, error = batch_serializer(request.data)
+        if error:
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        with timed('validate'):
+            valid = serializer.is_valid()
+        if valid:
+            if queue_enabled():
+                rejected = get_ingest_queue().put_batch(serializer.validated_data)
+                if rejected:
+                    return queue_full_response(rejected, len(serializer.validated_data))
+                return Response({'queued': len(serializer.validated_data)}, status=status.HTTP_202_ACCEPTED)
+            docs = ingest_readings(serializer.validated_data)
+            return Response({'inserted': len(docs)}, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['get'])
+    def queue(self, request):
+        if not queue_enabled():
+            return Response({'mode': 'sync'})
+        return Response({'mode': ingest_mode(), **get_ingest_queue().stats()})
+
 class DeviceViewSet(viewsets.ViewSet):
     def list(self, request):
         devices = Device.get_all()
@@ -159,12 +220,7 @@ class DeviceViewSet(viewsets.ViewSet):
         device = Device.get_by_id(pk)
         if device is None:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        return Response({
-            'relay': device['relay_state'],
-            'auto_mode': device['auto_mode'],
-            'temp_threshold_high': device['temp_threshold_high'],
-            'temp_threshold_low': device['temp_threshold_low']
-        })
+        return conditional_response(request, command_payload(device))
 
     @action(detail=True, methods=['post'])
     def set_relay(self, request, pk=None):
@@ -173,9 +229,20 @@ class DeviceViewSet(viewsets.ViewSet):
             return Response(status=status.HTTP_404_NOT_FOUND)
             
         update_data = {}
+        transitions = []
         if 'state' in request.data and not device['auto_mode']:
-            update_data['relay_state'] = request.data['state']
+            switched, transitions = rules.switch(device, bool(request.data['state']), datetime.now())
+            update_data.update(switched)
         
+        if 'rules' in request.data:
+            try:
+                if request.data['rules'] is not None:
+                    rules.compile_rules(request.data['rules'])
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            # None goes back to the temperature thresholds
+            update_data['rules'] = request.data['rules']
+
         if 'auto_mode' in request.data:
             update_data['auto_mode'] = request.data['auto_mode']
         
@@ -185,16 +252,20 @@ class DeviceViewSet(viewsets.ViewSet):
         if 'temp_threshold_low' in request.data:
             update_data['temp_threshold_low'] = request.data['temp_threshold_low']
         
+        # Runtime first: the device update moves the history mtime on, so
+        # Last-Modified also covers the runtime it changed
+        if transitions:
+            RelayEvent.record_many([(pk, device['relay_state'], device.get('relay_changed_at'), transitions)])
         if update_data:
-            Device.update(pk, update_data)
-            device = Device.get_by_id(pk)
+            device = Device.update(pk, update_data)
             
         return Response({
             'status': 'device updated',
             'relay_state': device['relay_state'],
             'auto_mode': device['auto_mode'],
             'temp_threshold_high': device['temp_threshold_high'],
-            'temp_threshold_low': device['temp_threshold_low']
+            'temp_threshold_low': device['temp_threshold_low'],
+            'rules': rules.device_rules(device)
         })
 
 class DailyLogViewSet(viewsets.ViewSet):
@@ -203,18 +274,606 @@ class DailyLogViewSet(viewsets.ViewSet):
         device_id = request.query_params.get('device_id', None)
         
         now = datetime.now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
         if days:
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=int(days))
+            start_date = today - timedelta(days=int(days))
         else:
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            start_date = today
             
-        logs = DailyLog.collection.find({
-            'date': {'$gte': start_date},
-            **(({'device_id': device_id} if device_id else {}))
-        }).sort('date', -1)
-        
-        serializer = DailyLogSerializer(list(logs), many=True)
-        return Response(serializer.data)
+        logs = DailyLog.get_range(start_date, device_id)
+
+        with timed('serialize'):
+            data = DailyLogSerializer(logs, many=True).data
+        return conditional_response(request, data, last_modified(device_id, today))
+
+class RuntimeViewSet(viewsets.ViewSet):
+    # Fan runtime and duty cycle per device from the relay interval sums
+    def list(self, request):
+        timespan = request.query_params.get('timespan', '7d')
+        bucket = request.query_params.get('bucket', '1d')
+        device_id = request.query_params.get('device_id', None)
+
+        try:
+            span, bucket_size = resolve_window(timespan, bucket)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if bucket_size % RelayRuntime.resolution:
+            return Response({'error': 'bucket must be a whole number of hours'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        now = datetime.now()
+        start_time, count = bucket_window(now, span, bucket_size)
+        totals = RelayRuntime.runtime_seconds(start_time, start_time + count * bucket_size, bucket_size, device_id, now)
+
+        bucket_seconds = bucket_size.total_seconds()
+        devices = {}
+        for (run_device, index), seconds in totals.items():
+            if 0 <= index < count:
+                devices.setdefault(run_device, [0.0] * count)[index] += seconds
+        return Response({
+            'start': start_time.isoformat(),
+            'bucket_seconds': bucket_seconds,
+            'timestamps': [(start_time + i * bucket_size).isoformat() for i in range(count)],
+            'devices': [
+                {
+                    'device_id': run_device,
+                    'total_minutes': round(sum(series) / 60, 2),
+                    'runtime_minutes': [round(seconds / 60, 2) for seconds in series],
+                    'duty_cycle': [round(seconds / bucket_seconds, 4) for seconds in series],
+                }
+                for run_device, series in sorted(devices.items())
+            ],
+        })
+
+class FleetViewSet(viewsets.ViewSet):
+    # Every device with its latest reading, online status and today's log,
+    # one keyset page at a time. Served from the last_seen/last_reading
+    # fields ingest keeps on the device documents, so a page costs three
+    # queries however many readings the devices have.
+    def list(self, request):
+        state = request.query_params.get('status', None)
+        after = request.query_params.get('after', None)
+        if state not in (None, 'online', 'offline'):
+            return Response({'error': 'status must be online or offline'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            after = decode_cursor(after, Device.page_fields) if after else None
+            limit = min(int(request.query_params.get('limit', FLEET_PAGE_SIZE)), MAX_FLEET_PAGE_SIZE)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response({'error': 'limit must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+
+        now = datetime.now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        cutoff = now - timedelta(seconds=fleet_settings()['offline_after'])
+        query = Device.status_query(state == 'online', cutoff) if state else None
+        devices = Device.find_page(after, limit, query, FLEET_FIELDS)
+        logs = DailyLog.for_devices([d['device_id'] for d in devices], today) if devices else {}
+        online, offline = Device.count_online(cutoff)
+
+        with timed('serialize'):
+            logs = {log['device_id']: log for log in DailyLogSerializer(list(logs.values()), many=True).data}
+            results = [
+                {
+                    'device_id': device['device_id'],
+                    'online': device.get('last_seen') is not None and device['last_seen'] >= cutoff,
+                    'last_seen': device.get('last_seen'),
+                    'last_reading': device.get('last_reading'),
+                    'relay_state': device['relay_state'],
+                    'auto_mode': device['auto_mode'],
+                    'today': logs.get(device['device_id']),
+                }
+                for device in devices
+            ]
+        return Response({
+            'results': results,
+            'next': encode_cursor(devices[-1], Device.page_fields) if len(devices) == limit else None,
+            'counts': {'online': online, 'offline': offline, 'total': online + offline},
+        })
+
+class AnomalyViewSet(viewsets.ViewSet):
+    # Flagged and quarantined readings, newest first
+    def list(self, request):
+        since = request.query_params.get('since', '24h')
+        device_id = request.query_params.get('device_id', None)
+        kind = request.query_params.get('kind', None)
+        after = request.query_params.get('after', None)
+        try:
+            since = datetime.now() - parse_duration(since)
+            after = decode_cursor(after, Anomaly.page_fields) if after else None
+            limit = min(int(request.query_params.get('limit', ANOMALY_PAGE_SIZE)), MAX_ANOMALY_PAGE_SIZE)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response({'error': 'limit must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+
+        events = Anomaly.find_page(since, device_id, kind, after, limit)
+        return Response({
+            'results': [{k: v for k, v in event.items() if k != '_id'} for event in events],
+            'next': encode_cursor(events[-1], Anomaly.page_fields) if len(events) == limit else None,
+        })
+
+class AnalyticsViewSet(viewsets.ViewSet):
+    def list(self, request):
+        try:
+            from . import analytics
+        except ImportError:
+            return Response({'error': 'Analytics requires numpy'}, status=status.HTTP_501_NOT_IMPLEMENTED)
+
+        timespan = request.query_params.get('timespan', '24h')
+        bucket = request.query_params.get('bucket', None)
+        window = request.query_params.get('window', None)
+        # Comma separated; all devices when omitted
+        device_ids = [d for d in request.query_params.get('device_id', '').split(',') if d]
+
+        try:
+            span, bucket_size = resolve_window(timespan, bucket)
+            window_size = parse_duration(window) if window else bucket_size
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        now = datetime.now()
+        start_time, _ = bucket_window(now, span, bucket_size)
+        try:
+            result = analytics.analyze(start_time, now, bucket_size, window_size, device_ids or None)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+# Native async counterparts of the hot endpoints, routed ahead of the DRF
+# viewsets when IOT_ASYNC_VIEWS is set (dashboard/asgi.py does this)
+
+def parse_json_body(request):
+    # (data, error response)
+    try:
+        return json.loads(request.body or b'null'), None
+    except ValueError as e:
+        return None, JsonResponse({'detail': f'JSON parse error - {e}'}, status=400)
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+async def telemetry_collection(request):
+    if request.method == 'POST':
+        return await telemetry_create(request)
+
+    timespan = request.GET.get('timespan', '1h')
+    bucket = request.GET.get('bucket', None)
+    device_id = request.GET.get('device_id', None)
+    try:
+        span, bucket_size = resolve_window(timespan, bucket)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    now = datetime.now()
+    start_time, count = bucket_window(now, span, bucket_size)
+    partials = await Telemetry.acached_buckets(start_time, now, bucket_size, device_id)
+    with timed('bucketing'):
+        series = build_series(start_time, bucket_size, count, partials)
+    modified = await alast_modified(device_id, align(now, bucket_size))
+    return conditional_json_response(request, series, modified)
+
+async def telemetry_create(request):
+    data, error = parse_json_body(request)
+    if error:
+        return error
+    serializer = TelemetrySerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    if queue_enabled():
+        if not await get_ingest_queue().aput(serializer.validated_data):
+            return queue_full_response()
+        return JsonResponse(serializer.data, status=202)
+    await aingest_readings([serializer.validated_data])
+    return JsonResponse(serializer.data, status=201)
+
+@csrf_exempt
+@require_POST
+async def telemetry_batch(request):
+    data, error = parse_json_body(request)
+    if error:
+        return error
+    serializer, error = batch_serializer(data)
+    if error:
+        return JsonResponse(error, status=400)
+    with timed('validate'):
+        valid = serializer.is_valid()
+    if not valid:
+        return JsonResponse(serializer.errors, safe=False, status=400)
+    if queue_enabled():
+        rejected = await get_ingest_queue().aput_batch(serializer.validated_data)
+        if rejected:
+            return queue_full_response(rejected, len(serializer.validated_data))
+        return JsonResponse({'queued': len(serializer.validated_data)}, status=202)
+    docs = await aingest_readings(serializer.validated_data)
+    return JsonResponse({'inserted': len(docs)}, status=201)
+
+@require_GET
+async def async_bootstrap(request):
+    try:
+        device_id, now, start_time, bucket_size, count, log_start = bootstrap_window(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        device, partials, logs = await asyncio.wait_for(asyncio.gather(
+            Device.aget_by_id(device_id),
+            Telemetry.acached_buckets(start_time, now, bucket_size, device_id),
+            DailyLog.aget_range(log_start, device_id),
+        ), bootstrap_settings()['timeout'])
+    except asyncio.TimeoutError:
+        return JsonResponse({'error': 'Timed out loading the dashboard'}, status=504)
+    payload = bootstrap_payload(device, partials, start_time, bucket_size, count, logs)
+    modified = await alast_modified(device_id, align(now, bucket_size))
+    return compact_json_response(request, payload, modified)
+
+@require_GET
+async def device_command(request, pk):
+    device = await Device.aget_by_id(pk)
+    if device is None:
+        return HttpResponse(status=404)
+    return conditional_json_response(request, command_payload(device))
 
 def dashboard(request):
-    return render(request, 'iot_app/dashboard.html')
\ No newline at end of file
+    return render(request, 'iot_app/dashboard.html')
+
+# Everything the dashboard needs on load in one response: device state, the
+# chart series and the daily logs, fetched concurrently. Series and logs
+# are parallel arrays; bucket i starts at start + i * bucket_seconds and
+# empty buckets are null.
+
+def bootstrap_settings():
+    return {'workers': 16, 'timeout': 10, **getattr(settings, 'IOT_BOOTSTRAP', {})}
+
+_bootstrap_pool = None
+_bootstrap_pool_lock = threading.Lock()
+
+def get_bootstrap_pool():
+    global _bootstrap_pool
+    if _bootstrap_pool is None:
+        with _bootstrap_pool_lock:
+            if _bootstrap_pool is None:
+                _bootstrap_pool = ThreadPoolExecutor(
+                    max_workers=bootstrap_settings()['workers'], thread_name_prefix='iot-bootstrap'
+                )
+    return _bootstrap_pool
+
+def run_until(deadline, call):
+    # One call of gather_sync, in a copy of the request context so its
+    # queries still count towards the request's stats. Not started once the
+    # deadline has passed; its MongoDB operations are bounded by what is
+    # left (pymongo's client-side timeout).
+    function, *args = call
+    remaining = deadline - time.monotonic() if deadline is not None else None
+    if remaining is not None and remaining <= 0:
+        raise FutureTimeoutError()
+
+    def run():
+        with pymongo.timeout(remaining):
+            return function(*args)
+
+    try:
+        return contextvars.copy_context().run(run)
+    except PyMongoError as e:
+        if e.timeout:
+            raise FutureTimeoutError() from e
+        raise
+
+def gather_sync(*calls, timeout=None):
+    # asyncio.gather for sync views. The first call runs on the request
+    # thread, which afterwards takes back any call still waiting for a pool
+    # thread, so a busy pool slows requests down instead of queueing them
+    # behind each other. Raises concurrent.futures.TimeoutError once
+    # `timeout` seconds have passed; calls still waiting are cancelled.
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    pool = get_bootstrap_pool()
+    futures = [pool.submit(run_until, deadline, call) for call in calls[1:]]
+    try:
+        results = [run_until(deadline, calls[0])]
+        for call, future in zip(calls[1:], futures):
+            if future.cancel():
+                results.append(run_until(deadline, call))
+            else:
+                remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+                results.append(future.result(remaining))
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return results
+
+# Days of daily logs a bootstrap response includes at most
+BOOTSTRAP_MAX_DAYS = 366
+
+def bootstrap_window(params):
+    # (device_id, now, series start, bucket, bucket count, first log date)
+    device_id = params.get('device_id')
+    if not device_id:
+        raise ValueError('device_id is required')
+    span, bucket_size = resolve_window(params.get('timespan', '1h'), params.get('bucket'))
+    days = int(params.get('days', 0))
+    if days < 0:
+        raise ValueError('days must not be negative')
+    days = min(days, BOOTSTRAP_MAX_DAYS)
+    now = datetime.now()
+    start_time, count = bucket_window(now, span, bucket_size)
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return device_id, now, start_time, bucket_size, count, today - timedelta(days=days)
+
+def rounded(value):
+    return round(value, 2) if value is not None else None
+
+def bootstrap_payload(device, partials, start_time, bucket_size, count, logs):
+    series = {'start': start_time.isoformat(), 'bucket_seconds': bucket_size.total_seconds(), 'count': []}
+    for field in ('temperature', 'humidity'):
+        series[field] = []
+    for index in range(count):
+        partial = partials.get(index)
+        n = partial['count'] if partial else 0
+        series['count'].append(n)
+        for field in ('temperature', 'humidity'):
+            series[field].append(round(partial[f'{field}_sum'] / n, 2) if n else None)
+
+    columns = ('avg_temperature', 'min_temperature', 'max_temperature', 'avg_humidity', 'fan_runtime_minutes')
+    daily = {'date': [log['date'].date().isoformat() for log in logs]}
+    for column in columns:
+        daily[column] = [rounded(log[column]) for log in logs]
+
+    if device is not None:
+        device = {
+            **command_payload(device),
+            'device_id': device['device_id'],
+            'last_seen': device.get('last_seen'),
+            'last_reading': device.get('last_reading'),
+        }
+    return {'device': device, 'series': series, 'logs': daily}
+
+@require_GET
+def bootstrap(request):
+    try:
+        device_id, now, start_time, bucket_size, count, log_start = bootstrap_window(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        partials, device, logs = gather_sync(
+            (Telemetry.cached_buckets, start_time, now, bucket_size, device_id),
+            (Device.get_by_id, device_id),
+            (DailyLog.get_range, log_start, device_id),
+            timeout=bootstrap_settings()['timeout'],
+        )
+    except FutureTimeoutError:
+        return JsonResponse({'error': 'Timed out loading the dashboard'}, status=504)
+    payload = bootstrap_payload(device, partials, start_time, bucket_size, count, logs)
+    return compact_json_response(request, payload, last_modified(device_id, align(now, bucket_size)))
+
+def metrics_view(request):
+    # Prometheus text exposition for this worker process
+    gauges = []
+    cache = get_device_cache()
+    gauges.append(('iot_device_cache_hits_total', 'counter', 'Device cache hits', cache.hits))
+    gauges.append(('iot_device_cache_misses_total', 'counter', 'Device cache misses', cache.misses))
+    detector = get_detector()
+    if detector is not None:
+        gauges.append(('iot_anomaly_tracked_devices', 'gauge', 'Devices with anomaly detector state', detector.tracked()))
+    if queue_enabled():
+        stats = get_ingest_queue().stats()
+        gauges += [
+            ('iot_ingest_queue_depth', 'gauge', 'Readings waiting to be written', stats['depth']),
+            ('iot_ingest_queue_capacity', 'gauge', 'Ingest queue capacity', stats['capacity']),
+            ('iot_ingest_accepted_total', 'counter', 'Readings accepted into the queue', stats['accepted']),
+            ('iot_ingest_rejected_total', 'counter', 'Readings rejected with a full queue', stats['rejected']),
+            ('iot_ingest_written_total', 'counter', 'Queued readings written', stats['written']),
+            ('iot_ingest_failed_total', 'counter', 'Queued readings in failed write attempts', stats['failed']),
+            ('iot_ingest_retries_total', 'counter', 'Queue batch write retries', stats['retries']),
+            ('iot_ingest_dropped_total', 'counter', 'Queued readings dropped after the last retry', stats['dropped']),
+            ('iot_ingest_flushes_total', 'counter', 'Queue flushes', stats['flushes']),
+            ('iot_ingest_flush_seconds_total', 'counter', 'Time spent flushing the queue', stats['flush_seconds_total']),
+            ('iot_ingest_flush_seconds_max', 'gauge', 'Slowest queue flush', stats['flush_seconds_max']),
+        ]
+    return HttpResponse(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Seconds between SSE comments that keep idle connections open through proxies
+STREAM_KEEPALIVE = 15
+
+async def telemetry_stream(request):
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'error': 'Streaming requires an ASGI server (dashboard.asgi)'}, status=501)
+
+    device_id = request.GET.get('device_id', None)
+    subscription = broker.subscribe(device_id)
+
+    async def events():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+# Long-poll limits for command_wait, in seconds
+COMMAND_WAIT_DEFAULT = 30
+COMMAND_WAIT_MAX = 60
+# Re-read the device this often while parked, to catch updates made by
+# other worker processes that the in-process broker never sees
+COMMAND_WAIT_RECHECK = 5
+
+async def command_wait(request, pk):
+    try:
+        known_version = int(request.GET.get('version', -1))
+        timeout = float(request.GET.get('timeout', COMMAND_WAIT_DEFAULT))
+        if not math.isfinite(timeout):
+            raise ValueError
+    except ValueError:
+        return JsonResponse({'error': 'version and timeout must be numbers'}, status=400)
+    timeout = min(max(timeout, 0), COMMAND_WAIT_MAX)
+
+    # Subscribe before reading so a change in between still wakes us up
+    subscription = broker.subscribe(pk)
+    try:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        recheck = False
+        while True:
+            # Rechecks read the database: the device cache is per process
+            # and could hide another process's update for its whole TTL
+            device = await Device.aget_by_id(pk, fresh=recheck)
+            if device is None:
+                return JsonResponse({'error': 'Device not found'}, status=404)
+            if device.get('state_version', 0) != known_version:
+                payload = command_payload(device)
+                response = JsonResponse(payload)
+                response['ETag'] = payload_etag(payload)
+                return response
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                response = HttpResponse(status=304)
+                response['ETag'] = payload_etag(command_payload(device))
+                return response
+            try:
+                while True:
+                    event = await asyncio.wait_for(subscription.get(), min(remaining, COMMAND_WAIT_RECHECK))
+                    if event['type'] == 'device':
+                        break
+            except asyncio.TimeoutError:
+                pass
+            recheck = True
+    finally:
+        broker.unsubscribe(subscription)
+
+EXPORT_FIELDS = ('device_id', 'timestamp', 'temperature', 'humidity')
+EXPORT_BATCH_SIZE = 1000
+# Rows per page when paging with ?limit; without it the export is unbounded
+MAX_EXPORT_LIMIT = 1000000
+
+class ExportRows:
+    # The rows of one export. Once a full page (?limit) has streamed,
+    # next_cursor is its resume cursor, which the encoders write after the
+    # rows: a last ndjson line, a '# next_cursor=' line ending the CSV, or
+    # the custom metadata of an empty last Arrow batch.
+
+    def __init__(self, cursor, limit):
+        self.cursor = cursor
+        self.limit = limit
+        self.next_cursor = None
+
+    def __iter__(self):
+        for count, doc in enumerate(self.cursor, 1):
+            yield doc
+            if self.limit and count >= self.limit:
+                self.next_cursor = encode_cursor(doc, Telemetry.page_fields)
+                self.cursor.close()
+                return
+
+def export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for doc in rows:
+        writer.writerow([
+            doc['device_id'], doc['timestamp'].isoformat(), doc['temperature'], doc['humidity']
+        ])
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if rows.next_cursor:
+        buffer.write(f'# next_cursor={rows.next_cursor}\r\n')
+    yield buffer.getvalue()
+
+def export_ndjson(rows):
+    for doc in rows:
+        yield json.dumps({
+            'device_id': doc['device_id'],
+            'timestamp': doc['timestamp'].isoformat(),
+            'temperature': doc['temperature'],
+            'humidity': doc['humidity']
+        }) + '\n'
+    if rows.next_cursor:
+        yield json.dumps({'next_cursor': rows.next_cursor}) + '\n'
+
+def export_arrow(rows):
+    import pyarrow as pa
+
+    schema = pa.schema([
+        ('device_id', pa.string()),
+        ('timestamp', pa.timestamp('us')),
+        ('temperature', pa.float64()),
+        ('humidity', pa.float64()),
+    ])
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    batch = []
+    for doc in rows:
+        batch.append(doc)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            batch = []
+            yield drain()
+    if batch:
+        writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+    if rows.next_cursor:
+        writer.write_batch(pa.RecordBatch.from_pylist([], schema=schema),
+                           custom_metadata={'next_cursor': rows.next_cursor})
+    writer.close()
+    yield drain()
+
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+    'arrow': (export_arrow, 'application/vnd.apache.arrow.stream'),
+}
+
+def parse_time_param(value, name):
+    if value is None:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'{name} must be an ISO 8601 datetime')
+    return to_local(parsed, None)
+
+def telemetry_export(request):
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}, status=400)
+    if export_format == 'arrow':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return JsonResponse({'error': 'Arrow export requires pyarrow'}, status=501)
+
+    try:
+        start_time = parse_time_param(request.GET.get('start'), 'start')
+        end_time = parse_time_param(request.GET.get('end'), 'end')
+        after = request.GET.get('after')
+        after = decode_cursor(after, Telemetry.page_fields) if after else None
+        if after and not (isinstance(after[0], datetime) and isinstance(after[1], ObjectId)):
+            raise ValueError('Invalid cursor')
+        limit = int(request.GET.get('limit', 0))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if not 0 <= limit <= MAX_EXPORT_LIMIT:
+        return JsonResponse({'error': f'limit must be between 0 and {MAX_EXPORT_LIMIT}'}, status=400)
+
+    device_id = request.GET.get('device_id', None)
+    # Archived days are merged in, in the same (timestamp, _id) order
+    cursor = Telemetry.export_range(start_time, end_time, device_id, after=after, batch_size=EXPORT_BATCH_SIZE)
+    encoder, content_type = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(encoder(ExportRows(cursor, limit)), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="telemetry.{export_format}"'
+    return response
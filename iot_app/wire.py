@@ -0,0 +1,91 @@
+import struct
+from datetime import datetime
+
+# Fixed-layout binary telemetry frames, little-endian. One UDP datagram
+# carries one frame; on TCP each frame is prefixed with its length (uint16).
+#
+#   header   magic 'IT' | version u8 | flags u8 | id length u8 | device id (ASCII)
+#   count    u16
+#   reading  timestamp u32 (unix seconds, 0 = time of arrival)
+#            temperature i16 (0.01 °C) | humidity u16 (0.01 %RH)
+#
+# A DHT22 reading is 8 bytes, against ~70 for the JSON body.
+
+MAGIC = b'IT'
+VERSION = 1
+MAX_DEVICE_ID = 64
+MAX_READINGS = 1000
+
+HEADER = struct.Struct('<2sBBB')
+COUNT = struct.Struct('<H')
+READING = struct.Struct('<IhH')
+LENGTH = struct.Struct('<H')
+
+# TCP acknowledgement: magic | version | status u8 | readings accepted u16
+ACK = struct.Struct('<2sBBH')
+ACK_OK = 0
+ACK_BUSY = 1
+ACK_INVALID = 2
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frame(device_id, readings):
+    # readings: (timestamp or None, temperature, humidity) tuples
+    device = device_id.encode('ascii')
+    if not device or len(device) > MAX_DEVICE_ID:
+        raise FrameError(f'Device id must be 1-{MAX_DEVICE_ID} ASCII characters')
+    if len(readings) > MAX_READINGS:
+        raise FrameError(f'At most {MAX_READINGS} readings per frame')
+    parts = [HEADER.pack(MAGIC, VERSION, 0, len(device)), device, COUNT.pack(len(readings))]
+    for timestamp, temperature, humidity in readings:
+        seconds = int(timestamp.timestamp()) if timestamp is not None else 0
+        try:
+            parts.append(READING.pack(seconds, round(temperature * 100), round(humidity * 100)))
+        except struct.error:
+            raise FrameError(f'Reading out of range: {temperature} °C, {humidity} %RH')
+    return b''.join(parts)
+
+
+def decode_frame(frame, received_at=None):
+    # Returns reading dicts in the shape the ingest path takes
+    try:
+        magic, version, _, id_length = HEADER.unpack_from(frame)
+        if magic != MAGIC or version != VERSION:
+            raise FrameError('Unknown frame type')
+        offset = HEADER.size
+        device_id = frame[offset:offset + id_length].decode('ascii')
+        offset += id_length
+        (count,) = COUNT.unpack_from(frame, offset)
+        offset += COUNT.size
+    except (struct.error, UnicodeDecodeError):
+        raise FrameError('Truncated or malformed header')
+    if not device_id or count > MAX_READINGS:
+        raise FrameError('Invalid device id or reading count')
+    if len(frame) != offset + count * READING.size:
+        raise FrameError('Frame length does not match the reading count')
+
+    received_at = received_at or datetime.now()
+    readings = []
+    for seconds, temperature, humidity in READING.iter_unpack(frame[offset:]):
+        readings.append({
+            'device_id': device_id,
+            'temperature': temperature / 100,
+            'humidity': humidity / 100,
+            # Naive local time like the rest of the stored timestamps
+            'timestamp': datetime.fromtimestamp(seconds) if seconds else received_at,
+        })
+    return readings
+
+
+def encode_ack(status, accepted):
+    return ACK.pack(MAGIC, VERSION, status, accepted)
+
+
+def decode_ack(data):
+    magic, version, status, accepted = ACK.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise FrameError('Unknown ack')
+    return status, accepted